@@ -0,0 +1,115 @@
+#!/usr/bin/python
+"""
+descriptor_index.py: Benchmark the IVF-PQ index of masif_modules/descriptor_index.py against exact
+search. The database is either an export of masif_modules/export_descriptors.py (the target
+descriptors, queried with flipped descriptors of the same export) or synthetic descriptors near a low dimensional subspace:
+
+    python benchmarks/descriptor_index.py
+    python benchmarks/descriptor_index.py --n 1000000 --n_queries 200
+    python benchmarks/descriptor_index.py --desc_dir descriptors/sc05/all_feat/corpus
+
+Reports the build time, the index size, and for each n_probe the recall@k (fraction of the exact k
+nearest descriptors found) and the time per query, with and without exact reranking, against exact
+chunked search (exact_search), and the number of queries after which the build time is paid back.
+The row compute_dists is the per-query distance loop of train_ppi_search, for reference only. Exact
+search is about as fast as the index up to about 50k descriptors; the index is faster from a few
+hundred thousand descriptors on (e.g. --n 1000000).
+Released under an Apache License 2.0
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+SOURCE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SOURCE_DIR))
+
+from masif_modules.descriptor_index import DescriptorIndex, exact_search
+
+
+def synthetic_descriptors(n, n_dims, rng, n_latent=10):
+    # Descriptors near a n_latent dimensional subspace, as the output of the last linear layer of the network
+    projection = np.random.RandomState(0).normal(size=(n_latent, n_dims)).astype(np.float32)
+    latent = rng.normal(size=(n, n_latent)).astype(np.float32)
+    return latent @ projection + 0.1 * rng.normal(size=(n, n_dims)).astype(np.float32)
+
+
+def recall(found, truth):
+    return np.mean([len(np.intersect1d(f, t)) / len(t) for f, t in zip(found, truth)])
+
+
+def brute_force(database, queries, k):
+    # Distances of each query to every descriptor, as compute_dists in train_ppi_search
+    out = []
+    for query in queries:
+        dists = np.sqrt(np.sum(np.square(database - query), axis=1))
+        out.append(np.argsort(dists)[:k])
+    return np.array(out)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Recall and latency of the descriptor index against exact search")
+    parser.add_argument("--desc_dir", default=None, help="Export of export_descriptors.py (default: synthetic descriptors)")
+    parser.add_argument("--n", type=int, default=200000, help="Number of synthetic descriptors")
+    parser.add_argument("--n_dims", type=int, default=80, help="Size of the synthetic descriptors")
+    parser.add_argument("--n_queries", type=int, default=100, help="Number of queries")
+    parser.add_argument("--k", type=int, default=10, help="Number of neighbors")
+    parser.add_argument("--n_lists", type=int, default=None, help="Number of lists (default: about 4*sqrt(n))")
+    parser.add_argument("--n_subvectors", type=int, default=16, help="Bytes per descriptor")
+    parser.add_argument("--n_probe", type=int, nargs="+", default=[1, 4, 16, 64], help="Lists scanned per query")
+    return parser.parse_args()
+
+
+def main(args):
+    rng = np.random.RandomState(0)
+    if args.desc_dir is not None:
+        database = np.load(os.path.join(args.desc_dir, "desc_straight.npy"), mmap_mode="r")
+        flipped = np.load(os.path.join(args.desc_dir, "desc_flipped.npy"), mmap_mode="r")
+        queries = np.asarray(flipped[np.sort(rng.choice(len(flipped), args.n_queries, replace=False))], dtype=np.float32)
+    else:
+        database = synthetic_descriptors(args.n, args.n_dims, rng)
+        queries = synthetic_descriptors(args.n_queries, args.n_dims, np.random.RandomState(1))
+    n_lists = args.n_lists or int(min(4 * np.sqrt(len(database)), len(database) // 39 + 1))
+    print("{} descriptors of size {}, {} queries, {} lists".format(len(database), database.shape[1], len(queries), n_lists))
+
+    tic = time.perf_counter()
+    truth, _ = exact_search(database, queries, args.k)
+    exact_time = (time.perf_counter() - tic) / len(queries)
+
+    n_brute = min(len(queries), 10)
+    tic = time.perf_counter()
+    brute_force(np.asarray(database, dtype=np.float32), queries[:n_brute], args.k)
+    brute_time = (time.perf_counter() - tic) / n_brute
+
+    tic = time.perf_counter()
+    sample = database[np.sort(rng.choice(len(database), min(200000, len(database)), replace=False))]
+    index = DescriptorIndex.train(sample, n_lists=n_lists, n_subvectors=args.n_subvectors)
+    index.add(database)
+    build_time = time.perf_counter() - tic
+    with tempfile.TemporaryDirectory() as index_dir:
+        index.save(index_dir)
+        size = sum(f.stat().st_size for f in Path(index_dir).iterdir())
+        index = DescriptorIndex.load(index_dir)
+        print("Build {:.1f} s, index {:.1f} MB ({:.1f} MB of float32 descriptors)".format(
+            build_time, size / 2**20, database.shape[0] * database.shape[1] * 4 / 2**20))
+
+        print("{:<22} {:>10} {:>14} {:>12}".format("search", "recall@{}".format(args.k), "ms / query", "break-even"))
+        print("{:<22} {:>10.3f} {:>14.2f}".format("compute_dists", 1.0, 1000 * brute_time))
+        print("{:<22} {:>10.3f} {:>14.2f}".format("exact (chunked)", 1.0, 1000 * exact_time))
+        for n_probe in args.n_probe:
+            for rerank in [False, True]:
+                tic = time.perf_counter()
+                found, _ = index.search(queries, k=args.k, n_probe=n_probe, database=database if rerank else None)
+                elapsed = (time.perf_counter() - tic) / len(queries)
+                name = "n_probe={}{}".format(n_probe, " reranked" if rerank else "")
+                # Queries after which the build time is paid back, against exact search
+                break_even = "{:.0f}".format(build_time / (exact_time - elapsed)) if elapsed < exact_time else "never"
+                print("{:<22} {:>10.3f} {:>14.2f} {:>12}".format(name, recall(found, truth), 1000 * elapsed, break_even))
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+"""
+ligand_tfrecords.py: Benchmark the MaSIF-ligand records: the FloatList / Int64List records read with
+_parse_function, against the raw byte records (float32 and float16) read with the tf.data pipeline of
+read_ligand_tfrecords.ligand_dataset. The records hold synthetic proteins with the array shapes of
+the precomputed patches, written to a temporary directory in several shards:
+
+    python benchmarks/ligand_tfrecords.py
+    python benchmarks/ligand_tfrecords.py --n_proteins 64 --n_vertices 4000 --shards 8 --epochs 3
+
+Reports the time to write the records, their size, and the records read per second.
+Released under an Apache License 2.0
+"""
+import argparse
+import importlib.util
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+SOURCE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SOURCE_DIR))
+
+
+def synthetic_protein(n_vertices, max_vertices, n_feat, n_ligands, rng):
+    n_members = rng.integers(max_vertices // 2, max_vertices + 1, n_vertices)
+    mask = (np.arange(max_vertices)[None,:] < n_members[:,None]).astype(float)
+    return {
+        "input_feat": rng.normal(size=(n_vertices, max_vertices, n_feat)) * mask[:,:,None],
+        "rho_wrt_center": rng.uniform(0, 12, (n_vertices, max_vertices)) * mask,
+        "theta_wrt_center": rng.uniform(0, 2 * np.pi, (n_vertices, max_vertices)) * mask,
+        "mask": mask[:,:,None],
+        "pocket_labels": rng.integers(0, 8, (n_vertices, n_ligands)) * (rng.uniform(size=(n_vertices, 1)) < 0.05),
+    }
+
+
+def write_records(out_dir, name, proteins, shards, serialize):
+    import tensorflow as tf
+
+    files = [str(out_dir.joinpath("{}_{:03d}.tfrecord".format(name, k))) for k in range(shards)]
+    start = time.perf_counter()
+    writers = [tf.python_io.TFRecordWriter(f) for f in files]
+    for i, (pdb, arrays) in enumerate(proteins):
+        writers[i % shards].write(serialize(pdb, arrays))
+    for writer in writers:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    size = sum(Path(f).stat().st_size for f in files)
+    return files, elapsed, size
+
+
+def read_records(dataset, epochs):
+    """
+    Records per second read from dataset (over all epochs), and the arrays of the first record.
+    """
+    import tensorflow as tf
+
+    next_element = dataset.repeat(epochs).make_one_shot_iterator().get_next()
+    n = 0
+    first = None
+    with tf.Session() as session:
+        start = time.perf_counter()
+        while True:
+            try:
+                values = session.run(next_element)
+            except tf.errors.OutOfRangeError:
+                break
+            if first is None:
+                first = values
+            n += 1
+        elapsed = time.perf_counter() - start
+    return n / elapsed, first
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Write and read speed of the MaSIF-ligand record formats")
+    parser.add_argument("--n_proteins", type=int, default=32, help="Number of records")
+    parser.add_argument("--n_vertices", type=int, default=2000, help="Number of patches of each protein")
+    parser.add_argument("--max_vertices", type=int, default=200, help="Number of vertices of each patch")
+    parser.add_argument("--n_feat", type=int, default=5, help="Number of input features")
+    parser.add_argument("--shards", type=int, default=4, help="Number of files the records are written to")
+    parser.add_argument("--epochs", type=int, default=2, help="Number of passes over the records")
+    parser.add_argument("--num_parallel_calls", type=int, default=4, help="Parallel interleave and parse calls")
+    return parser.parse_args()
+
+
+def main(args):
+    if importlib.util.find_spec("tensorflow") is None:
+        sys.exit("tensorflow is not installed")
+    import tensorflow as tf
+    from masif_modules.read_ligand_tfrecords import raw_example, features_example
+
+    rng = np.random.default_rng(0)
+    proteins = [("P{:04d}_A".format(i), synthetic_protein(args.n_vertices, args.max_vertices, args.n_feat, 2, rng))
+                for i in range(args.n_proteins)]
+    formats = [
+        ("features", lambda pdb, a: features_example(pdb, a["input_feat"], a["rho_wrt_center"],
+                                                     a["theta_wrt_center"], a["mask"], a["pocket_labels"])),
+        ("raw_float32", lambda pdb, a: raw_example(pdb, a, float_dtype="float32")),
+        ("raw_float16", lambda pdb, a: raw_example(pdb, a, float_dtype="float16")),
+    ]
+
+    print("{:<14} {:<10} {:>10} {:>14} {:>12} {:>10}".format(
+        "format", "reader", "write [s]", "MB / record", "records/s", "max error"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, serialize in formats:
+            files, write_time, size = write_records(Path(tmp_dir), name, proteins, args.shards, serialize)
+            # The records in the current format are also read as they are now: one file after the other,
+            # parsed sequentially
+            readers = ["sequential", "pipeline"] if name == "features" else ["pipeline"]
+            for reader in readers:
+                with tf.Graph().as_default():
+                    rate, first = read_records_in_graph(reader, name, files, args)
+                pdb = first[5].decode()
+                expected = dict(proteins)[pdb]
+                error = max(np.abs(first[k] - expected[key]).max() for k, key in enumerate(
+                    ["input_feat", "rho_wrt_center", "theta_wrt_center", "mask", "pocket_labels"]))
+                print("{:<14} {:<10} {:>10.2f} {:>14.2f} {:>12.1f} {:>10.2g}".format(
+                    name, reader, write_time, size / len(proteins) / 2**20, rate, error))
+
+
+def read_records_in_graph(reader, name, files, args):
+    # Build the reader in the current graph and time it
+    import tensorflow as tf
+    from masif_modules.read_ligand_tfrecords import _parse_function, ligand_dataset
+
+    if reader == "sequential":
+        dataset = tf.data.TFRecordDataset(files).map(_parse_function)
+    else:
+        record_format = "features" if name == "features" else "raw"
+        float_dtype = "float32" if name == "features" else name.split("_")[1]
+        dataset = ligand_dataset(files, record_format=record_format, float_dtype=float_dtype,
+                                 cycle_length=args.num_parallel_calls, num_parallel_calls=args.num_parallel_calls)
+    return read_records(dataset, args.epochs)
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
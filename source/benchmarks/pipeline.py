@@ -0,0 +1,572 @@
+#!/usr/bin/python
+"""
+pipeline.py: Benchmark the stages of the surface pipeline on the bundled molecules (data/2sic.pdb,
+data/np.pqr) and on synthetic surfaces of controlled size (icospheres and random blobs, see synthetic.py),
+which need no external programs. Reports the time and peak memory of each stage, how they scale with
+the number of vertices, and compares them with stored baselines:
+
+    python benchmarks/pipeline.py                              # all stages, compared with benchmarks/baselines.json
+    python benchmarks/pipeline.py --sizes 1000 10000 --stages geodesic_dijkstra geodesic_heat
+    python benchmarks/pipeline.py --update_baselines           # store the current results as the baselines
+    python benchmarks/pipeline.py --fail_on_regression         # exit with an error on a regression (e.g. in CI)
+
+The times are compared relative to a calibration workload run on the same machine (see calibrate), so
+that baselines recorded on another machine, or under another load, do not show as regressions. The
+regressions are reported as warnings unless --fail_on_regression is given.
+
+The stages that work on patches (geodesics, MDS, compute_thetas, DDC, shape complementarity) are run on
+--n_patches patches, so their scaling shows the part of the cost that grows with the size of the mesh.
+Stages whose libraries (pymesh, BioPython) or programs (MSMS) are missing are reported as skipped.
+Released under an Apache License 2.0
+"""
+import argparse
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+SOURCE_DIR = Path(__file__).resolve().parent.parent
+DATA_DIR = SOURCE_DIR.parent.joinpath('data')
+sys.path.insert(0, str(SOURCE_DIR))
+
+from default_config import global_vars
+from default_config.masif_opts import masif_opts
+from profiling import peak_rss_mb
+from synthetic import icosphere_mesh, blob_mesh, dot_surface, write_msms
+
+DEFAULT_SIZES = [1000, 3000, 10000, 30000, 100000]
+DEFAULT_MOLECULES = ['2sic.pdb', 'np.pqr']
+DEFAULT_BASELINES = Path(__file__).resolve().parent.joinpath('baselines.json')
+
+
+class Skip(Exception):
+    pass
+
+
+class Timer:
+    """
+    Wall time of a block and, if trace_memory, the peak of the memory allocated in it (tracemalloc).
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.wall = None
+        self.peak_mb = None
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+            self.base = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.start
+        if self.trace_memory:
+            self.peak_mb = (tracemalloc.get_traced_memory()[1] - self.base) / 2**20
+            tracemalloc.stop()
+
+
+class Case:
+    """
+    A surface the stages run on. Intermediate results that several stages need (normals,
+    geodesic distances of the patches, ...) are computed once, outside of the timed blocks.
+        faces: None for a dot surface (no mesh)
+        path: PDB / PQR file of a molecule, None for synthetic surfaces
+    """
+    def __init__(self, name, family, vertices, faces=None, normals=None, names=None, path=None, tmp_dir=None,
+                 n_patches=200, radius=9.0, seed=0):
+        self.name = name
+        self.family = family
+        self.vertices = vertices
+        self.faces = faces
+        self.path = path
+        self.tmp_dir = tmp_dir
+        self.n_patches = n_patches
+        self.radius = radius
+        self.rng = np.random.default_rng(seed)
+        self.names = names if names is not None else ['A_1_ALA_C_CA'] * len(vertices)
+        self.cache = {} if normals is None else {'normals':normals}
+
+    def get(self, key, func):
+        if key not in self.cache:
+            self.cache[key] = func(self)
+        return self.cache[key]
+
+    def require_mesh(self):
+        if self.faces is None:
+            raise Skip('no mesh (MSMS not found)')
+
+
+def synthetic_case(family, size, args, tmp_dir):
+    vertices, faces = {'icosphere':icosphere_mesh, 'blob':blob_mesh}[family](size)
+    return Case(f"{family}_{len(vertices)}", family, vertices, faces, tmp_dir=tmp_dir,
+                n_patches=args.n_patches, radius=args.radius)
+
+
+def molecule_case(name, args, tmp_dir):
+    """
+    The MSMS surface of a bundled molecule, or its dot surface if MSMS is not installed.
+    """
+    from main import build_parser, msms_arguments
+    from triangulation.xyzrn import read_xyzrn_atoms
+    from triangulation.computeMSMS import computeMSMS
+
+    path = DATA_DIR.joinpath(name)
+    try:
+        global_vars.msms_bin
+    except global_vars.MissingProgramError:
+        atom_idx, coords, R, full_ids = read_xyzrn_atoms(path)
+        vertices, normals, names = dot_surface(coords, np.array(R, dtype=float), full_ids)
+        return Case(f"{path.stem}_dots", 'molecule', vertices, normals=normals, names=names, path=path,
+                    tmp_dir=tmp_dir, n_patches=args.n_patches, radius=args.radius)
+
+    masif_opts['tmp_dir'] = str(tmp_dir)
+    vertices, faces, normals, names, areas = computeMSMS(path, msms_arguments(build_parser().parse_args([name])))
+    return Case(path.stem, 'molecule', vertices, faces, normals=normals, names=names, path=path,
+                tmp_dir=tmp_dir, n_patches=args.n_patches, radius=args.radius)
+
+
+### Intermediate results shared by the stages
+
+def case_normals(case):
+    from triangulation.compute_normal import compute_normal
+    return compute_normal(case.vertices, case.faces)
+
+
+def case_centers(case):
+    n = len(case.vertices)
+    return np.sort(case.rng.choice(n, min(case.n_patches, n), replace=False))
+
+
+def case_mesh(case):
+    return SimpleNamespace(vertices=case.vertices, faces=case.faces)
+
+
+def case_patches(case):
+    """
+    Geodesic distances from the patch centers and between the members of each patch, as in
+    compute_patch_coordinates. Returns the distances (dict) and the sparse distance matrix.
+    """
+    import networkx as nx
+    from geometry.compute_polar_coordinates import mesh_graph
+    from geometry.geodesic_matrix import dict_to_csr
+
+    G = mesh_graph(case.get('mesh', case_mesh))
+    centers = case.get('centers', case_centers)
+    d2 = {c: nx.single_source_dijkstra_path_length(G, c, cutoff=case.radius) for c in centers}
+    members = set()
+    for c in centers:
+        members.update(d2[c])
+    for v in members.difference(d2):
+        d2[v] = nx.single_source_dijkstra_path_length(G, v, cutoff=case.radius)
+    return d2, dict_to_csr(d2, len(case.vertices))
+
+
+def case_planes(case):
+    """
+    Patch members and their projection on the tangent plane at the center, as the input of compute_thetas.
+    """
+    normals = case.get('normals', case_normals)
+    d2, D = case.get('patches', case_patches)
+    planes = []
+    for c in case.get('centers', case_centers):
+        neigh = np.array([v for v, d in d2[c].items() if d < case.radius/2], dtype=int)
+        u = np.linalg.svd(np.eye(3) - np.outer(normals[c], normals[c]))[0][:,:2]
+        planes.append((c, neigh, (case.vertices[neigh] - case.vertices[c]) @ u))
+    return planes
+
+
+def kd_surface(vertices, normals, rows, radius, max_vertices):
+    """
+    Surface whose patches are the nearest vertices within radius (euclidean) of each vertex in rows,
+    to run compute_shape_complementarity without computing geodesic patches for the whole mesh.
+    """
+    from scipy.spatial import cKDTree
+    from masif_modules.surface import Surface
+
+    n = len(vertices)
+    rho = np.zeros((n, max_vertices))
+    mask = np.zeros((n, max_vertices))
+    neigh = [np.zeros(0, dtype=int)] * n
+    dist, idx = cKDTree(vertices).query(vertices[rows], k=min(max_vertices, n), distance_upper_bound=radius)
+    for r, d, i in zip(rows, dist, idx):
+        valid = np.isfinite(d)
+        neigh[r] = i[valid]
+        rho[r,:valid.sum()] = d[valid]
+        mask[r,:valid.sum()] = 1
+    return Surface(vertices, normals, None, rho, None, mask, neigh, None)
+
+
+def case_sc_surfaces(case):
+    """
+    The surface, and a noisy copy of the region around one of its vertices, with flipped normals,
+    as the binding partner: the interface has about n_patches vertices.
+    """
+    from scipy.spatial import cKDTree
+
+    params = masif_opts['ppi_search']
+    normals = case.get('normals', case_normals)
+    v1 = case.vertices
+    region = cKDTree(v1).query(v1[case.get('centers', case_centers)[0]], k=min(case.n_patches, len(v1)))[1]
+    v2 = v1[region] + case.rng.normal(0, 0.3, (len(region), 3))
+    n2 = -normals[region]
+
+    # Only the patches at the interface are used
+    d, _ = cKDTree(v2).query(v1)
+    rows1 = np.where(d < params['sc_interaction_cutoff'] + 1)[0]
+    surf1 = kd_surface(v1, normals, rows1, params['sc_radius'], params['max_shape_size'])
+    surf2 = kd_surface(v2, n2, np.arange(len(v2)), params['sc_radius'], params['max_shape_size'])
+    return surf1, surf2
+
+
+### Stages. Each one prepares its input and times the computation in `with timer:`.
+### Returns the number of items processed (vertices, patches, ...).
+
+def bench_read_msms(case, timer):
+    from input_output.read_msms import read_msms
+
+    case.require_mesh()
+    root = str(case.tmp_dir.joinpath(case.name))
+    if not Path(root + '.vert').exists():
+        write_msms(root, case.vertices, case.faces, case.get('normals', case_normals), case.names)
+    with timer:
+        read_msms(root)
+    return len(case.vertices)
+
+
+def bench_computeCharges(case, timer):
+    from triangulation.computeCharges import computeCharges
+
+    if case.path is None:
+        raise Skip('needs a molecule')
+    with timer:
+        computeCharges(case.path, case.vertices, case.names)
+    return len(case.vertices)
+
+
+def bench_assignChargesToNewMesh(case, timer):
+    from triangulation.computeCharges import assignChargesToNewMesh
+
+    # The new mesh is close to the old one, as after regularization
+    new_vertices = case.vertices + case.rng.normal(0, 0.3, case.vertices.shape)
+    charges = case.rng.uniform(-1, 1, len(case.vertices))
+    with timer:
+        assignChargesToNewMesh(new_vertices, case.vertices, charges, masif_opts)
+    return len(case.vertices)
+
+
+def bench_compute_normal(case, timer):
+    from triangulation.compute_normal import compute_normal
+
+    case.require_mesh()
+    with timer:
+        compute_normal(case.vertices, case.faces)
+    return len(case.vertices)
+
+
+def bench_fix_mesh(case, timer):
+    import pymesh
+    from triangulation.fixmesh import fix_mesh
+
+    case.require_mesh()
+    mesh = pymesh.form_mesh(case.vertices, case.faces)
+    with timer:
+        fix_mesh(mesh, masif_opts['mesh_res'])
+    return len(case.vertices)
+
+
+def bench_geodesic_dijkstra(case, timer):
+    import networkx as nx
+    from geometry.compute_polar_coordinates import mesh_graph
+
+    case.require_mesh()
+    mesh = case.get('mesh', case_mesh)
+    centers = case.get('centers', case_centers)
+    with timer:
+        G = mesh_graph(mesh)
+        for c in centers:
+            nx.single_source_dijkstra_path_length(G, c, cutoff=case.radius)
+    return len(centers)
+
+
+def bench_geodesic_heat(case, timer):
+    from geometry.geodesic_heat import HeatGeodesics
+
+    case.require_mesh()
+    centers = case.get('centers', case_centers)
+    with timer:
+        HeatGeodesics(case.vertices, case.faces).distances_dict(centers, cutoff=case.radius)
+    return len(centers)
+
+
+def bench_mds(case, timer):
+    from geometry.compute_polar_coordinates import compute_theta_all_fast, faces_per_vertex
+
+    case.require_mesh()
+    centers = case.get('centers', case_centers)
+    d2, D = case.get('patches', case_patches)
+    idx = case.get('faces_per_vertex', lambda case: faces_per_vertex(case.faces))
+    with timer:
+        compute_theta_all_fast(D, case.vertices, case.faces, case.get('normals', case_normals), idx, case.radius,
+                               centers=centers)
+    return len(centers)
+
+
+def bench_compute_thetas(case, timer):
+    from geometry.compute_polar_coordinates import compute_thetas, faces_per_vertex
+
+    case.require_mesh()
+    planes = case.get('planes', case_planes)
+    normals = case.get('normals', case_normals)
+    idx = case.get('faces_per_vertex', lambda case: faces_per_vertex(case.faces))
+    with timer:
+        for c, neigh, plane in planes:
+            compute_thetas(plane, c, case.vertices, case.faces, normals, neigh, idx)
+    return len(planes)
+
+
+def bench_ddc(case, timer):
+    from masif_modules.read_data_from_surface import compute_ddc
+
+    case.require_mesh()
+    normals = case.get('normals', case_normals)
+    d2, D = case.get('patches', case_patches)
+    patches = []
+    for c in case.get('centers', case_centers):
+        neigh = np.array(list(d2[c].keys()), dtype=int)
+        patches.append((case.vertices[neigh], normals[neigh], np.where(neigh == c)[0][0], np.array(list(d2[c].values()))))
+    with timer:
+        for patch_v, patch_n, patch_cp, patch_rho in patches:
+            compute_ddc(patch_v, patch_n, patch_cp, patch_rho)
+    return len(patches)
+
+
+def bench_shape_complementarity(case, timer):
+    from masif_modules.read_data_from_surface import compute_shape_complementarity
+
+    case.require_mesh()
+    surf1, surf2 = case.get('sc_surfaces', case_sc_surfaces)
+    with timer:
+        compute_shape_complementarity(surf1, surf2, masif_opts['ppi_search'])
+    return len(surf2.vertices)
+
+
+STAGES = {'read_msms':bench_read_msms, 'computeCharges':bench_computeCharges,
+          'assignChargesToNewMesh':bench_assignChargesToNewMesh, 'compute_normal':bench_compute_normal,
+          'fix_mesh':bench_fix_mesh, 'geodesic_dijkstra':bench_geodesic_dijkstra, 'geodesic_heat':bench_geodesic_heat,
+          'mds':bench_mds, 'compute_thetas':bench_compute_thetas, 'ddc':bench_ddc,
+          'shape_complementarity':bench_shape_complementarity}
+
+
+def run_stage(func, case, repeat, trace_memory):
+    """
+    Run a stage repeat times, and once more with tracemalloc (which slows down the Python code)
+    for the peak memory. Returns the fastest time, the peak memory and the number of items.
+    """
+    times = []
+    try:
+        with redirect_stdout(io.StringIO()):
+            for i in range(repeat):
+                timer = Timer()
+                items = func(case, timer)
+                times.append(timer.wall)
+            peak_mb = None
+            if trace_memory:
+                timer = Timer(trace_memory=True)
+                func(case, timer)
+                peak_mb = timer.peak_mb
+    except Skip as e:
+        return {'skipped':str(e)}
+    except ImportError as e:
+        return {'skipped':f"missing {e.name}"}
+    return {'vertices':len(case.vertices), 'items':items, 'time':min(times), 'peak_mb':peak_mb}
+
+
+def scaling_exponent(sizes, values):
+    """
+    Exponent k of the fit values ~ sizes^k (log-log least squares).
+    """
+    if len(sizes) < 2:
+        return None
+    return float(np.polyfit(np.log(sizes), np.log(np.maximum(values, 1e-9)), 1)[0])
+
+
+def scaling(results, stages):
+    """
+    Returns {stage: {family: {'time':k, 'peak_mb':k}}} with the scaling exponents over the synthetic surfaces.
+    """
+    out = {}
+    for s in stages:
+        out[s] = {}
+        for family in ['icosphere', 'blob']:
+            runs = [r[s] for r in results.values() if r['family'] == family and 'time' in r.get(s, {})]
+            if len(runs) < 2:
+                continue
+            sizes = [r['vertices'] for r in runs]
+            out[s][family] = {'time':scaling_exponent(sizes, [r['time'] for r in runs])}
+            if all(r['peak_mb'] is not None for r in runs):
+                out[s][family]['peak_mb'] = scaling_exponent(sizes, [r['peak_mb'] for r in runs])
+    return out
+
+
+def calibrate(repeat=5):
+    """
+    Fastest time of a fixed workload (a pure Python loop and a dense eigendecomposition, as the stages
+    mix both), which measures the speed of the machine the benchmark runs on.
+    """
+    a = np.random.RandomState(0).random_sample((300, 300))
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        total = 0.0
+        for k in range(300000):
+            total += k * 0.5
+        np.linalg.eigh(a @ a.T)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def compare(results, baselines, tolerance, memory_tolerance, min_time=0.01, min_mb=1.0, speed=1.0):
+    """
+    Compare the results with the baselines. Returns {(case, stage): (time ratio, memory ratio)}
+    and the list of regressions: slower (or more memory) than the baseline by more than the tolerance.
+    Stages faster than min_time seconds, or using less than min_mb MB, are not checked.
+        speed: calibration time of this run over that of the baselines; the time ratios are divided by it.
+    """
+    ratios = {}
+    regressions = []
+    for case, stages in results.items():
+        for s, r in stages.items():
+            b = baselines.get(case, {}).get(s, {})
+            if 'time' not in r or 'time' not in b:
+                continue
+            time_ratio = r['time'] / max(b['time'], 1e-9) / speed
+            mem_ratio = None
+            if r['peak_mb'] is not None and b.get('peak_mb') is not None:
+                mem_ratio = r['peak_mb'] / max(b['peak_mb'], 1e-3)
+            ratios[(case, s)] = (time_ratio, mem_ratio)
+            if time_ratio > tolerance and r['time'] > min_time:
+                regressions.append(f"{case}/{s}: time {r['time']:.3f}s, baseline {b['time']:.3f}s ({time_ratio:.2f}x)")
+            if mem_ratio is not None and mem_ratio > memory_tolerance and r['peak_mb'] > min_mb:
+                regressions.append(f"{case}/{s}: peak memory {r['peak_mb']:.1f} MB, baseline {b['peak_mb']:.1f} MB ({mem_ratio:.2f}x)")
+    return ratios, regressions
+
+
+def print_results(results, stages, ratios):
+    print(f"{'stage':<24s} {'case':<20s} {'vertices':>9s} {'items':>7s} {'time [s]':>9s} {'peak [MB]':>10s} "
+          f"{'vs baseline':>12s}")
+    for s in stages:
+        for case, r in results.items():
+            if s not in r:
+                continue
+            r = r[s]
+            if 'skipped' in r:
+                print(f"{s:<24s} {case:<20s} skipped: {r['skipped']}")
+                continue
+            peak = '' if r['peak_mb'] is None else f"{r['peak_mb']:.1f}"
+            ratio = ratios.get((case, s))
+            ratio = '' if ratio is None else f"{ratio[0]:.2f}x"
+            print(f"{s:<24s} {case:<20s} {r['vertices']:9d} {r['items']:7d} {r['time']:9.3f} {peak:>10s} {ratio:>12s}")
+
+
+def print_scaling(exponents):
+    print(f"\nScaling with the number of vertices (time ~ n^k, peak memory ~ n^k)")
+    print(f"{'stage':<24s} {'icosphere time':>15s} {'memory':>7s} {'blob time':>10s} {'memory':>7s}")
+    for s, families in exponents.items():
+        line = f"{s:<24s}"
+        for family, width in [('icosphere', 15), ('blob', 10)]:
+            k = families.get(family, {})
+            line += f" {'' if k.get('time') is None else format(k['time'], '.2f'):>{width}s}"
+            line += f" {'' if k.get('peak_mb') is None else format(k['peak_mb'], '.2f'):>7s}"
+        print(line)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Time and memory of each stage of the surface pipeline, and their scaling')
+    parser.add_argument('--sizes', type=int, nargs='*', default=DEFAULT_SIZES, help='Number of vertices of the synthetic surfaces')
+    parser.add_argument('--families', nargs='*', default=['icosphere', 'blob'], choices=['icosphere', 'blob'], help='Synthetic surfaces')
+    parser.add_argument('--molecules', nargs='*', default=DEFAULT_MOLECULES, help='Molecules in data/')
+    parser.add_argument('--stages', nargs='*', default=list(STAGES), choices=list(STAGES), help='Stages to run')
+    parser.add_argument('--n_patches', type=int, default=200, help='Number of patches for the stages that work on patches')
+    parser.add_argument('--radius', type=float, default=9.0, help='Geodesic patch radius')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each stage; the fastest is reported')
+    parser.add_argument('--no_memory', action='store_true', help='Do not measure the peak memory of each stage')
+    parser.add_argument('--baselines', type=Path, default=DEFAULT_BASELINES, help='JSON file with the baselines')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='Report a stage slower than the baseline by more than this factor '
+                        '(after the calibration)')
+    parser.add_argument('--memory_tolerance', type=float, default=1.5, help='Report a stage that uses more memory than the baseline by more than this factor')
+    parser.add_argument('--fail_on_regression', action='store_true', help='Exit with an error if a stage regressed')
+    parser.add_argument('--update_baselines', action='store_true', help='Write the results to the baselines file')
+    parser.add_argument('-o', '--output', type=Path, default=None, help='Write the results and scaling exponents to this JSON file')
+    return parser.parse_args()
+
+
+def main(args):
+    tmp_dir = Path(tempfile.mkdtemp(prefix='masif_bench_'))
+    cases = [(family, size) for family in args.families for size in args.sizes] + [('molecule', m) for m in args.molecules]
+
+    calibration = calibrate()
+    results = {}
+    for family, size in cases:
+        try:
+            if family == 'molecule':
+                case = molecule_case(size, args, tmp_dir)
+            else:
+                case = synthetic_case(family, size, args, tmp_dir)
+        except ImportError as e:
+            name = Path(size).stem if family == 'molecule' else f"{family}_{size}"
+            results[name] = {'family':family, **{s: {'skipped':f"missing {e.name}"} for s in args.stages}}
+            continue
+        if case.name in results:
+            continue
+        print(f"{case.name}: {len(case.vertices)} vertices", file=sys.stderr)
+        results[case.name] = {'family':family}
+        for s in args.stages:
+            results[case.name][s] = run_stage(STAGES[s], case, args.repeat, not args.no_memory)
+
+    baselines = {}
+    speed = 1.0
+    if args.baselines.exists():
+        with open(args.baselines, 'r') as f:
+            stored = json.load(f)
+        baselines = stored['results']
+        if 'calibration' in stored:
+            speed = calibration / stored['calibration']
+        else:
+            print(f"Warning: {args.baselines} has no calibration, the times are compared as measured")
+    stage_results = {case: {s: r[s] for s in args.stages} for case, r in results.items()}
+    ratios, regressions = compare(stage_results, baselines, args.tolerance, args.memory_tolerance, speed=speed)
+    exponents = scaling(results, args.stages)
+
+    print_results(stage_results, args.stages, ratios)
+    print_scaling(exponents)
+    print(f"\nPeak RSS {peak_rss_mb():.0f} MB, calibration {calibration:.3f}s ({speed:.2f}x the baselines)")
+
+    machine = {'platform':platform.platform(), 'python':platform.python_version(), 'numpy':np.__version__}
+    if args.output is not None:
+        with open(args.output, 'w') as o:
+            json.dump({'machine':machine, 'calibration':calibration, 'results':stage_results, 'scaling':exponents}, o, indent=1)
+    if args.update_baselines:
+        # Keep the baselines of the cases and stages that were not run (or skipped)
+        for case, stages in stage_results.items():
+            baselines.setdefault(case, {}).update({s: {k: round(v, 4) if isinstance(v, float) else v for k, v in r.items()}
+                                                   for s, r in stages.items() if 'time' in r})
+        with open(args.baselines, 'w') as o:
+            json.dump({'machine':machine, 'calibration':round(calibration, 4), 'results':baselines}, o, indent=1)
+        print(f"Baselines written to {args.baselines}")
+        return 0
+
+    for r in regressions:
+        print(f"{'FAIL' if args.fail_on_regression else 'Warning'}: {r}")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_arguments()))
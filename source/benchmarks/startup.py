@@ -0,0 +1,89 @@
+#!/usr/bin/python
+"""
+startup.py: Measure the startup time of the MaSIF command line scripts, and the import cost of each module
+(from python -X importtime), to catch regressions in the time needed to start short-lived jobs.
+Released under an Apache License 2.0
+"""
+import argparse
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SOURCE_DIR = Path(__file__).resolve().parent.parent
+
+# Packages that should not be loaded just to parse the command line.
+HEAVY_MODULES = ['Bio', 'pymesh', 'sklearn', 'scipy', 'networkx', 'IPython', 'tensorflow']
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Startup time and per-module import cost of a MaSIF script')
+    parser.add_argument('--script', default='main.py', help='Script to run, relative to source/')
+    parser.add_argument('--script_args', nargs='*', default=['--help'], help='Arguments passed to the script')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs; the fastest is reported')
+    parser.add_argument('--top', type=int, default=20, help='Number of modules shown in the table')
+    parser.add_argument('--max_ms', type=float, default=None, help='Fail if the startup takes longer than this')
+    parser.add_argument('--forbid', nargs='*', default=HEAVY_MODULES, help='Fail if any of these packages is imported')
+    return parser.parse_args()
+
+
+def run_importtime(script, script_args):
+    """
+    Run the script with -X importtime. Returns the wall time and the stderr output.
+    """
+    cmd = [sys.executable, '-X', 'importtime', script] + script_args
+    start = time.perf_counter()
+    p = subprocess.run(cmd, cwd=str(SOURCE_DIR), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return time.perf_counter() - start, p.stderr
+
+
+def parse_importtime(stderr):
+    """
+    Parse the lines 'import time: self [us] | cumulative | imported package' of -X importtime.
+    Returns a list of (module, self_us, cumulative_us, depth).
+    """
+    records = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        records.append((name.strip(), int(fields[0]), int(fields[1]), depth))
+    return records
+
+
+def print_table(records, top):
+    print(f"{'module':<50s} {'self [ms]':>10s} {'cumulative [ms]':>16s}")
+    for name, self_us, cum_us, depth in sorted(records, key=lambda r: -r[2])[:top]:
+        print(f"{'  '*depth + name:<50s} {self_us/1000:10.1f} {cum_us/1000:16.1f}")
+
+
+def main(args):
+    wall = []
+    for i in range(args.repeat):
+        t, stderr = run_importtime(args.script, args.script_args)
+        wall.append(t)
+    records = parse_importtime(stderr)
+
+    print_table(records, args.top)
+    total = sum(r[2] for r in records if r[3] == 0)
+    print(f"\n{args.script} {' '.join(args.script_args)}: startup {min(wall)*1000:.0f} ms (fastest of {args.repeat}), "
+          f"imports {total/1000:.0f} ms, {len(records)} modules")
+
+    failed = False
+    imported = {r[0].split('.')[0] for r in records}
+    for m in args.forbid:
+        if m in imported:
+            print(f"FAIL: {m} is imported at startup")
+            failed = True
+    if args.max_ms is not None and min(wall)*1000 > args.max_ms:
+        print(f"FAIL: startup takes longer than {args.max_ms:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_arguments()))
@@ -0,0 +1,127 @@
+"""
+synthetic.py: Surfaces of controlled size for the benchmarks, which need no external programs:
+icospheres, random blobs, and dot surfaces of molecules (for when MSMS is not installed).
+The meshes are scaled so that the mean edge length is close to the MaSIF mesh resolution (1 A),
+so that the patches have the same number of vertices as on protein surfaces.
+Released under an Apache License 2.0
+"""
+import numpy as np
+from scipy.spatial import ConvexHull, cKDTree
+
+
+def icosphere(subdivisions):
+    """
+    Unit icosphere with 10*4**subdivisions + 2 vertices. Returns the vertices and the faces,
+    oriented outwards.
+    """
+    t = (1 + 5**0.5) / 2
+    vertices = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0],
+                         [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t],
+                         [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype=float)
+    faces = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+                      [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+                      [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+                      [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]])
+    vertices /= np.linalg.norm(vertices, axis=1, keepdims=True)
+
+    for _ in range(subdivisions):
+        # One new vertex in the middle of each edge
+        edges = np.sort(np.concatenate([faces[:,[0,1]], faces[:,[1,2]], faces[:,[2,0]]]), axis=1)
+        unique_edges, inverse = np.unique(edges, axis=0, return_inverse=True)
+        middle = vertices[unique_edges].mean(axis=1)
+        middle /= np.linalg.norm(middle, axis=1, keepdims=True)
+        ab, bc, ca = inverse.reshape(3, -1) + len(vertices)
+        a, b, c = faces.T
+        faces = np.concatenate([np.stack([a, ab, ca], axis=1), np.stack([ab, b, bc], axis=1),
+                                np.stack([ca, bc, c], axis=1), np.stack([ab, bc, ca], axis=1)])
+        vertices = np.concatenate([vertices, middle])
+    return vertices, faces
+
+
+def sphere_points(n, seed=None):
+    """
+    n points spread evenly on the unit sphere (Fibonacci lattice), optionally jittered.
+    """
+    i = np.arange(n) + 0.5
+    if seed is not None:
+        i = i + np.random.default_rng(seed).uniform(-0.3, 0.3, n)
+    phi = np.arccos(np.clip(1 - 2*i/n, -1, 1))
+    theta = np.pi * (1 + 5**0.5) * i
+    return np.stack([np.cos(theta)*np.sin(phi), np.sin(theta)*np.sin(phi), np.cos(phi)], axis=1)
+
+
+def orient_outwards(vertices, faces):
+    centers = vertices[faces].mean(axis=1) - vertices.mean(axis=0)
+    normals = np.cross(vertices[faces[:,1]] - vertices[faces[:,0]], vertices[faces[:,2]] - vertices[faces[:,0]])
+    flip = (normals * centers).sum(axis=1) < 0
+    faces[flip] = faces[flip][:,::-1]
+    return faces
+
+
+def scale_to_edge_length(vertices, faces, edge_length):
+    edges = vertices[faces] - vertices[np.roll(faces, 1, axis=1)]
+    return vertices * edge_length / np.linalg.norm(edges, axis=2).mean()
+
+
+def icosphere_mesh(n_vertices, edge_length=1.0):
+    """
+    Icosphere with the number of vertices closest to n_vertices (642, 2562, 10242, 40962, ...).
+    """
+    subdivisions = int(np.argmin([abs(10 * 4**k + 2 - n_vertices) for k in range(10)]))
+    vertices, faces = icosphere(subdivisions)
+    return scale_to_edge_length(vertices, faces, edge_length), faces
+
+
+def blob_mesh(n_vertices, edge_length=1.0, n_bumps=12, amplitude=0.3, width=0.4, seed=0):
+    """
+    Random blob with n_vertices vertices: points on the sphere, triangulated, and moved
+    radially by a sum of Gaussian bumps and dents. The surface stays star shaped, so the
+    triangulation of the sphere is a valid triangulation of the blob.
+    """
+    rng = np.random.default_rng(seed)
+    directions = sphere_points(n_vertices, seed=seed)
+    faces = orient_outwards(directions, ConvexHull(directions).simplices)
+
+    bumps = sphere_points(n_bumps, seed=seed + 1)
+    signs = rng.choice([-1, 1], n_bumps) * rng.uniform(0.5, 1, n_bumps)
+    r = 1 + amplitude * (signs * np.exp(-(1 - directions @ bumps.T) / width**2)).sum(axis=1)
+    vertices = directions * np.clip(r, 0.5, None)[:,None]
+    return scale_to_edge_length(vertices, faces, edge_length), faces
+
+
+def dot_surface(coords, radii, full_ids, density=2.0, k=16):
+    """
+    Dot surface of a molecule: points on the sphere of each atom that are not inside any
+    other atom, with density points per A^2. Used in place of the MSMS vertices when MSMS
+    is not installed. Returns the vertices, their normals and their names (see computeMSMS).
+    """
+    coords = np.asarray(coords, dtype=float)
+    radii = np.asarray(radii, dtype=float)
+    n_dots = int(np.ceil(4 * np.pi * radii.max()**2 * density))
+    unit = sphere_points(n_dots)
+
+    atom = np.repeat(np.arange(len(coords)), n_dots)
+    normals = np.tile(unit, (len(coords), 1))
+    vertices = coords[atom] + radii[atom,None] * normals
+
+    # Remove the dots inside one of the k nearest atoms
+    dist, nearest = cKDTree(coords).query(vertices, k=min(k, len(coords)))
+    buried = ((dist < radii[nearest] - 1e-6) & (nearest != atom[:,None])).any(axis=1)
+    keep = np.where(~buried)[0]
+    return vertices[keep], normals[keep], [full_ids[i] for i in atom[keep]]
+
+
+def write_msms(file_root, vertices, faces, normals, names):
+    """
+    Write a surface as the {file_root}.vert and {file_root}.face files of MSMS (see read_msms).
+    """
+    with open(file_root + ".vert", "w") as o:
+        o.write("# MSMS solvent excluded surface vertices\n#vertex #sphere density probe_r\n")
+        o.write(f"{len(vertices):7d}    0  1.00  1.50\n")
+        for (x, y, z), (nx, ny, nz), name in zip(vertices, normals, names):
+            o.write(f"{x:9.3f} {y:9.3f} {z:9.3f} {nx:9.3f} {ny:9.3f} {nz:9.3f} 0 1 1 {name}\n")
+    with open(file_root + ".face", "w") as o:
+        o.write("# MSMS solvent excluded surface faces\n#faces  #sphere density probe_r\n")
+        o.write(f"{len(faces):7d}    0  1.00  1.50\n")
+        for a, b, c in faces + 1:
+            o.write(f"{a:6d} {b:6d} {c:6d}  1  1\n")
@@ -62,20 +62,15 @@ for ppi_pair_id in ppi_pair_list:
         pids = ['p1', 'p2']
         
     # Compute shape complementarity between the two proteins. 
-    rho = {}
-    neigh_indices = {}
-    mask = {}
-    input_feat = {}
-    theta = {}
-    iface_labels = {}
-    verts = {}
+    surf = {}
 
     for pid in pids:
-        input_feat[pid], rho[pid], theta[pid], mask[pid], neigh_indices[pid], iface_labels[pid], verts[pid] = read_data_from_surface(ply_file[pid], params)
+        geodesics_path = my_precomp_dir+pid+'_geodesics.npz' if masif_opts['save_geodesics'] else None
+        surf[pid] = read_data_from_surface(ply_file[pid], params, geodesics_path=geodesics_path)
 
     if len(pids) > 1 and masif_app == 'masif_ppi_search':
         start_time = time.time()
-        p1_sc_labels, p2_sc_labels = compute_shape_complementarity(ply_file['p1'], ply_file['p2'], neigh_indices['p1'],neigh_indices['p2'], rho['p1'], rho['p2'], mask['p1'], mask['p2'], params)
+        p1_sc_labels, p2_sc_labels = compute_shape_complementarity(surf['p1'], surf['p2'], params)
         np.save(my_precomp_dir+'p1_sc_labels', p1_sc_labels)
         np.save(my_precomp_dir+'p2_sc_labels', p2_sc_labels)
         end_time = time.time()
@@ -83,13 +78,4 @@ for ppi_pair_id in ppi_pair_list:
 
     # Save data only if everything went well. 
     for pid in pids: 
-        np.save(my_precomp_dir+pid+'_rho_wrt_center', rho[pid])
-        np.save(my_precomp_dir+pid+'_theta_wrt_center', theta[pid])
-        np.save(my_precomp_dir+pid+'_input_feat', input_feat[pid])
-        np.save(my_precomp_dir+pid+'_mask', mask[pid])
-        np.save(my_precomp_dir+pid+'_list_indices', neigh_indices[pid])
-        np.save(my_precomp_dir+pid+'_iface_labels', iface_labels[pid])
-        # Save x, y, z
-        np.save(my_precomp_dir+pid+'_X.npy', verts[pid][:,0])
-        np.save(my_precomp_dir+pid+'_Y.npy', verts[pid][:,1])
-        np.save(my_precomp_dir+pid+'_Z.npy', verts[pid][:,2])
+        surf[pid].save(my_precomp_dir+pid)
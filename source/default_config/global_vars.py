@@ -2,39 +2,47 @@
 # Pablo Gainza - LPDI STI EPFL 2018-2019
 # Released under an Apache License 2.0
 
-import os 
-from IPython.core.debugger import set_trace
+import os
+import shutil
 epsilon = 1.0e-6
 
-msms_bin= ""
-if 'MSMS_BIN' in os.environ:
-   msms_bin = os.environ['MSMS_BIN']
-else:
-  set_trace()
-  print("ERROR: MSMS_BIN not set. Variable should point to MSMS program.")
-  sys.exit(1)
-
-pdb2pqr_bin=""
-if 'PDB2PQR_BIN' in os.environ:
-   pdb2pqr_bin = os.environ['PDB2PQR_BIN']
-else:
-  print("ERROR: PDB2PQR_BIN not set. Variable should point to PDB2PQR_BIN program.")
-  sys.exit(1)
-
-apbs_bin=""
-if 'APBS_BIN' in os.environ:
-   apbs_bin = os.environ['APBS_BIN']
-else:
-  print("ERROR: APBS_BIN not set. Variable should point to APBS program.")
-  sys.exit(1)
-  
-multivalue_bin=""
-if 'MULTIVALUE_BIN' in os.environ:
-   multivalue_bin = os.environ['MULTIVALUE_BIN']
-else:
-  print("ERROR: MULTIVALUE_BIN not set. Variable should point to MULTIVALUE program.")
-  sys.exit(1)
-
 
 class NoSolutionError(Exception):
     pass
+
+
+class MissingProgramError(Exception):
+    pass
+
+
+# Module attribute -> (environment variable, executable name looked up in PATH)
+PROGRAMS = {
+    'msms_bin': ('MSMS_BIN', 'msms'),
+    'pdb2pqr_bin': ('PDB2PQR_BIN', 'pdb2pqr'),
+    'apbs_bin': ('APBS_BIN', 'apbs'),
+    'multivalue_bin': ('MULTIVALUE_BIN', 'multivalue'),
+}
+
+
+def find_program(name):
+    """
+    Path to an external program: the environment variable if set, otherwise the executable in PATH.
+    Raises MissingProgramError if neither is found.
+    """
+    env, exe = PROGRAMS[name]
+    if env in os.environ:
+        return os.environ[env]
+    path = shutil.which(exe)
+    if path is None:
+        raise MissingProgramError(f"{env} not set. Variable should point to the {exe} program.")
+    return path
+
+
+def __getattr__(name):
+    # The programs are only looked up when they are first used (e.g. global_vars.msms_bin),
+    # so that importing MaSIF does not require every external program to be installed.
+    if name in PROGRAMS:
+        path = find_program(name)
+        globals()[name] = path
+        return path
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -18,6 +18,9 @@ masif_opts["feature_interpolation"] = True
 
 # Coords params
 masif_opts["radius"] = 12.0
+# Save the geodesic distances of each protein with its precomputed patches (tens of MB per protein), so
+# that a later precomputation of the same surface reuses them.
+masif_opts["save_geodesics"] = False
 
 # Neural network patch application specific parameters.
 masif_opts["ppi_search"] = {}
@@ -72,6 +75,14 @@ masif_opts["ligand"]["train_fract"] = 0.9 * 0.8
 masif_opts["ligand"]["val_fract"] = 0.1 * 0.8
 masif_opts["ligand"]["test_fract"] = 0.2
 masif_opts["ligand"]["tfrecords_dir"] = "data_preparation/tfrecords"
+# Format of the records: "raw" (arrays as bytes, see read_ligand_tfrecords.raw_example) or "features"
+masif_opts["ligand"]["tfrecord_format"] = "raw"
+masif_opts["ligand"]["tfrecord_float_dtype"] = "float32"  # or "float16"
+# Each split is written to tfrecord_shards files, compressed with "GZIP" or "ZLIB" if set, by
+# tfrecord_workers processes (None: one per CPU)
+masif_opts["ligand"]["tfrecord_shards"] = 8
+masif_opts["ligand"]["tfrecord_compression"] = ""
+masif_opts["ligand"]["tfrecord_workers"] = None
 masif_opts["ligand"]["max_distance"] = 12.0
 masif_opts["ligand"]["n_classes"] = 7
 masif_opts["ligand"]["feat_mask"] = [1.0, 1.0, 1.0, 1.0, 1.0]
@@ -13,76 +13,82 @@ import scipy.linalg
 from IPython.core.debugger import set_trace
 from  numpy.linalg import norm
 import time
-from scipy.sparse import csr_matrix, coo_matrix
-import pymesh
+from scipy.spatial import cKDTree
 
-def compute_polar_coordinates(mesh, do_fast=True, radius=12, max_vertices=200):
+from geometry.geodesic_heat import HeatGeodesics, symmetrize
+from geometry.geodesic_matrix import dict_to_csr, compact, computed_rows, row, submatrix, restrict, stored_geodesics, \
+    keep_geodesics
+from profiling import stage
+
+def compute_polar_coordinates(mesh, do_fast=True, radius=12, max_vertices=200, centers=None, geodesic='dijkstra',
+                              cache=None):
     """
     compute_polar_coordinates: compute the polar coordinates for every patch in the mesh. 
+        centers: if given, only compute the patches centered at these vertex indices
+            (see compute_patch_coordinates); outputs then have one row per center.
+        geodesic: 'dijkstra' (shortest paths along mesh edges) or 'heat' (heat method, see geodesic_heat.py)
+        cache: see compute_patch_coordinates. If cache['geodesics'] is a stored geodesic distance matrix
+            (D, radius, method) of this mesh with all rows computed up to this radius or more, it is used
+            instead of computing the distances.
     Returns: 
         rho: radial coordinates for each patch. padded to zero.
         theta: angle values for each patch. padded to zero. 
         neigh_indices: indices of members of each patch. 
         mask: the mask for rho and theta
     """
+    if centers is not None:
+        return compute_patch_coordinates(mesh, centers, do_fast=do_fast, radius=radius, max_vertices=max_vertices,
+                                         geodesic=geodesic, cache=cache)
 
     # Vertices, faces and normals
     vertices = mesh.vertices
     faces = mesh.faces
-    norm1 = mesh.get_attribute('vertex_nx')
-    norm2 = mesh.get_attribute('vertex_ny')
-    norm3 = mesh.get_attribute('vertex_nz')
-    normals = np.vstack([norm1, norm2, norm3]).T
-
-    # Graph 
-    G=nx.Graph()
-    n = len(mesh.vertices)
-    G.add_nodes_from(np.arange(n))
-
-    # Get edges
-    f = np.array(mesh.faces, dtype = int)
-    rowi = np.concatenate([f[:,0], f[:,0], f[:,1], f[:,1], f[:,2], f[:,2]], axis = 0)
-    rowj = np.concatenate([f[:,1], f[:,2], f[:,0], f[:,2], f[:,0], f[:,1]], axis = 0)
-    edges = np.stack([rowi, rowj]).T
-    verts = mesh.vertices
+    normals = mesh_normals(mesh)
 
-    # Get weights 
-    edgew = verts[rowi] - verts[rowj]
-    edgew = scipy.linalg.norm(edgew, axis=1)
-    wedges = np.stack([rowi, rowj, edgew]).T
+    cache = {} if cache is None else cache
+    n = len(vertices)
 
-    G.add_weighted_edges_from(wedges)
-    start = time.clock()
-    if do_fast:
-        dists = nx.all_pairs_dijkstra_path_length(G, cutoff=radius)
+    # Graph 
+    start = time.perf_counter()
+    cutoff = radius if do_fast else radius*2
+    stored = stored_geodesics(cache, vertices, faces, geodesic)
+    if stored is not None and stored[1] >= cutoff and computed_rows(stored[0]).all():
+        D = restrict(stored[0], cutoff)
     else:
-        dists = nx.all_pairs_dijkstra_path_length(G, cutoff=radius*2)
-    d2 = {}
-    for key_tuple in dists:
-        d2[key_tuple[0]] = key_tuple[1]
-    end = time.clock()
-    print('Dijkstra took {:.2f}s'.format((end-start)))
-    D = dict_to_sparse(d2)
+        # Computed up to the radius of a stored matrix, if larger, so that it can replace it
+        full_radius = cutoff if stored is None else max(cutoff, stored[1])
+        with stage('geodesic', method=geodesic, mesh_vertices=n):
+            if geodesic == 'heat':
+                d2 = HeatGeodesics(vertices, faces).distances_dict(np.arange(n), cutoff=full_radius)
+            else:
+                G = mesh_graph(mesh)
+                dists = nx.all_pairs_dijkstra_path_length(G, cutoff=full_radius)
+                d2 = {}
+                for key_tuple in dists:
+                    d2[key_tuple[0]] = key_tuple[1]
+            # Diagonal elements are set to a very small value greater than zero.
+            D = dict_to_csr(d2, n)
+            del d2
+        keep_geodesics(cache, D, full_radius, geodesic, vertices, faces)
+        D = restrict(D, cutoff)
+    end = time.perf_counter()
+    print('Geodesic distances ({}) took {:.2f}s'.format(geodesic, (end-start)))
+    # The members of each patch are selected from its own distances, before the heat method distances are symmetrized.
+    D_members = D
+    if geodesic == 'heat':
+        D = compact(symmetrize(D))
 
     # Compute the faces per vertex.
-    idx = {}
-    for ix, face in enumerate(mesh.faces):
-        for i in range(3):
-            if face[i] not in idx:
-                idx[face[i]] = []
-            idx[face[i]].append(ix)
+    idx = faces_per_vertex(mesh.faces)
 
-
-    i = np.arange(D.shape[0])
-    # Set diagonal elements to a very small value greater than zero..
-    D[i,i] = 1e-8
     # Call MDS for all points.
-    mds_start_t = time.clock()
+    mds_start_t = time.perf_counter()
 
-    if do_fast:
-        theta = compute_theta_all_fast(D, vertices, faces, normals, idx, radius)
-    else:
-        theta = compute_theta_all(D, vertices, faces, normals, idx, radius)
+    with stage('mds', patches=D.shape[0]):
+        if do_fast:
+            theta = compute_theta_all_fast(D, vertices, faces, normals, idx, radius)
+        else:
+            theta = compute_theta_all(D, vertices, faces, normals, idx, radius)
 
     
     # Output a few patches for debugging purposes.
@@ -96,10 +102,178 @@ def compute_polar_coordinates(mesh, do_fast=True, radius=12, max_vertices=200):
     #    output_patch_coords(subv, subf, subn, i, neigh_i, theta[i], D[i, :])
     
 
-    mds_end_t = time.clock()
+    mds_end_t = time.perf_counter()
     print('MDS took {:.2f}s'.format((mds_end_t-mds_start_t)))
     
-    n = len(d2)
+    rho_out, theta_out, neigh_indices, mask_out = assemble_patches(D, theta, range(n), max_vertices, order_by=D_members)
+
+    return rho_out, theta_out, neigh_indices, mask_out
+
+def compute_patch_coordinates(mesh, centers, do_fast=True, radius=12, max_vertices=200, geodesic='dijkstra', cache=None):
+    """
+    compute_patch_coordinates: compute the polar coordinates only for the patches centered
+    at the vertices in centers. Geodesic distances are computed only from the members of
+    these patches, so the cost grows with the number of patches rather than with the mesh size.
+        cache: dictionary where the mesh graph (or heat method solver) and the faces of each
+            vertex are kept between calls on the same mesh, e.g. when the patches are computed in chunks.
+            If it has the key 'geodesics', the geodesic distance matrix (D, radius, method) is kept there too,
+            and the rows of a stored matrix of this mesh (see geodesic_matrix.py) are reused instead of
+            recomputed. New rows are computed up to the stored radius, if larger, and merged into the stored
+            matrix, which is only replaced when rows were added.
+    Returns rho, theta, neigh_indices and mask as compute_polar_coordinates, with one row per center.
+    """
+    cache = {} if cache is None else cache
+    vertices = mesh.vertices
+    faces = mesh.faces
+    normals = mesh_normals(mesh)
+    if 'faces_per_vertex' not in cache:
+        cache['faces_per_vertex'] = faces_per_vertex(faces)
+    idx = cache['faces_per_vertex']
+    centers = np.asarray(centers, dtype=int)
+    n = len(vertices)
+
+    cutoff = radius if do_fast else radius*2
+    # Rows that are already computed, up to full_radius
+    stored = stored_geodesics(cache, vertices, faces, geodesic)
+    D_full, full_radius = (None, cutoff) if stored is None or stored[1] < cutoff else stored
+    with stage('geodesic', method=geodesic, mesh_vertices=n) as info:
+        if geodesic == 'heat':
+            if 'heat' not in cache:
+                cache['heat'] = HeatGeodesics(vertices, faces)
+            solver = cache['heat']
+            single_source = lambda sources: solver.distances_dict(sources, cutoff=full_radius)
+        else:
+            if 'graph' not in cache:
+                cache['graph'] = mesh_graph(mesh)
+            G = cache['graph']
+            single_source = lambda sources: {v: nx.single_source_dijkstra_path_length(G, v, cutoff=full_radius) for v in sources}
+
+        have = np.zeros(n, dtype=bool) if D_full is None else computed_rows(D_full)
+
+        # The patch members of each center ...
+        new = dict_to_csr(single_source(np.unique(centers[~have[centers]])), n)
+        D_full = new if D_full is None else compact(D_full + new)
+        D = restrict(D_full, cutoff)
+        # ... and the distances between all members of each patch.
+        members = np.unique(np.concatenate([c[d <= radius] for c, d in (row(D, c) for c in centers)] + [centers]))
+        missing = members[~computed_rows(D_full)[members]]
+        if len(missing) > 0:
+            D_full = compact(D_full + dict_to_csr(single_source(missing), n))
+            D = restrict(D_full, cutoff)
+        info['sources'] = int(computed_rows(D_full).sum() - have.sum())
+
+    # The stored matrix keeps the distances of each row as computed, so that rows without entries are the
+    # ones not computed yet.
+    if info['sources'] > 0:
+        keep_geodesics(cache, D_full, full_radius, geodesic, vertices, faces)
+    # The members of each patch are selected from its own distances, before the heat method distances are symmetrized.
+    D_members = D
+    if geodesic == 'heat':
+        D = compact(symmetrize(D))
+
+    with stage('mds', patches=len(centers)):
+        if do_fast:
+            theta = compute_theta_all_fast(D, vertices, faces, normals, idx, radius, centers=centers)
+        else:
+            theta = compute_theta_all(D, vertices, faces, normals, idx, radius, centers=centers)
+
+    return assemble_patches(D, theta, centers, max_vertices, order_by=D_members)
+
+
+def update_polar_coordinates(mesh, old_mesh, rho, theta, neigh_indices, mask, do_fast=True,
+                             radius=12, max_vertices=200, tol=1e-3, geodesic='dijkstra'):
+    """
+    update_polar_coordinates: update the patch decomposition of old_mesh for a new mesh
+    (e.g. the next frame of a trajectory, or a side-chain repack), where only part of the surface moved.
+    New vertices are matched to old vertices with a KD-tree; a vertex changed if it has no
+    old vertex within tol, or if its mesh neighbors changed. Patches with a changed vertex within
+    radius of their center are recomputed; all others are copied with their indices remapped.
+    Returns:
+        rho, theta, neigh_indices, mask: as compute_polar_coordinates, for the new mesh.
+        recomputed: the indices of the recomputed patches.
+        old_of_new: the matching vertex in old_mesh of each vertex (-1 if none);
+            patches that were not recomputed are copies of the patch of this vertex.
+    """
+    new_v = mesh.vertices
+    old_v = old_mesh.vertices
+    n = len(new_v)
+
+    # Vertex correspondence between the new and the old mesh (one to one).
+    dists, old_of_new = cKDTree(old_v).query(new_v)
+    matched = dists <= tol
+    counts = np.bincount(old_of_new[matched], minlength=len(old_v))
+    matched[counts[old_of_new] > 1] = False
+    old_of_new[~matched] = -1
+    new_of_old = -np.ones(len(old_v), dtype=int)
+    new_of_old[old_of_new[matched]] = np.where(matched)[0]
+
+    # Matched vertices whose neighbors in the mesh changed.
+    new_edges = mesh_edges(mesh.faces)
+    old_edges = mesh_edges(old_mesh.faces)
+    new_edges_in_old = old_of_new[new_edges]
+    valid = (new_edges_in_old >= 0).all(axis=1)
+    old_edge_set = set(map(tuple, old_edges))
+    changed_edges = [tuple(e) not in old_edge_set for e in new_edges_in_old[valid]]
+    changed_edges = new_edges[valid][np.array(changed_edges, dtype=bool)]
+    new_edge_set = set(map(tuple, new_edges))
+    removed_edges = [tuple(e) not in new_edge_set for e in new_of_old[old_edges]]
+    removed_edges = old_edges[np.array(removed_edges, dtype=bool)]
+
+    # Positions of all changes: new and removed vertices, and both ends of changed edges.
+    changed = np.concatenate([new_v[~matched], new_v[changed_edges.ravel()],
+                              old_v[new_of_old < 0], old_v[removed_edges.ravel()]], axis=0)
+
+    # Geodesic distances are at least as large as euclidean ones, so this finds every
+    # center that has a changed vertex within a radius-neighborhood.
+    dirty = np.zeros(n, dtype=bool)
+    dirty[~matched] = True
+    if len(changed) > 0:
+        near = cKDTree(new_v).query_ball_point(changed, radius)
+        for nn in near:
+            dirty[nn] = True
+
+    rho_out = np.zeros((n, max_vertices))
+    theta_out = np.zeros((n, max_vertices))
+    mask_out = np.zeros((n, max_vertices))
+    neigh_out = [None] * n
+
+    # Reuse the patches that did not change.
+    for i in np.where(~dirty)[0]:
+        o = old_of_new[i]
+        neigh = new_of_old[np.asarray(neigh_indices[o], dtype=int)]
+        if (neigh < 0).any():
+            dirty[i] = True
+            continue
+        neigh_out[i] = list(neigh)
+        rho_out[i] = rho[o][:max_vertices]
+        theta_out[i] = theta[o][:max_vertices]
+        mask_out[i] = mask[o][:max_vertices]
+
+    # Recompute the rest.
+    recomputed = np.where(dirty)[0]
+    if len(recomputed) > 0:
+        rho_c, theta_c, neigh_c, mask_c = compute_patch_coordinates(mesh, recomputed, do_fast=do_fast,
+                                                                    radius=radius, max_vertices=max_vertices,
+                                                                    geodesic=geodesic)
+        rho_out[recomputed] = rho_c
+        theta_out[recomputed] = theta_c
+        mask_out[recomputed] = mask_c
+        for k, i in enumerate(recomputed):
+            neigh_out[i] = neigh_c[k]
+
+    return rho_out, theta_out, neigh_out, mask_out, recomputed, old_of_new
+
+
+def assemble_patches(D, theta, centers, max_vertices, order_by=None):
+    """
+    Assemble the padded rho, theta and mask arrays for the patches centered at centers.
+        D: geodesic distance matrix (see geodesic_matrix.py), with the distances from each center to its patch members.
+        theta: theta values of each patch, in the same order as centers.
+        order_by: distance matrix whose row of each center selects and orders the members of the patch
+            (e.g. the heat method distances before they are symmetrized in D); D if None.
+    """
+    order_by = D if order_by is None else order_by
+    n = len(centers)
     theta_out = np.zeros((n, max_vertices))
     rho_out= np.zeros((n, max_vertices))
     mask_out = np.zeros((n, max_vertices))
@@ -107,19 +281,69 @@ def compute_polar_coordinates(mesh, do_fast=True, radius=12, max_vertices=200):
     neigh_indices = []
     
     # Assemble output.
-    for i in range(n): 
-        dists_i = d2[i]
-        sorted_dists_i = sorted(dists_i.items(), key=lambda kv: kv[1])
-        neigh = [int(x[0]) for x in sorted_dists_i[0:max_vertices]] 
-        neigh_indices.append(neigh)
-        rho_out[i,:len(neigh)]= np.squeeze(np.asarray(D[i,neigh].todense()))
-        theta_out[i,:len(neigh)]= np.squeeze(theta[i][neigh])
-        mask_out[i,:len(neigh)] = 1
+    for k, i in enumerate(centers):
+        cols, dists = row(order_by, i)
+        order = np.argsort(dists, kind='stable')[:max_vertices]
+        neigh = cols[order]
+        neigh_indices.append(neigh.tolist())
+        rho_out[k,:len(neigh)]= dists[order] if order_by is D else submatrix(D, [i], neigh)[0]
+        theta_out[k,:len(neigh)]= theta[k][neigh]
+        mask_out[k,:len(neigh)] = 1
     # have the angles between 0 and 2*pi
     theta_out[theta_out < 0] +=2 * np.pi
 
     return rho_out, theta_out, neigh_indices, mask_out
 
+
+def mesh_normals(mesh):
+    norm1 = mesh.get_attribute('vertex_nx')
+    norm2 = mesh.get_attribute('vertex_ny')
+    norm3 = mesh.get_attribute('vertex_nz')
+    return np.vstack([norm1, norm2, norm3]).T
+
+
+def mesh_edges(faces):
+    """
+    Directed edges (both directions) of a triangle mesh, as a (6*n_faces, 2) array.
+    """
+    f = np.array(faces, dtype = int)
+    rowi = np.concatenate([f[:,0], f[:,0], f[:,1], f[:,1], f[:,2], f[:,2]], axis = 0)
+    rowj = np.concatenate([f[:,1], f[:,2], f[:,0], f[:,2], f[:,0], f[:,1]], axis = 0)
+    return np.stack([rowi, rowj]).T
+
+
+def mesh_graph(mesh):
+    """
+    Graph of the mesh, with edges weighted by their euclidean length.
+    """
+    G=nx.Graph()
+    n = len(mesh.vertices)
+    G.add_nodes_from(np.arange(n))
+
+    # Get edges
+    edges = mesh_edges(mesh.faces)
+    rowi = edges[:,0]
+    rowj = edges[:,1]
+    verts = mesh.vertices
+
+    # Get weights 
+    edgew = verts[rowi] - verts[rowj]
+    edgew = scipy.linalg.norm(edgew, axis=1)
+    wedges = np.stack([rowi, rowj, edgew]).T
+
+    G.add_weighted_edges_from(wedges)
+    return G
+
+
+def faces_per_vertex(faces):
+    idx = {}
+    for ix, face in enumerate(faces):
+        for i in range(3):
+            if face[i] not in idx:
+                idx[face[i]] = []
+            idx[face[i]].append(ix)
+    return idx
+
 def compute_thetas(plane, vix, verts, faces, normal, neighbors, idx):
     """
     compute_thetas: compute the angles of each vertex with respect to some
@@ -205,31 +429,6 @@ def compute_thetas(plane, vix, verts, faces, normal, neighbors, idx):
 
     return thetas
 
-def dict_to_sparse(mydict):
-    """ 
-        create a sparse matrix from a dictionary
-    """
-
-    # Create the appropriate format for the COO format.
-    data = []
-    row = []
-    col = []
-    for r in mydict.keys():
-        for c in mydict[r].keys():
-            r = int(r)
-            c = int(c)
-            v = mydict[r][c]
-            data.append(v)
-            row.append(r)
-            col.append(c)
-    # Create the COO-matrix
-    coo = coo_matrix((data,(row,col)))
-    # Let Scipy convert COO to CSR format and return
-    return csr_matrix(coo)
-
-
-
-
 def extract_patch(mesh, neigh, cv):
     """ 
     Extract a patch from the mesh.
@@ -267,7 +466,8 @@ def output_patch_coords(subv, subf, subn, i, neigh_i, theta, rho):
     """ 
         For debugging purposes, save a patch to visualize it.
     """ 
-    
+    import pymesh
+
     mesh = pymesh.form_mesh(subv, subf)
     n1 = subn[:,0]
     n2 = subn[:,1]
@@ -295,20 +495,21 @@ def output_patch_coords(subv, subf, subn, i, neigh_i, theta, rho):
 
 #@jit
 def call_mds(mds_obj, pair_dist):
-    return mds_obj.fit_transform(pair_dist)
+    # Recent versions of scikit-learn do not accept np.matrix
+    return mds_obj.fit_transform(np.asarray(pair_dist))
 
-def compute_theta_all(D, vertices, faces, normals, idx, radius):
+def compute_theta_all(D, vertices, faces, normals, idx, radius, centers=None):
     mymds = MDS(n_components=2, n_init=1, max_iter=50, dissimilarity='precomputed', n_jobs=10)
     all_theta = []
-    for i in range(D.shape[0]):
+    if centers is None:
+        centers = range(D.shape[0])
+    for i in centers:
         if i % 100 == 0:
             print(i)
         # Get the pairs of geodesic distances.
-        neigh = D[i].nonzero()
-        ii = np.where(D[i][neigh] < radius)[1]
-        neigh_i = neigh[1][ii]
-        pair_dist_i = D[neigh_i,:][:,neigh_i]
-        pair_dist_i = pair_dist_i.todense()
+        neigh, dists = row(D, i)
+        neigh_i = neigh[dists < radius]
+        pair_dist_i = submatrix(D, neigh_i, neigh_i)
 
         # Plane_i: the 2D plane for all neighbors of i
         plane_i = call_mds(mymds, pair_dist_i)
@@ -319,7 +520,7 @@ def compute_theta_all(D, vertices, faces, normals, idx, radius):
     return all_theta
 
 
-def compute_theta_all_fast(D, vertices, faces, normals, idx, radius):
+def compute_theta_all_fast(D, vertices, faces, normals, idx, radius, centers=None):
     """
         compute_theta_all_fast: compute the theta coordinate using an approximation.
         The approximation consists of taking only the inner radius/2 for the multidimensional
@@ -328,40 +529,37 @@ def compute_theta_all_fast(D, vertices, faces, normals, idx, radius):
     """
     mymds = MDS(n_components=2, n_init=1, eps=0.1, max_iter=50, dissimilarity='precomputed', n_jobs=1)
     all_theta = []
-    start_loop = time.clock()
+    start_loop = time.perf_counter()
     only_mds = 0.0
-    for i in range(D.shape[0]):
+    if centers is None:
+        centers = range(D.shape[0])
+    for i in centers:
         # Get the pairs of geodesic distances.
-        neigh = D[i].nonzero()
+        neigh, dists = row(D, i)
         # We will run MDS on only a subset of the points.
-        ii = np.where(D[i][neigh] < radius/2)[1]
-        neigh_i = neigh[1][ii]
-        pair_dist_i = D[neigh_i,:][:,neigh_i]
-        pair_dist_i = pair_dist_i.todense()
+        neigh_i = neigh[dists < radius/2]
+        pair_dist_i = submatrix(D, neigh_i, neigh_i)
 
         # Plane_i: the 2D plane for all neighbors of i
-        tic = time.clock()
+        tic = time.perf_counter()
         plane_i = call_mds(mymds, pair_dist_i)
-        toc = time.clock()
+        toc = time.perf_counter()
         only_mds += (toc - tic)
     
         # Compute the angles on the plane.
         theta = compute_thetas(plane_i, i, vertices, faces, normals, neigh_i, idx)
 
         # We now must assign angles to all points kk that are between radius/2 and radius from the center.
-        kk = np.where(D[i][neigh] >= radius/2)[1]
-        neigh_k = neigh[1][kk]
-        dist_kk = D[neigh_k,:][:,neigh_i]
-        dist_kk = dist_kk.todense()
+        neigh_k = neigh[dists >= radius/2]
+        dist_kk = submatrix(D, neigh_k, neigh_i)
         dist_kk[dist_kk == 0] = float('inf')
         closest = np.argmin(dist_kk, axis=1)
-        closest = np.squeeze(closest)
         closest = neigh_i[closest]
         theta[neigh_k] = theta[closest]
 
         
         all_theta.append(theta)
-    end_loop = time.clock()
+    end_loop = time.perf_counter()
     print('Only MDS time: {:.2f}s'.format(only_mds))
     print('Full loop time: {:.2f}s'.format(end_loop-start_loop))
     return all_theta
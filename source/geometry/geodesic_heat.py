@@ -0,0 +1,223 @@
+"""
+geodesic_heat.py: Geodesic distances on a triangle mesh with the heat method
+(Crane, Weischedel and Wardetzky, "Geodesics in Heat", 2013).
+Released under an Apache License 2.0
+"""
+
+import numpy as np
+from scipy.sparse import coo_matrix, diags
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import splu
+from scipy.spatial import cKDTree
+
+
+class HeatGeodesics:
+    """
+    Heat method geodesics. The heat flow and Poisson systems are factorized once per mesh,
+    so the distances from each source only cost two sparse back-substitutions, and many
+    sources are solved together as the columns of one right-hand side.
+    With a cutoff, on meshes of more than local_min vertices and with many sources, the distances are
+    solved on the part of the mesh around the sources instead (see distances_dict).
+        t_factor: the diffusion time is t_factor * (mean edge length)^2.
+        t: diffusion time, instead of t_factor (e.g. the one of the whole mesh, for a part of it).
+    """
+    local_min = 4000
+    # Local solves are used when there are at least this many sources per cube on average
+    local_sources_per_cell = 4
+    # Width of the mesh kept around the patches of the sources in a local solve, relative to the cutoff,
+    # so that the boundary of the part of the mesh does not bend the distances within the cutoff.
+    local_margin = 0.5
+
+    def __init__(self, vertices, faces, t_factor=1.0, t=None):
+        self.vertices = np.asarray(vertices, dtype=float)
+        self.faces = np.asarray(faces, dtype=int)
+        self.n = len(self.vertices)
+
+        if t is None:
+            p = self.vertices[self.faces]
+            h = np.mean(np.linalg.norm(p - np.roll(p, 1, axis=1), axis=2))
+            t = t_factor * h**2
+        self.t = t
+        self.heat_solver = None
+
+    def factorize(self):
+        L, M = cotangent_laplacian(self.vertices, self.faces)
+        self.grad = face_gradient(self.vertices, self.faces)
+        self.div = vertex_divergence(self.vertices, self.faces)
+        self.heat_solver = splu((M + self.t * L).tocsc())
+        # L is only positive semi-definite (constants are in its null space): a small shift makes
+        # it invertible, and the constant it adds is removed when setting the distance at the source to zero.
+        self.poisson_solver = splu((L + 1e-8 * M).tocsc())
+        # Vertices in other connected components than a source are not reached from it
+        self.component = connected_components(mesh_adjacency(self.faces, self.n), directed=False)[1]
+
+    def distances(self, sources):
+        """
+        Returns a (n_vertices, len(sources)) array with the distance of every vertex to each source
+        (infinite in the other connected components of the mesh).
+        """
+        if self.heat_solver is None:
+            self.factorize()
+        sources = np.asarray(sources, dtype=int)
+        delta = np.zeros((self.n, len(sources)))
+        delta[sources, np.arange(len(sources))] = 1
+
+        # Heat flow from each source.
+        u = self.heat_solver.solve(delta)
+
+        # Normalized (negative) gradient of the heat in each face.
+        X = np.stack([G @ u for G in self.grad], axis=2)
+        X /= -np.maximum(np.linalg.norm(X, axis=2, keepdims=True), 1e-300)
+
+        # Recover the distance, whose gradient is X, from its divergence.
+        div = sum(D @ X[:,:,i] for i, D in enumerate(self.div))
+        phi = self.poisson_solver.solve(-div)
+        phi -= phi[sources, np.arange(len(sources))]
+        phi = np.maximum(phi, 0)
+        phi[self.component[:,None] != self.component[sources][None,:]] = np.inf
+        return phi
+
+    def distances_dict(self, sources, cutoff=None, batch_size=64):
+        """
+        Distances from each source in the format of networkx.single_source_dijkstra_path_length:
+        {source: {vertex: distance}} for all vertices within cutoff.
+        On a large mesh, solving on the whole mesh costs O(n_vertices) per source, so that the distances
+        from all vertices cost O(n_vertices^2) and are slower than Dijkstra. With a cutoff, the sources
+        are then grouped into cubes of cutoff / 2, and the sources of each cube are solved on the faces
+        within (1 + local_margin) * cutoff of it, which is enough as the geodesic distance is never
+        shorter than the euclidean one. The cost then grows with the number of sources only, and the
+        distances differ slightly from the whole mesh solve near the edge of each local mesh.
+        Sources too sparse to share the factorization of a cube are solved on the whole mesh.
+        """
+        sources = np.asarray(sources, dtype=int)
+        if cutoff is None or self.n <= self.local_min:
+            return self.solve_dict(sources, np.arange(self.n), cutoff, batch_size)
+        cell = cutoff / 2
+        keys = np.floor(self.vertices[sources] / cell).astype(np.int64)
+        cells, cell_of = np.unique(keys, axis=0, return_inverse=True)
+        if len(sources) < self.local_sources_per_cell * len(cells):
+            return self.solve_dict(sources, np.arange(self.n), cutoff, batch_size)
+
+        cell_of = cell_of.ravel()
+        tree = cKDTree(self.vertices)
+        reach = np.sqrt(3) * cell / 2 + (1 + self.local_margin) * cutoff
+        d2 = {}
+        order = np.argsort(cell_of, kind='stable')
+        bounds = np.searchsorted(cell_of[order], np.arange(len(cells) + 1))
+        for c in range(len(cells)):
+            batch = sources[order[bounds[c]:bounds[c+1]]]
+            region = np.zeros(self.n, dtype=bool)
+            region[tree.query_ball_point((cells[c] + 0.5) * cell, reach)] = True
+            faces = self.faces[region[self.faces].all(axis=1)]
+            vertices, local_faces = np.unique(faces, return_inverse=True)
+            # Sources without a face in the region (isolated vertices) only reach themselves
+            pos = np.minimum(np.searchsorted(vertices, batch), max(len(vertices) - 1, 0))
+            found = vertices[pos] == batch if len(vertices) > 0 else np.zeros(len(batch), dtype=bool)
+            for s in batch[~found].tolist():
+                d2[s] = {s: 0.0}
+            if found.any():
+                part = HeatGeodesics(self.vertices[vertices], local_faces.reshape(-1, 3), t=self.t)
+                d2.update(part.solve_dict(pos[found], vertices, cutoff, batch_size))
+        return {s: d2[s] for s in sources.tolist()}
+
+    def solve_dict(self, sources, labels, cutoff, batch_size):
+        # Distances from sources, in batches, as {source: {vertex: distance}} with vertices and
+        # sources given as labels[index]
+        d2 = {}
+        for start in range(0, len(sources), batch_size):
+            batch = sources[start:start+batch_size]
+            dists = self.distances(batch)
+            for k, s in enumerate(batch):
+                col = dists[:,k]
+                members = np.where(np.isfinite(col))[0] if cutoff is None else np.where(col <= cutoff)[0]
+                source = labels[s].item()
+                d2[source] = dict(zip(labels[members].tolist(), col[members].tolist()))
+                d2[source][source] = 0.0
+        return d2
+
+
+def mesh_adjacency(faces, n):
+    """
+    Sparse (n, n) adjacency matrix of the edges of the faces.
+    """
+    rows = faces.ravel()
+    cols = np.roll(faces, -1, axis=1).ravel()
+    return coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n)).tocsr()
+
+
+def symmetrize(D):
+    """
+    The heat method distance from u to v and from v to u differ slightly. Average them in the sparse
+    distance matrix D, keeping the entries that are only present in one direction (near the cutoff).
+    """
+    D = D.tocsr()
+    Dt = D.T.tocsr()
+    both = D.multiply(Dt > 0)
+    return (D + Dt - (both + both.T) / 2).tocsr()
+
+
+def face_geometry(vertices, faces):
+    """
+    Edge vectors opposite each corner (e[:,i] goes from corner i+1 to corner i+2), cotangents
+    of the angle at each corner, unit face normals and face areas.
+    """
+    p = vertices[faces]
+    e = np.roll(p, -2, axis=1) - np.roll(p, -1, axis=1)
+    cross = np.cross(p[:,1] - p[:,0], p[:,2] - p[:,0])
+    double_area = np.maximum(np.linalg.norm(cross, axis=1), 1e-12)
+    normals = cross / double_area[:,None]
+    cot = np.zeros((len(faces), 3))
+    for i in range(3):
+        a = p[:,(i+1)%3] - p[:,i]
+        b = p[:,(i+2)%3] - p[:,i]
+        cot[:,i] = np.sum(a*b, axis=1) / double_area
+    return e, cot, normals, double_area / 2
+
+
+def cotangent_laplacian(vertices, faces):
+    """
+    Cotangent Laplacian L (positive semi-definite) and lumped mass matrix M.
+    """
+    n = len(vertices)
+    _, cot, _, area = face_geometry(vertices, faces)
+    rows, cols, vals = [], [], []
+    for i in range(3):
+        j, k = (i+1)%3, (i+2)%3
+        # The angle at corner i is opposite to the edge (j, k).
+        w = 0.5 * cot[:,i]
+        rows += [faces[:,j], faces[:,k], faces[:,j], faces[:,k]]
+        cols += [faces[:,k], faces[:,j], faces[:,j], faces[:,k]]
+        vals += [-w, -w, w, w]
+    L = coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n)).tocsr()
+    M = diags(np.bincount(faces.ravel(), weights=np.repeat(area / 3, 3), minlength=n))
+    return L, M
+
+
+def face_gradient(vertices, faces):
+    """
+    Sparse (n_faces, n_vertices) operators giving the x, y and z components of the
+    gradient in each face of a function defined on the vertices.
+    """
+    n = len(vertices)
+    e, _, normals, area = face_geometry(vertices, faces)
+    rows = np.repeat(np.arange(len(faces)), 3)
+    cols = faces.ravel()
+    vals = np.cross(normals[:,None,:], e) / (2 * area[:,None,None])
+    return [coo_matrix((vals[:,:,d].ravel(), (rows, cols)), shape=(len(faces), n)).tocsr() for d in range(3)]
+
+
+def vertex_divergence(vertices, faces):
+    """
+    Sparse (n_vertices, n_faces) operators giving the integrated divergence at each vertex
+    of a vector field that is constant in each face, from its x, y and z components.
+    """
+    n = len(vertices)
+    p = vertices[faces]
+    _, cot, _, _ = face_geometry(vertices, faces)
+    rows = faces.ravel()
+    cols = np.repeat(np.arange(len(faces)), 3)
+    vals = np.zeros((len(faces), 3, 3))
+    for i in range(3):
+        j, k = (i+1)%3, (i+2)%3
+        vals[:,i] = 0.5 * (cot[:,k,None] * (p[:,j] - p[:,i]) + cot[:,j,None] * (p[:,k] - p[:,i]))
+    return [coo_matrix((vals[:,:,d].ravel(), (rows, cols)), shape=(n, len(faces))).tocsr() for d in range(3)]
@@ -0,0 +1,195 @@
+"""
+geodesic_matrix.py: Compact geodesic distance matrix of a mesh. The distances within the patch radius are
+kept in a CSR matrix with float32 distances and int32 indices (about 8 bytes per pair), which can be saved
+and reloaded, cut to a smaller radius, and read row by row or as small dense submatrices (the inputs of
+the MDS) without scipy's fancy indexing.
+Rows without any entry have not been computed: every computed row has at least its diagonal entry,
+which is set to a small positive value (1e-8) so that it is kept as a nonzero.
+A saved matrix carries a fingerprint of the mesh (a hash of its vertices and faces), so that it is not
+reused for another mesh with the same number of vertices.
+Released under an Apache License 2.0
+"""
+import hashlib
+from itertools import chain
+from pathlib import Path
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+DIAGONAL = 1e-8
+
+
+def dict_to_csr(d2, n):
+    """
+    CSR matrix of shape (n, n) from geodesic distances {source: {vertex: distance}} (as returned by
+    networkx.single_source_dijkstra_path_length), with sorted indices and the diagonal set to DIAGONAL.
+    """
+    rows = np.fromiter(d2.keys(), dtype=np.int64, count=len(d2))
+    lengths = np.fromiter((len(d2[r]) for r in d2), dtype=np.int64, count=len(d2))
+    cols = np.fromiter(chain.from_iterable(d2[r].keys() for r in d2), dtype=np.int64, count=lengths.sum())
+    data = np.fromiter(chain.from_iterable(d2[r].values() for r in d2), dtype=np.float32, count=lengths.sum())
+    row_of = np.repeat(rows, lengths)
+    data[row_of == cols] = DIAGONAL
+
+    # Sort by row, then column
+    order = np.lexsort((cols, row_of))
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_of, minlength=n), out=indptr[1:])
+    return make_csr(data[order], cols[order], indptr, n)
+
+
+def make_csr(data, indices, indptr, n):
+    index_dtype = np.int32 if len(data) < 2**31 else np.int64
+    return csr_matrix((np.asarray(data, dtype=np.float32), np.asarray(indices, dtype=index_dtype),
+                       np.asarray(indptr, dtype=index_dtype)), shape=(n, n))
+
+
+def compact(D):
+    """
+    D as float32 / int32 CSR with sorted indices (e.g. after sparse arithmetic).
+    """
+    D = D.tocsr()
+    D.sort_indices()
+    return make_csr(D.data, D.indices, D.indptr, D.shape[0])
+
+
+def computed_rows(D):
+    return np.diff(D.indptr) > 0
+
+
+def row(D, i):
+    """
+    Columns (sorted) and distances of the nonzero entries of row i.
+    """
+    start, end = D.indptr[i], D.indptr[i+1]
+    cols = D.indices[start:end]
+    dists = D.data[start:end]
+    nonzero = dists != 0
+    if not nonzero.all():
+        cols, dists = cols[nonzero], dists[nonzero]
+    return cols, dists
+
+
+def submatrix(D, rows, cols):
+    """
+    Dense (len(rows), len(cols)) float64 array D[rows][:,cols], with zeros where D has no entry.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    out = np.zeros((len(rows), len(cols)))
+    if len(rows) == 0 or len(cols) == 0:
+        return out
+    if np.any(cols[1:] < cols[:-1]):
+        order = np.argsort(cols)
+        out[:,order] = submatrix(D, rows, cols[order])
+        return out
+    starts = D.indptr[rows]
+    lengths = D.indptr[rows + 1] - starts
+    # Positions in D.indices of all the entries of the rows
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    pos = offsets + np.arange(lengths.sum())
+    found = D.indices[pos]
+    k = np.minimum(np.searchsorted(cols, found), len(cols) - 1)
+    keep = cols[k] == found
+    r = np.repeat(np.arange(len(rows)), lengths)
+    out[r[keep], k[keep]] = D.data[pos[keep]]
+    return out
+
+
+def restrict(D, radius):
+    """
+    D without the distances larger than radius.
+    """
+    keep = D.data <= radius
+    if keep.all():
+        return D
+    row_of = np.repeat(np.arange(D.shape[0]), np.diff(D.indptr))
+    indptr = np.zeros(D.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_of[keep], minlength=D.shape[0]), out=indptr[1:])
+    return make_csr(D.data[keep], D.indices[keep], indptr, D.shape[0])
+
+
+def mesh_fingerprint(vertices, faces):
+    """
+    Hash of the vertex coordinates and faces of a mesh.
+    """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(vertices, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(faces, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+def stored_geodesics(cache, vertices, faces, method):
+    """
+    (D, radius) of the geodesic distance matrix kept in cache (see geodesic_cache), if it was computed
+    for this mesh (same fingerprint) with this method, otherwise None.
+    """
+    stored = cache.get('geodesics')
+    if stored is None:
+        return None
+    D, radius, stored_method = stored
+    n = len(vertices)
+    if D.shape != (n, n) or stored_method != method or cache.get('fingerprint') != mesh_fingerprint(vertices, faces):
+        return None
+    return D, radius
+
+
+def keep_geodesics(cache, D, radius, method, vertices, faces):
+    """
+    Keep the geodesic distance matrix D of the mesh in cache, if it has the key 'geodesics', so that
+    save_geodesic_cache saves it.
+    """
+    if 'geodesics' in cache:
+        cache['geodesics'] = (D, radius, method)
+        cache['fingerprint'] = mesh_fingerprint(vertices, faces)
+        cache['changed'] = True
+
+
+def save_geodesics(path, D, radius, method, fingerprint=''):
+    """
+    Save the geodesic distance matrix (computed up to radius, with method 'dijkstra' or 'heat') as an .npz
+    file, with the fingerprint of its mesh (see mesh_fingerprint).
+    """
+    with open(path, 'wb') as f:
+        np.savez(f, data=D.data, indices=D.indices, indptr=D.indptr, n=D.shape[0], radius=radius, method=method,
+                 fingerprint=fingerprint)
+
+
+def load_geodesics(path):
+    """
+    Returns (D, radius, method) as stored by save_geodesics.
+    """
+    with np.load(path) as f:
+        n = int(f['n'])
+        return make_csr(f['data'], f['indices'], f['indptr'], n), float(f['radius']), str(f['method'])
+
+
+def load_fingerprint(path):
+    """
+    Fingerprint of the mesh stored by save_geodesics, or None for files saved without one.
+    """
+    with np.load(path) as f:
+        return str(f['fingerprint']) if 'fingerprint' in f.files else None
+
+
+def geodesic_cache(path):
+    """
+    Cache for compute_polar_coordinates that reuses the geodesic distances stored at path, if the file
+    exists and was saved for the same mesh, and keeps the distances that are computed so that they can
+    be saved with save_geodesic_cache. Rows computed for a smaller radius than the stored one are
+    computed up to the stored radius, so the stored matrix is never cut down.
+    """
+    path = Path(path)
+    if not path.exists():
+        return {'geodesics': None}
+    return {'geodesics': load_geodesics(path), 'fingerprint': load_fingerprint(path)}
+
+
+def save_geodesic_cache(path, cache):
+    """
+    Save the geodesic distances kept in cache, if rows were added since it was loaded.
+    """
+    if cache.get('changed') and cache.get('geodesics') is not None:
+        D, radius, method = cache['geodesics']
+        save_geodesics(Path(path), D, radius, method, fingerprint=cache['fingerprint'])
+        cache['changed'] = False
@@ -0,0 +1,106 @@
+"""
+patch_centers.py: Select the vertices on which patches are centered, when only part of the surface is needed.
+Released under an Apache License 2.0
+"""
+
+import networkx as nx
+import numpy as np
+
+from geometry.compute_polar_coordinates import mesh_graph
+
+
+def resolve_centers(spec, mesh, features=None):
+    """
+    resolve_centers: convert a selection of patch centers into vertex indices.
+        spec: one of
+            None: all vertices (returns None).
+            array of vertex indices.
+            {'residues': ['A:12', 'A:20-25', ...]}: vertices assigned to these residues (needs features).
+            {'box': (xmin, ymin, zmin, xmax, ymax, zmax)}: vertices inside an axis-aligned box.
+            {'n_samples': k}: k vertices chosen by farthest point sampling.
+            {'cover_radius': r}: a small set of vertices such that every vertex lies within a
+                geodesic distance r of one of them (see coverage_sampling).
+        features: per-vertex 'chain' and 'residx', as computed by main.unpack_names
+    Returns: sorted array of vertex indices (or None).
+    """
+    if spec is None:
+        return None
+    vertices = mesh.vertices
+    if not isinstance(spec, dict):
+        return np.unique(np.asarray(spec, dtype=int))
+    if 'residues' in spec:
+        return select_residues(spec['residues'], features)
+    if 'box' in spec:
+        return select_box(vertices, spec['box'])
+    if 'n_samples' in spec:
+        return np.sort(farthest_point_sampling(vertices, spec['n_samples']))
+    if 'cover_radius' in spec:
+        return np.sort(coverage_sampling(mesh, spec['cover_radius']))
+    raise ValueError(f"Unknown patch center selection: {spec}")
+
+
+def parse_residues(residues):
+    """
+    Parse residue selections of the form 'A:12' or 'A:12-20' into (chain, first, last) tuples.
+    """
+    selection = []
+    for r in residues:
+        chain, rng = r.split(':')
+        first, _, last = rng.partition('-')
+        selection.append((chain, int(first), int(last) if last else int(first)))
+    return selection
+
+
+def select_residues(residues, features):
+    chain = np.array(features['chain'])
+    residx = np.array(features['residx'])
+    selected = np.zeros(len(residx), dtype=bool)
+    for c, first, last in parse_residues(residues):
+        selected |= (chain == c) & (residx >= first) & (residx <= last)
+    return np.where(selected)[0]
+
+
+def select_box(vertices, box):
+    box = np.asarray(box, dtype=float)
+    inside = np.all((vertices >= box[:3]) & (vertices <= box[3:]), axis=1)
+    return np.where(inside)[0]
+
+
+def farthest_point_sampling(vertices, n_samples, start=0):
+    """
+    Greedy farthest point sampling: repeatedly pick the vertex farthest (euclidean distance)
+    from all previously picked vertices. Returns the indices in the order they were picked.
+    """
+    n_samples = min(n_samples, len(vertices))
+    picked = np.zeros(n_samples, dtype=int)
+    picked[0] = start
+    dists = np.linalg.norm(vertices - vertices[start], axis=1)
+    for k in range(1, n_samples):
+        picked[k] = np.argmax(dists)
+        dists = np.minimum(dists, np.linalg.norm(vertices - vertices[picked[k]], axis=1))
+    return picked
+
+
+def coverage_sampling(mesh, cover_radius, order=None):
+    """
+    Choose patch centers such that every vertex lies within a geodesic distance cover_radius
+    of a center. Vertices are visited in order (all vertices by default); every vertex that is
+    not yet covered becomes a center, and a Dijkstra front bounded by cover_radius marks the
+    vertices it covers. Centers are therefore more than cover_radius apart, so that nearly
+    identical overlapping patches are not computed twice, and each front only visits the
+    neighborhood of its center.
+    Returns the indices of the centers in the order they were picked.
+    """
+    G = mesh_graph(mesh)
+    n = len(mesh.vertices)
+    if order is None:
+        order = np.arange(n)
+    covered = np.zeros(n, dtype=bool)
+    picked = []
+    for v in order:
+        if covered[v]:
+            continue
+        picked.append(v)
+        front = nx.single_source_dijkstra_path_length(G, v, cutoff=cover_radius)
+        covered[np.array(list(front.keys()), dtype=int)] = True
+    return np.array(picked, dtype=int)
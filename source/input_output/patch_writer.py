@@ -0,0 +1,53 @@
+"""
+patch_writer.py: Write the patches of a surface to .npy files chunk by chunk, as they are computed,
+so that the arrays of all patches are never held in memory at once.
+Released under an Apache License 2.0
+"""
+import numpy as np
+
+
+class PatchWriter:
+    """
+    Write the patches to {stem}_rho_wrt_center.npy, {stem}_theta_wrt_center.npy, {stem}_input_feat.npy,
+    {stem}_mask.npy and {stem}_list_indices.npy, in the layout saved by main.py. The files are created
+    with their final shape, and each chunk is written at its offset with plain file writes (not
+    through a memory map, so the written pages do not stay in the memory of the process).
+    list_indices is an (n_patches, max_vertices) int32 array, padded with the index of the center
+    (as pad_indices in train_masif_site.py).
+        path: path template, as for save_patches (e.g. out/1abc.npy)
+        n_patches: total number of patches
+        max_vertices, n_feat: size of the patches and number of input features
+    """
+    def __init__(self, path, n_patches, max_vertices, n_feat):
+        self.n_patches = n_patches
+        self.files = {}
+        for name, shape, dtype in [('rho_wrt_center', (n_patches, max_vertices), np.float64),
+                                   ('theta_wrt_center', (n_patches, max_vertices), np.float64),
+                                   ('input_feat', (n_patches, max_vertices, n_feat), np.float64),
+                                   ('mask', (n_patches, max_vertices), np.float64),
+                                   ('list_indices', (n_patches, max_vertices), np.int32)]:
+            p = path.with_name(f"{path.stem}_{name}.npy")
+            # Create the file with its header and final size, and keep the offset of the data
+            out = np.lib.format.open_memmap(p, mode='w+', dtype=dtype, shape=shape)
+            offset, row_bytes = out.offset, out[0].nbytes if n_patches > 0 else 0
+            del out
+            self.files[name] = (p, offset, row_bytes, dtype)
+        self.written = 0
+
+    def write(self, start, centers, patches):
+        """
+        Write the patches of centers, which are patches start to start+len(centers).
+            patches: input_feat, rho, theta, mask and neigh_idx, as returned by get_patches_from_surface
+        """
+        input_feat, rho, theta, mask, neigh_idx = patches
+        indices = np.repeat(np.asarray(centers, dtype=np.int32)[:,None], rho.shape[1], axis=1)
+        for k, neigh in enumerate(neigh_idx):
+            indices[k,:len(neigh)] = neigh[:rho.shape[1]]
+
+        for name, values in [('rho_wrt_center', rho), ('theta_wrt_center', theta), ('input_feat', input_feat),
+                             ('mask', mask), ('list_indices', indices)]:
+            p, offset, row_bytes, dtype = self.files[name]
+            with open(p, 'r+b') as f:
+                f.seek(offset + start * row_bytes)
+                f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+        self.written += len(centers)
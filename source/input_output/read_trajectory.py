@@ -0,0 +1,76 @@
+"""
+read_trajectory.py: Read a topology (pdb / pqr) once and stream the coordinates of its frames.
+Released under an Apache License 2.0
+"""
+import numpy as np
+from Bio.PDB import *
+
+from triangulation.xyzrn import read_xyzrn_atoms
+
+
+def read_topology(path_top):
+    """
+        Parse all the per-atom data that stays constant along a trajectory.
+        path_top: pdb / pqr file with the topology (and reference coordinates).
+        Returns a dictionary with:
+            n_atoms: number of atoms; frames must list them in the same order as the topology file.
+            atom_idx, R, full_ids: atoms that go into the MSMS xyzrn file (see read_xyzrn_atoms).
+            coords: (n_atoms,3) reference coordinates
+            atom_lines: ATOM / HETATM records of the first model, reused to write each frame.
+    """
+    parser = PDBParser(QUIET=True)
+    struct = parser.get_structure('', path_top)
+    model = Selection.unfold_entities(struct, "M")[0]
+    coords = np.array([atom.get_coord() for atom in model.get_atoms()])
+
+    atom_idx, _, R, full_ids = read_xyzrn_atoms(path_top)
+
+    atom_lines = []
+    for line in open(path_top, 'r'):
+        if line[:6] in ['ATOM  ', 'HETATM']:
+            atom_lines.append(line.rstrip('\n'))
+        elif line[:6] == 'ENDMDL':
+            break
+
+    if len(atom_lines) != len(coords):
+        raise ValueError(f"{path_top}: found {len(atom_lines)} atom records but parsed {len(coords)} atoms")
+
+    topology = {'path':path_top, 'n_atoms':len(coords), 'coords':coords,
+                'atom_idx':np.array(atom_idx, dtype=int), 'R':R, 'full_ids':full_ids,
+                'atom_lines':atom_lines}
+    return topology
+
+
+def iter_frames(path_traj, topology, start=0, stop=None, stride=1):
+    """
+        Yield (frame_index, coords) for the frames of a trajectory.
+        path_traj: either a .npy array of shape (n_frames, n_atoms, 3), which is memory-mapped,
+            or any trajectory format readable by MDAnalysis (dcd, xtc, trr, ...).
+    """
+    if path_traj.suffix == '.npy':
+        frames = np.load(path_traj, mmap_mode='r')
+        if frames.ndim != 3 or frames.shape[1:] != (topology['n_atoms'], 3):
+            raise ValueError(f"{path_traj}: expected frames of shape (n_frames, {topology['n_atoms']}, 3), got {frames.shape}")
+        for i in range(len(frames))[start:stop:stride]:
+            yield i, np.array(frames[i], dtype=float)
+    else:
+        try:
+            import MDAnalysis
+        except ImportError:
+            raise ImportError(f"MDAnalysis is needed to read {path_traj.suffix} trajectories; alternatively provide the frames as a .npy array")
+        u = MDAnalysis.Universe(str(topology['path']), str(path_traj))
+        if len(u.atoms) != topology['n_atoms']:
+            raise ValueError(f"{path_traj}: trajectory has {len(u.atoms)} atoms, topology has {topology['n_atoms']}")
+        for ts in u.trajectory[start:stop:stride]:
+            yield ts.frame, u.atoms.positions.astype(float)
+
+
+def write_frame(path_out, topology, coords):
+    """
+        Write the topology file with the coordinates of one frame (e.g. as a PQR input for APBS).
+    """
+    with open(path_out, 'w') as o:
+        for line, xyz in zip(topology['atom_lines'], coords):
+            o.write("{}{:8.3f}{:8.3f}{:8.3f}{}\n".format(line[:30], *xyz, line[54:]))
+        o.write("END\n")
+
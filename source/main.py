@@ -1,32 +1,18 @@
 #!/usr/bin/python
 import argparse
+from contextlib import nullcontext
 from pathlib import Path
 
 import numpy as np
-from Bio.Data.IUPACData import protein_letters_3to1
-from Bio.PDB import * 
 
 # Local includes
+# BioPython, pymesh, sklearn, scipy and networkx are imported by the stages that use them,
+# so that parsing the arguments (and e.g. --help) does not pay for loading them.
 from default_config.masif_opts import masif_opts
-from triangulation.computeMSMS import computeMSMS
-from triangulation.fixmesh import fix_mesh
-import pymesh
-from input_output.extractPDB import extractPDB
-from input_output.save_ply import save_ply
-from input_output.read_ply import read_ply
-from input_output.protonate import protonate
-from masif_modules.read_data_from_surface import get_patches_from_surface
-from triangulation.computeHydrophobicity import computeHydrophobicity
-from triangulation.computeCharges import computeCharges, assignChargesToNewMesh
-from triangulation.computeAPBS import computeAPBS
-from triangulation.compute_normal import compute_normal
-from sklearn.neighbors import KDTree
+from profiling import Profiler, RSSSampler, stage, rss_mb
 
 
-def parse_arguments():
-    parser = argparse.ArgumentParser(description='A program to compute molecular surfaces')
-    parser.add_argument('path', type=Path, help='Path to molecule PDB / PQR file')
-    parser.add_argument('-c', '--chain', default='', help='Choose a single chain to compute')
+def add_surface_arguments(parser):
     parser.add_argument('-o', '--output_dir', default=masif_opts['ply_dir'], help='Output directory path')
     parser.add_argument('--msms_density', type=float, default=3.0, help='Density of surface triangulation')
     parser.add_argument('--msms_hdensity', type=float, default=3.0, help='Density of surface triangulation')
@@ -34,17 +20,43 @@ def parse_arguments():
     parser.add_argument('--mesh_res', type=float, default=1.0, help='Surface triangulation probe radius')
     parser.add_argument('--patch_max_dist', type=float, default=9.0, help='Geodesic patch radius')
     parser.add_argument('--patch_max_size', type=int, default=100, help='Maximum number of vertices in patch')
-    parser.add_argument('--redo', action='store_true', help='Overwrite surface comparison results')
-    parser.add_argument('--noH', action='store_true', help='Do not protonate PDB file?')
-    parser.add_argument('--hbond', action='store_true', help='Calculate hydrogen-bonding potential')
     parser.add_argument('--hphob', action='store_true', help='Calculate Kyte-Doolittle hydrophobicity')
     parser.add_argument('--no_apbs', action='store_true', help='Calculate electrostatic potential')
     parser.add_argument('--patches', action='store_true', help='Decompose surface into patches')
+    parser.add_argument('--geodesic', default='dijkstra', choices=['dijkstra', 'heat'], help='Geodesic distances along mesh edges (dijkstra) or with the heat method (heat)')
+    # The centers of the patches are selected by at most one of these
+    centers = parser.add_mutually_exclusive_group()
+    centers.add_argument('--centers_file', type=Path, default=None, help='Only compute patches centered on the vertex indices in this .npy file')
+    centers.add_argument('--centers_residues', nargs='+', default=None, help='Only compute patches centered on these residues, e.g. A:12 A:20-25')
+    centers.add_argument('--centers_box', type=float, nargs=6, default=None, help='Only compute patches centered inside this box: xmin ymin zmin xmax ymax zmax')
+    centers.add_argument('--n_centers', type=int, default=None, help='Only compute this many patches, centered by farthest point sampling')
+    centers.add_argument('--cover_radius', type=float, default=None, help='Only compute patches centered on a set of vertices such that every vertex is within this geodesic distance of a center')
+    parser.add_argument('--chunk_size', type=int, default=None, help='Compute the patches in chunks of this many centers, written to disk as they are computed')
+    parser.add_argument('--max_memory_mb', type=float, default=None, help='Compute the patches in chunks sized to keep the peak memory under this ceiling')
+    parser.add_argument('--geodesics', default=None, help='Reuse the geodesic distances stored in this .npz file if it exists and was saved for the same mesh, '
+                        'and save the distances computed in addition there')
+    parser.add_argument('--profile', default=None, help='Append the time and resources used by each stage to this JSON lines file')
+    return parser
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='A program to compute molecular surfaces')
+    parser.add_argument('path', type=Path, help='Path to molecule PDB / PQR file')
+    parser.add_argument('-c', '--chain', default='', help='Choose a single chain to compute')
+    parser.add_argument('--redo', action='store_true', help='Overwrite surface comparison results')
+    parser.add_argument('--noH', action='store_true', help='Do not protonate PDB file?')
+    parser.add_argument('--hbond', action='store_true', help='Calculate hydrogen-bonding potential')
+    add_surface_arguments(parser)
+    return parser
 
-    return parser.parse_args()
+
+def parse_arguments():
+    return build_parser().parse_args()
 
 
 def unpack_names(names, features):
+    from Bio.Data.IUPACData import protein_letters_3to1
+
     chain, residx, resname, atomtype = [], [], [], []
     featnames = ['chain', 'residx', 'resname', 'atomtype']
     for n in names:
@@ -58,21 +70,141 @@ def unpack_names(names, features):
     return features
 
 
-def save_features(path, features):
+def feature_arrays(features):
     # Set precision of data types
     dtype = {'chain':'S1', 'residx':np.int16, 'resname':'S1', 'atomtype':'S1',
              'hbond':np.float16, 'hphob':np.float16, 'charge':np.float16,
              'mean_curvature':np.float16, 'gaussian_curvature':np.float16}
+    return {name: np.array(feat, dtype[name]) for name, feat in features.items()}
+
 
+def save_features(path, features):
     # Save each feature to a separate file
-    for name, feat in features.items():
+    for name, feat in feature_arrays(features).items():
         p = path.with_name(f"{path.stem}_{name}")
-        np.save(p, np.array(feat, dtype[name]))
+        np.save(p, feat)
+
+
+def get_center_selection(args):
+    if args.centers_file is not None:
+        return np.load(args.centers_file)
+    if args.centers_residues is not None:
+        return {'residues':args.centers_residues}
+    if args.centers_box is not None:
+        return {'box':args.centers_box}
+    if args.n_centers is not None:
+        return {'n_samples':args.n_centers}
+    if args.cover_radius is not None:
+        return {'cover_radius':args.cover_radius}
+    return None
+
+
+def patch_parameters(args):
+    return {'max_distance':args.patch_max_dist, 'max_shape_size':args.patch_max_size, 'geodesic':args.geodesic}
+
+
+def add_normals(mesh, vertex_normals):
+    # Add vertices to mesh
+    mesh.add_attribute("vertex_nx")
+    mesh.add_attribute("vertex_ny")
+    mesh.add_attribute("vertex_nz")
+    mesh.set_attribute("vertex_nx", vertex_normals[:,0])
+    mesh.set_attribute("vertex_ny", vertex_normals[:,1])
+    mesh.set_attribute("vertex_nz", vertex_normals[:,2])
+
+
+def select_centers(mesh, features, args, within=None):
+    from geometry.patch_centers import resolve_centers
+
+    with stage('centers'):
+        centers = resolve_centers(get_center_selection(args), mesh, features)
+        if within is not None:
+            centers = np.asarray(within, dtype=int) if centers is None else np.intersect1d(centers, within)
+    return centers
+
+
+def compute_patches(mesh, vertex_normals, features, args, within=None, cache=None):
+    """
+    Decompose the surface into patches, centered on the vertices selected by the arguments.
+        within: if given, only the selected vertices among these vertex indices are centers.
+        cache: see compute_patch_coordinates.
+    Returns the centers (None if all vertices) and the patches: input_feat, rho, theta, mask and neigh_idx.
+    """
+    from masif_modules.read_data_from_surface import get_patches_from_surface
+
+    add_normals(mesh, vertex_normals)
+    with stage('patches', mesh_vertices=len(mesh.vertices)) as info:
+        centers = select_centers(mesh, features, args, within)
+        patches = get_patches_from_surface(mesh, vertex_normals, features, patch_parameters(args), centers=centers,
+                                           cache=cache)
+        info['patches'] = len(patches[1])
+    return centers, patches
+
+
+def stream_patches(path, mesh, vertex_normals, features, args, cache=None):
+    """
+    Compute the patches in chunks of consecutive centers, and write each chunk to the patch files
+    (see input_output.patch_writer) before computing the next one. The geodesic distances, the
+    coordinates and the features are only held for one chunk at a time.
+    The chunks have --chunk_size centers. With --max_memory_mb, the size of each next chunk is set from
+    the largest memory per patch used so far (the increase of the RSS within a chunk, see RSSSampler)
+    and the memory left under the ceiling, and is at least halved after a chunk that went over it.
+        cache: see compute_patch_coordinates.
+    """
+    from masif_modules.read_data_from_surface import get_patches_from_surface, get_chemical_features
+    from input_output.patch_writer import PatchWriter
+
+    add_normals(mesh, vertex_normals)
+    n_vert = len(mesh.vertices)
+    with stage('patches', mesh_vertices=n_vert) as info:
+        centers = select_centers(mesh, features, args)
+        all_centers = np.arange(n_vert) if centers is None else centers
+        info['patches'] = len(all_centers)
+
+        chunk_size = args.chunk_size or 256
+        base_mb = rss_mb()
+        if args.max_memory_mb is not None and base_mb >= args.max_memory_mb:
+            print(f"Warning: {base_mb:.0f} MB are in use before computing the patches, over --max_memory_mb")
+        n_feat = 2 + len(get_chemical_features(features))
+        writer = PatchWriter(path, len(all_centers), args.patch_max_size, n_feat)
+        cache = {} if cache is None else cache
+        start = 0
+        per_patch = 0
+        while start < len(all_centers):
+            chunk = all_centers[start:start+chunk_size]
+            with RSSSampler() as rss, stage('chunk', patches=len(chunk)):
+                patches = get_patches_from_surface(mesh, vertex_normals, features, patch_parameters(args), centers=chunk,
+                                                   cache=cache)
+                writer.write(start, chunk, patches)
+            del patches
+            start += len(chunk)
+
+            if args.max_memory_mb is not None:
+                per_patch = max(per_patch, (rss.peak - rss.start) / len(chunk), 1e-3)
+                fits = max(int(0.8 * (args.max_memory_mb - rss.end) / per_patch), 1)
+                if rss.peak > args.max_memory_mb:
+                    fits = min(fits, max(len(chunk) // 2, 1))
+                chunk_size = fits
+            print(f"Patches: {start}/{len(all_centers)}")
+    save_centers(path, mesh, centers)
+
+
+def save_centers(path, mesh, centers):
+    # Save the vertex indices of the patch centers, if not all vertices
+    if centers is not None:
+        np.save(path.with_name(f"{path.stem}_centers"), centers)
+        n_vert = len(mesh.vertices)
+        print(f"Computed {len(centers)} patches instead of {n_vert}: compression ratio {n_vert / max(len(centers), 1):.1f}")
+
+    # Save x, y, z
+    np.save(path.with_name(f"{path.stem}_X.npy"), mesh.vertices[:,0])
+    np.save(path.with_name(f"{path.stem}_Y.npy"), mesh.vertices[:,1])
+    np.save(path.with_name(f"{path.stem}_Z.npy"), mesh.vertices[:,2])
 
 
-def get_patches(path, mesh, vertex_normals, features, patch_params):
-    # Get patches
-    input_feat, rho, theta, mask, neigh_idx = get_patches_from_surface(mesh, vertex_normals, features, patch_params)
+def save_patches(path, mesh, centers, patches):
+    input_feat, rho, theta, mask, neigh_idx = patches
+    save_centers(path, mesh, centers)
 
     # Save patches
     np.save(path.with_name(f"{path.stem}_rho_wrt_center"), rho)
@@ -81,63 +213,23 @@ def get_patches(path, mesh, vertex_normals, features, patch_params):
     np.save(path.with_name(f"{path.stem}_mask"), mask)
     np.save(path.with_name(f"{path.stem}_list_indices"), neigh_idx)
 
-    # Save x, y, z
-    np.save(path.with_name(f"{path.stem}_X.npy"), mesh.vertices[:,0])
-    np.save(path.with_name(f"{path.stem}_Y.npy"), mesh.vertices[:,1])
-    np.save(path.with_name(f"{path.stem}_Z.npy"), mesh.vertices[:,2])
-
-
-def compute_surface(args):
-
-    # Path to directory for temporary files
-    tmp_dir= Path(masif_opts['tmp_dir'])
 
-    # Path to input file
-    main_path = args.path
+def msms_arguments(args):
+    return ["-density", str(args.msms_density), "-hdensity", str(args.msms_hdensity),
+            "-probe", str(args.msms_probe)]
 
-    # Path to output folder
-    path_out = Path(args.output_dir).joinpath(f"{args.path.stem}")
-    path_out.mkdir(parents=True, exist_ok=True)
-
-    # Path for output mesh
-    path_ply = path_out.joinpath(f"{args.path.stem}.ply")
-
-    # Path template for features (and patches)
-    path_feat = path_out.joinpath(f"{args.path.stem}.npy")
-
-    # Container for features
-    features = {}
-
-    # Rewrite PDB file; extract a single chain if needed
-    ctxt = '' if args.chain == '' else f'_{args.chain}'
-    path_pdb_chain = tmp_dir.joinpath(f"{main_path.stem}{ctxt}{main_path.suffix}")
-    extractPDB(main_path, path_pdb_chain, args.chain)
-    main_path = path_pdb_chain
-
-    if args.noH:
-        # Remove hydrogens
-        path_deprotonated = tmp_dir.joinpath(f"{main_path.stem}{main_path.suffix}")
-        deprotonate(str(main_path), str(path_deprotonated))
-        main_path = path_deprotonated
-    else:
-        # Add hydrogens
-        path_protonated = tmp_dir.joinpath(f"{main_path.stem}{main_path.suffix}")
-        protonate(str(main_path), str(path_protonated))
-        main_path = path_protonated
-
-    # Compute MSMS of surface
-    msms_args = ["-density", str(args.msms_density), "-hdensity", str(args.msms_hdensity),
-                 "-probe", str(args.msms_probe)]
-    vertices, faces, normals, names, areas = computeMSMS(main_path, msms_args)
-
-    # Compute "charged" vertices
-    if args.hbond:
-        vertex_hbond = computeCharges(main_path, vertices, names)
-
-    # For each surface residue, assign the hydrophobicity of its amino acid. 
-    if args.hphob:
-        vertex_hphob = computeHydrophobicity(names)
 
+def regularize_surface(vertices, faces, names, features, args, vertex_hbond=None, vertex_hphob=None):
+    """
+    Regularize the MSMS mesh, and transfer the vertex names and
+    hbond / hphob values from the MSMS vertices to the new mesh.
+    Returns the new mesh, its vertex normals and the updated features.
+    """
+    import pymesh
+    from sklearn.neighbors import KDTree
+    from triangulation.fixmesh import fix_mesh
+    from triangulation.compute_normal import compute_normal
+    from triangulation.computeCharges import assignChargesToNewMesh
 
     # Regularize the mesh
     mesh = fix_mesh(pymesh.form_mesh(vertices, faces), args.mesh_res)
@@ -154,49 +246,162 @@ def compute_surface(args):
     features = unpack_names(names, features)
 
     # Assign hbond values to new mesh
-    if args.hbond:
+    if vertex_hbond is not None:
         vertex_hbond = assignChargesToNewMesh(mesh.vertices, vertices,\
             vertex_hbond, masif_opts, dists=dists, result=result)
         features['hbond'] = vertex_hbond
 
     # Assign hphob values to new mesh
-    if args.hphob:
+    if vertex_hphob is not None:
         vertex_hphob = assignChargesToNewMesh(mesh.vertices, vertices,\
             vertex_hphob, masif_opts, dists=dists, result=result)
         features['hphob'] = vertex_hphob
 
-    # Compute the surface charge
-    if not args.no_apbs:
-        vertex_charges = computeAPBS(mesh.vertices, main_path, tmp_dir)
-        features['charge'] = vertex_charges / 10
+    return mesh, vertex_normals, features
 
 
+def add_curvature(mesh, features):
     # Add curvature to mesh
     mesh.add_attribute("vertex_mean_curvature")
     mesh.add_attribute("vertex_gaussian_curvature")
     features['mean_curvature'] = mesh.get_attribute("vertex_mean_curvature")
     features['gaussian_curvature'] = mesh.get_attribute("vertex_gaussian_curvature")
+    return features
+
+
+def save_surface(path_ply, path_feat, mesh, vertex_normals, features, args):
+    from input_output.save_ply import save_ply
+    from geometry.geodesic_matrix import geodesic_cache, save_geodesic_cache
 
     # Save mesh and features
-    path_ply.parent.mkdir(exist_ok=True)
-    save_ply(str(path_ply), mesh)
-    save_features(path_feat, features)
+    with stage('save'):
+        path_ply.parent.mkdir(exist_ok=True)
+        save_ply(str(path_ply), mesh)
+        save_features(path_feat, features)
 
     # Decompose surface into patches
-    if args.patches:
-        patch_params = {'max_distance':args.patch_max_dist, 'max_shape_size':args.patch_max_size}
+    cache = geodesic_cache(args.geodesics) if args.patches and args.geodesics else None
+    if args.patches and (args.chunk_size is not None or args.max_memory_mb is not None):
+        stream_patches(path_feat, mesh, vertex_normals, features, args, cache=cache)
+    elif args.patches:
+        centers, patches = compute_patches(mesh, vertex_normals, features, args, cache=cache)
+        with stage('save_patches'):
+            save_patches(path_feat, mesh, centers, patches)
+    if cache is not None:
+        save_geodesic_cache(args.geodesics, cache)
+
+
+def prepare_input(path, args, tmp_dir):
+    """
+    Extract the chain and add (or, with --noH, remove) the hydrogens. Returns the path of the new file in tmp_dir.
+    """
+    from input_output.extractPDB import extractPDB
+    from input_output.protonate import protonate, deprotonate
 
-        # Add vertices to mesh
-        mesh.add_attribute("vertex_nx")
-        mesh.add_attribute("vertex_ny")
-        mesh.add_attribute("vertex_nz")
-        mesh.set_attribute("vertex_nx", vertex_normals[:,0])
-        mesh.set_attribute("vertex_ny", vertex_normals[:,1])
-        mesh.set_attribute("vertex_nz", vertex_normals[:,2])
+    # Path to input file
+    main_path = path
 
-        get_patches(path_feat, mesh, vertex_normals, features, patch_params)
+    # Rewrite PDB file; extract a single chain if needed
+    with stage('extract_pdb'):
+        ctxt = '' if args.chain == '' else f'_{args.chain}'
+        path_pdb_chain = tmp_dir.joinpath(f"{main_path.stem}{ctxt}{main_path.suffix}")
+        extractPDB(main_path, path_pdb_chain, args.chain)
+        main_path = path_pdb_chain
+
+    with stage('protonate') as info:
+        if args.noH:
+            # Remove hydrogens
+            path_deprotonated = tmp_dir.joinpath(f"{main_path.stem}{main_path.suffix}")
+            deprotonate(str(main_path), str(path_deprotonated))
+            main_path = path_deprotonated
+        else:
+            # Add hydrogens
+            path_protonated = tmp_dir.joinpath(f"{main_path.stem}{main_path.suffix}")
+            protonate(str(main_path), str(path_protonated))
+            main_path = path_protonated
+        info['atoms'] = count_atoms(main_path)
+    return main_path
+
+
+def compute_surface_data(path, args, tmp_dir, apbs_template=None, msms_slot=None, apbs_slot=None):
+    """
+    Compute the surface of the molecule in path and its features, writing intermediate files to tmp_dir.
+        apbs_template: lines of the APBS input template (see computeAPBS)
+        msms_slot, apbs_slot: context managers held while MSMS / APBS run, e.g. semaphores that bound
+            how many instances of the external programs run at once.
+    Returns the mesh, its vertex normals and the features.
+    """
+    from triangulation.computeMSMS import computeMSMS
+    from triangulation.computeCharges import computeCharges
+    from triangulation.computeHydrophobicity import computeHydrophobicity
+    from triangulation.computeAPBS import computeAPBS
+
+    msms_slot = nullcontext() if msms_slot is None else msms_slot
+    apbs_slot = nullcontext() if apbs_slot is None else apbs_slot
+
+    # Container for features
+    features = {}
+
+    main_path = prepare_input(path, args, tmp_dir)
+
+    # Compute MSMS of surface
+    with msms_slot, stage('msms') as info:
+        vertices, faces, normals, names, areas = computeMSMS(main_path, msms_arguments(args))
+        info['msms_vertices'] = len(vertices)
+
+    # Compute "charged" vertices
+    vertex_hbond = None
+    if args.hbond:
+        with stage('hbond'):
+            vertex_hbond = computeCharges(main_path, vertices, names)
+
+    # For each surface residue, assign the hydrophobicity of its amino acid. 
+    vertex_hphob = None
+    if args.hphob:
+        vertex_hphob = computeHydrophobicity(names)
+
+    # Regularize the mesh, and assign names, hbond and hphob values to the new mesh
+    with stage('regularize') as info:
+        mesh, vertex_normals, features = regularize_surface(vertices, faces, names, features, args,
+                                                            vertex_hbond=vertex_hbond, vertex_hphob=vertex_hphob)
+        info['mesh_vertices'] = len(mesh.vertices)
+
+    # Compute the surface charge
+    if not args.no_apbs:
+        with apbs_slot, stage('apbs', mesh_vertices=len(mesh.vertices)):
+            vertex_charges = computeAPBS(mesh.vertices, main_path, tmp_dir, apbs_template)
+        features['charge'] = vertex_charges / 10
+
+    with stage('curvature'):
+        features = add_curvature(mesh, features)
+    return mesh, vertex_normals, features
+
+
+def count_atoms(path):
+    with open(path, 'r') as f:
+        return sum(1 for line in f if line[:6] in ['ATOM  ', 'HETATM'])
+
+
+def compute_surface(args):
+    # Path to directory for temporary files
+    tmp_dir= Path(masif_opts['tmp_dir'])
+
+    # Path to output folder
+    path_out = Path(args.output_dir).joinpath(f"{args.path.stem}")
+    path_out.mkdir(parents=True, exist_ok=True)
+
+    # Path for output mesh
+    path_ply = path_out.joinpath(f"{args.path.stem}.ply")
+
+    # Path template for features (and patches)
+    path_feat = path_out.joinpath(f"{args.path.stem}.npy")
+
+    with Profiler(args.path.stem, args.profile):
+        mesh, vertex_normals, features = compute_surface_data(args.path, args, tmp_dir)
+
+        # Save mesh, features and patches
+        save_surface(path_ply, path_feat, mesh, vertex_normals, features, args)
 
 
 if __name__ == "__main__":
     compute_surface(parse_arguments())
-
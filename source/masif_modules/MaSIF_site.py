@@ -1,6 +1,8 @@
 import tensorflow as tf
 import numpy as np
 
+from masif_modules.rotation_conv import fused_rotation_conv
+
 
 class MaSIF_site:
 
@@ -73,6 +75,23 @@ class MaSIF_site:
         eps=1e-5,
         mean_gauss_activation=True,
     ):
+        if self.fused_rotations:
+            return fused_rotation_conv(
+                input_feat,
+                rho_coords,
+                theta_coords,
+                mask,
+                W_conv,
+                b_conv,
+                mu_rho,
+                sigma_rho,
+                mu_theta,
+                sigma_theta,
+                self.n_rotations,
+                eps=eps,
+                mean_gauss_activation=mean_gauss_activation,
+            )
+
         n_samples = tf.shape(rho_coords)[0]
         n_vertices = tf.shape(rho_coords)[1]
         n_feat = tf.shape(input_feat)[2]
@@ -158,6 +177,7 @@ class MaSIF_site:
         feat_mask=[1.0, 1.0, 1.0, 1.0, 1.0],
         n_conv_layers=1,
         optimizer_method="Adam",
+        fused_rotations=False,
     ):
 
         # order of the spectral filters
@@ -170,6 +190,8 @@ class MaSIF_site:
         )  # in MoNet was 0.005 with max radius=0.04 (i.e. 8 times smaller)
         self.sigma_theta_init = 1.0  # 0.25
         self.n_rotations = n_rotations
+        # Evaluate all rotations at once in the convolution layers (see rotation_conv.py)
+        self.fused_rotations = fused_rotations
         self.n_feat = int(sum(feat_mask))
         self.n_labels = 2
 
@@ -0,0 +1,198 @@
+"""
+build_ligand_tfrecords.py: Build the MaSIF-ligand records of a split (train, validation or test) from the
+precomputed patches and the ligand coordinates. The structures are processed in a process pool and
+written round-robin to n_shards files, optionally GZIP or ZLIB compressed. A manifest next to the
+shards lists the structures written to each shard and the ones skipped because they have no ligand,
+so that a later build with new structures only processes those, and writes them to new shards
+(TFRecord files cannot be appended to). Structures whose data cannot be loaded are not recorded,
+and are tried again by the next build.
+Released under an Apache License 2.0
+"""
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+LABELS_DICT = {"ADP": 1, "COA": 2, "FAD": 3, "HEM": 4, "NAD": 5, "NAP": 6, "SAM": 7}
+POCKET_RADIUS = 3.0
+
+
+def pocket_labels(xyz_coords, all_ligand_coords, all_ligand_types, labels_dict=LABELS_DICT, radius=POCKET_RADIUS):
+    """
+    (n_vertices, n_ligands) labels: the type of ligand j (see labels_dict) at the vertices within radius
+    of one of its atoms, 0 elsewhere. The atoms of all ligands are queried at once.
+    """
+    labels = np.zeros((len(xyz_coords), len(all_ligand_types)), dtype=int)
+    ligand_coords = [np.asarray(c, dtype=float).reshape(-1, 3) for c in all_ligand_coords]
+    if sum(len(c) for c in ligand_coords) == 0:
+        return labels
+    ligand_of_atom = np.repeat(np.arange(len(ligand_coords)), [len(c) for c in ligand_coords])
+    near = cKDTree(xyz_coords).query_ball_point(np.concatenate(ligand_coords), radius, return_sorted=False)
+    lengths = np.fromiter((len(p) for p in near), dtype=int, count=len(near))
+    if lengths.sum() == 0:
+        return labels
+    vertices = np.concatenate([np.asarray(p, dtype=int) for p in near])
+    ligands = np.repeat(ligand_of_atom, lengths)
+    in_pocket = np.zeros(labels.shape, dtype=bool)
+    in_pocket[vertices, ligands] = True
+    types = np.array([labels_dict[t] for t in all_ligand_types])
+    labels[in_pocket] = np.broadcast_to(types, labels.shape)[in_pocket]
+    return labels
+
+
+def load_structure(pdb, precom_dir, ligand_coord_dir):
+    """
+    The patches and pocket labels of a structure, or None if it has no ligand. Raises an exception
+    if its data is missing or cannot be read.
+    """
+    # Load precomputed data
+    input_feat = np.load(os.path.join(precom_dir, pdb + "_", "p1_input_feat.npy"))
+    rho_wrt_center = np.load(os.path.join(precom_dir, pdb + "_", "p1_rho_wrt_center.npy"))
+    theta_wrt_center = np.load(os.path.join(precom_dir, pdb + "_", "p1_theta_wrt_center.npy"))
+    mask = np.expand_dims(np.load(os.path.join(precom_dir, pdb + "_", "p1_mask.npy")), -1)
+    X = np.load(os.path.join(precom_dir, pdb + "_", "p1_X.npy"))
+    Y = np.load(os.path.join(precom_dir, pdb + "_", "p1_Y.npy"))
+    Z = np.load(os.path.join(precom_dir, pdb + "_", "p1_Z.npy"))
+    all_ligand_coords = np.load(
+        os.path.join(ligand_coord_dir, "{}_ligand_coords.npy".format(pdb.split("_")[0])), allow_pickle=True
+    )
+    all_ligand_types = np.load(
+        os.path.join(ligand_coord_dir, "{}_ligand_types.npy".format(pdb.split("_")[0]))
+    ).astype(str)
+
+    if len(all_ligand_types) == 0:
+        return None
+    xyz_coords = np.vstack([X, Y, Z]).T
+    return {
+        "input_feat": input_feat,
+        "rho_wrt_center": rho_wrt_center,
+        "theta_wrt_center": theta_wrt_center,
+        "mask": mask,
+        "pocket_labels": pocket_labels(xyz_coords, all_ligand_coords, all_ligand_types),
+    }
+
+
+def serialize_structure(job):
+    """
+    (pdb, serialized record, error) of a structure. The record is None if the structure has no ligand,
+    or if its data could not be loaded, with the error message.
+        job: (pdb, precom_dir, ligand_coord_dir, record_format, float_dtype)
+    """
+    from masif_modules.read_ligand_tfrecords import raw_example, features_example
+
+    pdb, precom_dir, ligand_coord_dir, record_format, float_dtype = job
+    try:
+        arrays = load_structure(pdb, precom_dir, ligand_coord_dir)
+    except Exception as e:
+        return pdb, None, "{}: {}".format(type(e).__name__, e)
+    if arrays is None:
+        return pdb, None, None
+    if record_format == "raw":
+        return pdb, raw_example(pdb, arrays, float_dtype=float_dtype), None
+    return pdb, features_example(pdb, arrays["input_feat"], arrays["rho_wrt_center"], arrays["theta_wrt_center"],
+                                 arrays["mask"], arrays["pocket_labels"]), None
+
+
+def manifest_path(prefix):
+    return prefix + ".manifest.json"
+
+
+def read_manifest(prefix):
+    path = manifest_path(prefix)
+    if not os.path.exists(path):
+        return {"shards": [], "skipped": []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def split_files(prefix):
+    """
+    The shard files of a split, as listed in its manifest.
+    """
+    directory = os.path.dirname(prefix)
+    return [os.path.join(directory, shard["file"]) for shard in read_manifest(prefix)["shards"]]
+
+
+def build_split(pdbs, prefix, precom_dir, ligand_coord_dir, n_shards=8, compression="", n_workers=None,
+                record_format="raw", float_dtype="float32"):
+    """
+    Write the records of the structures pdbs to n_shards files {prefix}-{part}-{shard}-of-{n_shards}.tfrecord.
+    Structures already in the manifest of the split (written, or skipped for having no ligand) are not
+    processed again; the new ones are written to the shards of a new part. Structures that fail to
+    load are reported and left out of the manifest, so the next build tries them again.
+        compression: '' (none), 'GZIP' or 'ZLIB'; the same compression_type must be given to the reader.
+    Returns the number of records written.
+    """
+    import tensorflow as tf
+
+    manifest = read_manifest(prefix)
+    done = set(manifest["skipped"])
+    for shard in manifest["shards"]:
+        done.update(shard["pdbs"])
+        # Manifests written before float_dtype was recorded have float32 shards
+        shard_dtype = shard.get("float_dtype", "float32")
+        if shard["compression"] != compression or shard["format"] != record_format or shard_dtype != float_dtype:
+            raise ValueError("{} has {} {} shards with compression '{}'".format(
+                manifest_path(prefix), shard["format"], shard_dtype, shard["compression"]))
+    new_pdbs = [pdb for pdb in pdbs if pdb not in done]
+    if len(new_pdbs) == 0:
+        print("{}: no new structures".format(prefix))
+        return 0
+
+    part = 1 + max([shard["part"] for shard in manifest["shards"]], default=-1)
+    n_shards = max(min(n_shards, len(new_pdbs)), 1)
+    shards = [
+        {
+            "file": "{}-{:03d}-{:05d}-of-{:05d}.tfrecord".format(os.path.basename(prefix), part, k, n_shards),
+            "part": part,
+            "compression": compression,
+            "format": record_format,
+            "float_dtype": float_dtype,
+            "pdbs": [],
+        }
+        for k in range(n_shards)
+    ]
+    directory = os.path.dirname(prefix)
+    options = None
+    if compression:
+        options = tf.python_io.TFRecordOptions(getattr(tf.python_io.TFRecordCompressionType, compression))
+    writers = [tf.python_io.TFRecordWriter(os.path.join(directory, s["file"]), options=options) for s in shards]
+
+    jobs = [(pdb, precom_dir, ligand_coord_dir, record_format, float_dtype) for pdb in new_pdbs]
+    pool = Pool(n_workers) if n_workers != 0 else None
+    results = pool.imap(serialize_structure, jobs) if pool is not None else map(serialize_structure, jobs)
+    written = 0
+    failed = []
+    try:
+        for i, (pdb, record, error) in enumerate(results):
+            if error is not None:
+                print("{}: {} could not be loaded ({})".format(os.path.basename(prefix), pdb, error))
+                failed.append(pdb)
+                continue
+            if record is None:
+                manifest["skipped"].append(pdb)
+                continue
+            shard = written % n_shards
+            writers[shard].write(record)
+            shards[shard]["pdbs"].append(pdb)
+            written += 1
+            print("{}: {} ({}/{})".format(os.path.basename(prefix), pdb, i + 1, len(new_pdbs)))
+    finally:
+        for writer in writers:
+            writer.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # Shards without records are removed
+    for s in shards:
+        if len(s["pdbs"]) == 0:
+            os.remove(os.path.join(directory, s["file"]))
+    manifest["shards"] += [s for s in shards if len(s["pdbs"]) > 0]
+    with open(manifest_path(prefix), "w") as f:
+        json.dump(manifest, f, indent=1)
+    print("{}: wrote {} structures, skipped {} without ligand, {} failed to load".format(
+        prefix, written, len(new_pdbs) - written - len(failed), len(failed)))
+    return written
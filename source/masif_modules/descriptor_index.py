@@ -0,0 +1,243 @@
+"""
+descriptor_index.py: Approximate nearest-neighbor search over MaSIF-search descriptors (as written by
+export_descriptors.py), to find the target patches complementary to a query patch (its flipped
+descriptor) without computing the distances to every descriptor.
+The index is an inverted file with product quantization (IVF-PQ): the descriptors are assigned to
+the nearest of n_lists coarse centroids (k-means), and the residual to that centroid is encoded as
+n_subvectors bytes, the nearest of 256 centroids of each slice of the descriptor. A query only scans
+the n_probe lists nearest to it. The squared distance of query q to the code of residual r in list c,
+|q - c|^2 + (|r|^2 + 2 c.r) - 2 q.r, is the distance to the list, a term stored with each code, and
+a sum of n_subvectors entries of a lookup table of the query (the same for all the lists). The
+candidates can be reranked with their exact distances. The index is a directory of .npy files,
+loaded memory mapped.
+The index only pays off on large corpora (hundreds of thousands of descriptors) searched many times,
+which repay its build; otherwise use exact_search (chunked matrix products), which needs no build.
+Released under an Apache License 2.0
+"""
+import json
+import os
+
+import numpy as np
+
+INDEX_ARRAYS = ["coarse", "codebooks", "codes", "ids", "terms", "offsets"]
+
+
+def squared_dists(x, centroids):
+    # (len(x), len(centroids)) squared Euclidean distances
+    d = np.sum(np.square(x), axis=1)[:,None] - 2 * x @ centroids.T + np.sum(np.square(centroids), axis=1)[None,:]
+    return np.maximum(d, 0)
+
+
+def nearest(x, centroids, chunk_size=65536):
+    # Index of the nearest centroid of each row of x, computed in chunks of rows
+    out = np.zeros(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk_size):
+        out[start:start + chunk_size] = np.argmin(squared_dists(x[start:start + chunk_size], centroids), axis=1)
+    return out
+
+
+def kmeans(x, k, n_iter=20, seed=0):
+    """
+    k centroids of the rows of x (Lloyd's algorithm from k random rows). Empty clusters are restarted
+    at random rows.
+    """
+    rng = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    if len(x) < k:
+        raise ValueError("{} vectors are not enough for {} centroids".format(len(x), k))
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = nearest(x, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        empty = counts == 0
+        order = np.argsort(assignment, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[~empty]
+        centroids[~empty] = np.add.reduceat(x[order], starts, axis=0) / counts[~empty,None]
+        centroids[empty] = x[rng.choice(len(x), empty.sum(), replace=False)]
+    return centroids
+
+
+def exact_search(database, queries, k, chunk_size=65536):
+    """
+    Exact k nearest neighbors of the queries in database: (ids, dists), each (n_queries, k), sorted by
+    distance. The database (e.g. a memory-mapped descriptor matrix) is read in chunks of rows.
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+    best_d = np.zeros((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(database), chunk_size):
+        d = squared_dists(queries, np.asarray(database[start:start + chunk_size], dtype=np.float32))
+        ids = np.broadcast_to(np.arange(start, start + d.shape[1]), d.shape)
+        best_d = np.concatenate([best_d, d], axis=1)
+        best_ids = np.concatenate([best_ids, ids], axis=1)
+        if best_d.shape[1] > k:
+            top = np.argpartition(best_d, k - 1, axis=1)[:,:k]
+            best_d = np.take_along_axis(best_d, top, axis=1)
+            best_ids = np.take_along_axis(best_ids, top, axis=1)
+    order = np.argsort(best_d, axis=1)
+    return np.take_along_axis(best_ids, order, axis=1), np.sqrt(np.take_along_axis(best_d, order, axis=1))
+
+
+class DescriptorIndex:
+    """
+    IVF-PQ index of descriptors. Build it with train and add (or build_index), save it to a directory,
+    and load it (memory mapped) with DescriptorIndex.load.
+        coarse: (n_lists, n_dims) coarse centroids
+        codebooks: (n_subvectors, 256, n_dims / n_subvectors) centroids of the residual slices
+        codes: (n, n_subvectors) uint8 codes, grouped by list; ids: (n) descriptor row of each code
+        terms: (n) |r|^2 + 2 c.r of the decoded residual r of each code, in list c
+        offsets: (n_lists + 1) first code of each list
+    """
+    def __init__(self, coarse, codebooks, codes=None, ids=None, terms=None, offsets=None):
+        self.coarse = coarse
+        self.codebooks = codebooks
+        self.codes = codes if codes is not None else np.zeros((0, len(codebooks)), dtype=np.uint8)
+        self.ids = ids if ids is not None else np.zeros(0, dtype=np.int64)
+        self.terms = terms if terms is not None else np.zeros(0, dtype=np.float32)
+        self.offsets = offsets if offsets is not None else np.zeros(len(coarse) + 1, dtype=np.int64)
+
+    @property
+    def n_subvectors(self):
+        return len(self.codebooks)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def train(cls, x, n_lists=1024, n_subvectors=16, n_iter=20, seed=0):
+        """
+        Index trained on the descriptors x (a sample of the database), without descriptors.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        if x.shape[1] % n_subvectors != 0:
+            raise ValueError("{} dimensions cannot be split in {} subvectors".format(x.shape[1], n_subvectors))
+        coarse = kmeans(x, n_lists, n_iter=n_iter, seed=seed)
+        residuals = x - coarse[nearest(x, coarse)]
+        slices = np.split(residuals, n_subvectors, axis=1)
+        codebooks = np.stack([kmeans(s, 256, n_iter=n_iter, seed=seed + j + 1) for j, s in enumerate(slices)])
+        return cls(coarse, codebooks)
+
+    def encode(self, x, lists):
+        residuals = np.asarray(x, dtype=np.float32) - self.coarse[lists]
+        return np.stack([nearest(s, c) for s, c in zip(np.split(residuals, self.n_subvectors, axis=1),
+                                                        self.codebooks)], axis=1).astype(np.uint8)
+
+    def decode(self, codes):
+        # Residuals of the codes
+        return np.concatenate([c[codes[:,j]] for j, c in enumerate(self.codebooks)], axis=1)
+
+    def add(self, x, ids=None, chunk_size=65536):
+        """
+        Add the descriptors x, with ids (default: the rows following the last added ones).
+        """
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(x))
+        lists, codes, terms = [], [], []
+        for start in range(0, len(x), chunk_size):
+            chunk = np.asarray(x[start:start + chunk_size], dtype=np.float32)
+            lists.append(nearest(chunk, self.coarse))
+            codes.append(self.encode(chunk, lists[-1]))
+            r = self.decode(codes[-1])
+            terms.append(np.sum(r * (r + 2 * self.coarse[lists[-1]]), axis=1).astype(np.float32))
+        old_lists = np.repeat(np.arange(len(self.coarse)), np.diff(self.offsets))
+        lists = np.concatenate([old_lists] + lists)
+        codes = np.concatenate([np.asarray(self.codes)] + codes)
+        terms = np.concatenate([np.asarray(self.terms)] + terms)
+        ids = np.concatenate([np.asarray(self.ids), np.asarray(ids, dtype=np.int64)])
+        order = np.argsort(lists, kind="stable")
+        self.codes, self.ids, self.terms = codes[order], ids[order], terms[order]
+        self.offsets = np.zeros(len(self.coarse) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lists, minlength=len(self.coarse)), out=self.offsets[1:])
+
+    def search(self, queries, k=10, n_probe=16, database=None, n_rerank=None):
+        """
+        Approximate k nearest descriptors of each query: (ids, dists), each (n_queries, k), sorted by
+        distance, with id -1 where fewer than k descriptors were scanned. With the database (the
+        descriptor matrix), the n_rerank (default 4*k) best candidates are reranked by their exact distance.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n_candidates = k if database is None else max(n_rerank or 4 * k, k)
+        out_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        out_dists = np.full((len(queries), k), np.inf, dtype=np.float32)
+        list_dists = squared_dists(queries, self.coarse)
+        probes = np.argsort(list_dists, axis=1)[:,:n_probe]
+        # -2 q.r of each slice of the query and codebook centroid: n_queries, n_subvectors, 256
+        tables = -2 * np.einsum("qjd,jcd->qjc", queries.reshape(len(queries), self.n_subvectors, -1), self.codebooks)
+        subvectors = np.arange(self.n_subvectors)
+        for q, query in enumerate(queries):
+            starts, ends = self.offsets[probes[q]], self.offsets[probes[q] + 1]
+            lengths = ends - starts
+            if lengths.sum() == 0:
+                continue
+            # Positions of the codes of all the probed lists
+            pos = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            ids = np.asarray(self.ids[pos])
+            dists = (np.repeat(list_dists[q, probes[q]], lengths) + self.terms[pos]
+                     + tables[q][subvectors, np.asarray(self.codes[pos])].sum(axis=1))
+            if len(ids) > n_candidates:
+                top = np.argpartition(dists, n_candidates - 1)[:n_candidates]
+                ids, dists = ids[top], dists[top]
+            if database is not None:
+                rows = np.sort(ids)
+                exact = np.sum(np.square(np.asarray(database[rows], dtype=np.float32) - query), axis=1)
+                ids, dists = rows, exact
+            order = np.argsort(dists)[:k]
+            out_ids[q,:len(order)] = ids[order]
+            out_dists[q,:len(order)] = np.sqrt(dists[order])
+        return out_ids, out_dists
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(index_dir, name + ".npy"), np.asarray(getattr(self, name)))
+        with open(os.path.join(index_dir, "index.json"), "w") as f:
+            json.dump({"n": len(self), "n_lists": len(self.coarse), "n_subvectors": self.n_subvectors,
+                       "n_dims": self.coarse.shape[1]}, f)
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode="r"):
+        """
+        Index saved in index_dir; the codes, ids and terms are memory mapped unless mmap_mode is None.
+        """
+        arrays = {name: np.load(os.path.join(index_dir, name + ".npy"),
+                                mmap_mode=mmap_mode if name in ["codes", "ids", "terms"] else None)
+                  for name in INDEX_ARRAYS}
+        return cls(**arrays)
+
+
+def build_index(desc_dir, index_dir=None, key="straight", n_lists=None, n_subvectors=16, n_train=200000, seed=0):
+    """
+    Index of the descriptors of an export (the target descriptors desc_straight.npy by default), saved
+    to index_dir (default: desc_dir/index_{key}). The coarse centroids and codebooks are trained on
+    n_train random descriptors; n_lists defaults to about 4*sqrt(n).
+    """
+    from masif_modules.export_descriptors import DESC_FILES
+
+    desc = np.load(os.path.join(desc_dir, DESC_FILES[key]), mmap_mode="r")
+    if n_lists is None:
+        n_lists = int(min(max(4 * np.sqrt(len(desc)), 1), len(desc) // 39 + 1))
+    rng = np.random.RandomState(seed)
+    sample = desc[np.sort(rng.choice(len(desc), min(n_train, len(desc)), replace=False))]
+    index = DescriptorIndex.train(sample, n_lists=n_lists, n_subvectors=n_subvectors, seed=seed)
+    index.add(desc)
+    index.save(index_dir or os.path.join(desc_dir, "index_{}".format(key)))
+    return index
+
+
+def patches_of(desc_dir, ids):
+    """
+    (protein name, vertex) of descriptor rows ids of an export; rows -1 give (None, -1).
+    """
+    with open(os.path.join(desc_dir, "index.json")) as f:
+        names = json.load(f)["proteins"]
+    offsets = np.load(os.path.join(desc_dir, "offsets.npy"))
+    protein_index = np.load(os.path.join(desc_dir, "protein_index.npy"), mmap_mode="r")
+    ids = np.asarray(ids)
+    out = []
+    for i in ids.ravel():
+        if i < 0:
+            out.append((None, -1))
+        else:
+            p = int(protein_index[i])
+            out.append((names[p], int(i - offsets[p])))
+    return out
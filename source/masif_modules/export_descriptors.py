@@ -0,0 +1,233 @@
+"""
+export_descriptors.py: Compute the MaSIF-search descriptors of every vertex of every protein of a corpus
+with a trained MaSIF_ppi_search model, e.g. for screening. The proteins are streamed through the model
+in batches, and the descriptors written to two memory-mapped .npy matrices (float32 or float16):
+desc_straight.npy (the target descriptors) and desc_flipped.npy (the binder descriptors, with the
+features and theta flipped as in construct_batch_val_test). protein_index.npy gives the protein of each
+row, offsets.npy the first row of each protein, and index.json the names of the proteins and the
+progress, so that an interrupted export resumes after the last protein written.
+The batch size is halved whenever the model runs out of memory.
+
+    python -m masif_modules.export_descriptors --list lists/testing.txt --out_dir descriptors/corpus/
+
+Released under an Apache License 2.0
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+DESC_FILES = {"straight": "desc_straight.npy", "flipped": "desc_flipped.npy"}
+
+
+def corpus_proteins(ppi_pair_ids, precomp_dir):
+    """
+    (name, directory, pid) of the precomputed proteins (p1, and p2 if it exists) of each ppi_pair_id.
+    """
+    proteins = []
+    for ppi_pair_id in ppi_pair_ids:
+        mydir = os.path.join(precomp_dir, ppi_pair_id, "")
+        for pid in ["p1", "p2"]:
+            if os.path.exists(mydir + pid + "_rho_wrt_center.npy"):
+                proteins.append(("{}_{}".format(ppi_pair_id, pid), mydir, pid))
+        if not os.path.exists(mydir + "p1_rho_wrt_center.npy"):
+            print("{}: no precomputed patches, skipped".format(ppi_pair_id))
+    return proteins
+
+
+def load_search_arrays(mydir, pid, feat_mask):
+    # rho, theta, input features and mask of the patches of a protein, memory mapped
+    from masif_modules.train_masif_site import mask_input_feat
+
+    rho_wrt_center = np.load(mydir + pid + "_rho_wrt_center.npy", mmap_mode="r")
+    theta_wrt_center = np.load(mydir + pid + "_theta_wrt_center.npy", mmap_mode="r")
+    input_feat = np.load(mydir + pid + "_input_feat.npy", mmap_mode="r")
+    if np.sum(feat_mask) < 5:
+        input_feat = mask_input_feat(input_feat, feat_mask)
+    mask = np.load(mydir + pid + "_mask.npy", mmap_mode="r")
+    return rho_wrt_center, theta_wrt_center, input_feat, mask
+
+
+def n_patches(mydir, pid):
+    return np.load(mydir + pid + "_mask.npy", mmap_mode="r").shape[0]
+
+
+def initial_batch_size(learning_obj, max_verts, max_memory_mb=None, default=1000):
+    """
+    Number of patches per batch: as many as fit in max_memory_mb (see site_bytes_per_patch), or default.
+    """
+    if max_memory_mb is None:
+        return default
+    from masif_modules.train_masif_site import site_bytes_per_patch
+
+    return max(int(max_memory_mb * 2**20 // site_bytes_per_patch(learning_obj, max_verts)), 1)
+
+
+class DescriptorWriter:
+    """
+    The descriptor matrices and index of an export in out_dir. An existing export of the same proteins,
+    descriptor size and dtype is reopened, with completed the number of proteins already written;
+    otherwise a new one is created.
+    """
+    def __init__(self, out_dir, names, sizes, n_dims, dtype="float32"):
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+        self.index = {"proteins": list(names), "n_dims": int(n_dims), "dtype": dtype, "completed": 0,
+                      "batch_size": None}
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        n_rows = int(self.offsets[-1])
+
+        stored = self.read_index()
+        resume = stored is not None and all(stored[k] == self.index[k] for k in ["proteins", "n_dims", "dtype"])
+        if resume:
+            self.index = stored
+            self.desc = {key: np.load(self.path(f), mmap_mode="r+") for key, f in DESC_FILES.items()}
+            resume = all(d.shape == (n_rows, n_dims) for d in self.desc.values())
+        if not resume:
+            self.desc = {
+                key: np.lib.format.open_memmap(self.path(f), mode="w+", dtype=dtype, shape=(n_rows, n_dims))
+                for key, f in DESC_FILES.items()
+            }
+            np.save(self.path("offsets.npy"), self.offsets)
+            np.save(self.path("protein_index.npy"),
+                    np.repeat(np.arange(len(names), dtype=np.int32), np.diff(self.offsets)))
+            self.write_index()
+
+    @property
+    def completed(self):
+        return self.index["completed"]
+
+    def path(self, name):
+        return os.path.join(self.out_dir, name)
+
+    def read_index(self):
+        if not os.path.exists(self.path("index.json")):
+            return None
+        with open(self.path("index.json")) as f:
+            return json.load(f)
+
+    def write_index(self):
+        # Written to a temporary file and renamed, so an interruption leaves the previous index
+        with open(self.path("index.json.tmp"), "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.path("index.json.tmp"), self.path("index.json"))
+
+    def write(self, i, descs, batch_size):
+        """
+        Write the descriptors {'straight': ..., 'flipped': ...} of protein i, and mark it completed.
+        """
+        assert i == self.completed
+        for key, values in descs.items():
+            self.desc[key][self.offsets[i]:self.offsets[i + 1]] = values
+            self.desc[key].flush()
+        self.index["completed"] = i + 1
+        self.index["batch_size"] = batch_size
+        self.write_index()
+
+
+def protein_descriptors(learning_obj, arrays, batch_size, flip=False):
+    """
+    Descriptors (n_patches, n_dims) of all the patches of a protein, in batches of at most batch_size
+    patches; the batch size is halved when the model runs out of memory. Returns the descriptors and
+    the batch size that fits.
+    """
+    import tensorflow as tf
+    from masif_modules.train_ppi_search import construct_batch_val_test
+
+    rho_wrt_center, theta_wrt_center, input_feat, mask = arrays
+    n = len(mask)
+    descs = np.zeros((n, learning_obj.global_desc.get_shape().as_list()[-1]), dtype=np.float32)
+    start = 0
+    while start < n:
+        rows = np.arange(start, min(start + batch_size, n))
+        batch_rho_coords, batch_theta_coords, batch_input_feat, batch_mask = construct_batch_val_test(
+            rows, rho_wrt_center, theta_wrt_center, input_feat, mask, flip=flip
+        )
+        feed_dict = {
+            learning_obj.rho_coords: batch_rho_coords,
+            learning_obj.theta_coords: batch_theta_coords,
+            learning_obj.input_feat: batch_input_feat,
+            learning_obj.mask: batch_mask,
+            learning_obj.keep_prob: 1.0,
+        }
+        try:
+            descs[rows] = learning_obj.session.run(learning_obj.global_desc, feed_dict=feed_dict)
+        except tf.errors.ResourceExhaustedError:
+            if batch_size == 1:
+                raise
+            batch_size = max(batch_size // 2, 1)
+            print("Out of memory, batch size reduced to {}".format(batch_size))
+            continue
+        start += len(rows)
+    return descs, batch_size
+
+
+def export_descriptors(learning_obj, proteins, out_dir, feat_mask, dtype="float32", batch_size=None,
+                       max_memory_mb=None):
+    """
+    Export the straight and flipped descriptors of proteins, a list of (name, directory, pid), to out_dir
+    (see DescriptorWriter), resuming an interrupted export. Without batch_size, the batch size is
+    set from max_memory_mb (see initial_batch_size), or taken from the interrupted export.
+    Returns the DescriptorWriter.
+    """
+    sizes = [n_patches(mydir, pid) for _, mydir, pid in proteins]
+    n_dims = learning_obj.global_desc.get_shape().as_list()[-1]
+    writer = DescriptorWriter(out_dir, [name for name, _, _ in proteins], sizes, n_dims, dtype=dtype)
+    if writer.completed > 0:
+        print("Resuming after {} of {} proteins".format(writer.completed, len(proteins)))
+    if batch_size is None:
+        batch_size = writer.index["batch_size"]
+    for i in range(writer.completed, len(proteins)):
+        name, mydir, pid = proteins[i]
+        arrays = load_search_arrays(mydir, pid, feat_mask)
+        if batch_size is None:
+            batch_size = initial_batch_size(learning_obj, arrays[3].shape[1], max_memory_mb)
+        descs = {}
+        for key in ["straight", "flipped"]:
+            descs[key], batch_size = protein_descriptors(learning_obj, arrays, batch_size, flip=key == "flipped")
+        writer.write(i, descs, batch_size)
+        print("{}: {} descriptors ({}/{})".format(name, sizes[i], i + 1, len(proteins)))
+    return writer
+
+
+def parse_arguments():
+    from default_config.masif_opts import masif_opts
+
+    params = masif_opts["ppi_search"]
+    parser = argparse.ArgumentParser(description="Export the MaSIF-search descriptors of a corpus of proteins")
+    parser.add_argument("--list", default=params["testing_list"], help="File with one ppi_pair_id per line")
+    parser.add_argument("--precomp_dir", default=params["masif_precomputation_dir"], help="Directory of the precomputed patches")
+    parser.add_argument("--model_dir", default=params["model_dir"], help="Directory of the trained model")
+    parser.add_argument("--out_dir", default=os.path.join(params["desc_dir"], "corpus"), help="Output directory")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"], help="Type of the stored descriptors")
+    parser.add_argument("--batch_size", type=int, default=None, help="Patches per batch (default: from --max_memory_mb)")
+    parser.add_argument("--max_memory_mb", type=float, default=None, help="Memory for the activations of a batch")
+    parser.add_argument("--gpu", default="/device:GPU:0", help="Device of the model")
+    return parser.parse_args()
+
+
+def main(args):
+    from default_config.masif_opts import masif_opts
+    from masif_modules.MaSIF_ppi_search import MaSIF_ppi_search
+
+    params = masif_opts["ppi_search"]
+    with open(args.list) as f:
+        ppi_pair_ids = [line.strip() for line in f if line.strip()]
+    proteins = corpus_proteins(ppi_pair_ids, args.precomp_dir)
+
+    learning_obj = MaSIF_ppi_search(
+        params["max_distance"],
+        n_thetas=16,
+        n_rhos=5,
+        n_rotations=16,
+        idx_gpu=args.gpu,
+        feat_mask=params["feat_mask"],
+    )
+    learning_obj.saver.restore(learning_obj.session, os.path.join(args.model_dir, "model"))
+    export_descriptors(learning_obj, proteins, args.out_dir, params["feat_mask"], dtype=args.dtype,
+                       batch_size=args.batch_size, max_memory_mb=args.max_memory_mb)
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
@@ -0,0 +1,245 @@
+"""
+numpy_inference.py: Run trained MaSIF-site, MaSIF-search and MaSIF-ligand models with NumPy only, e.g.
+in batch workers where importing TensorFlow and building the TF1 graph is too slow.
+export_model writes the variables of a trained model (the Gaussian kernels mu_rho, sigma_rho, mu_theta
+and sigma_theta, W_conv and b_conv of each convolution layer, and the fully connected layers) to a
+compressed .npz file, and NumpyMaSIF reproduces the outputs of the model from it: the convolution
+layer is the one of rotation_conv.py, with all the rotations evaluated at once as batched matrix
+products, and the fully connected layers follow the graphs of MaSIF_site.py, MaSIF_ppi_search.py and
+MaSIF_ligand.py. The batches can be run in several threads (NumPy releases the GIL, and the matrix
+products run on the BLAS threads).
+
+    export_model(learning_obj, "nn_models/sc05/all_feat/model_data/model.npz")   # with TensorFlow
+    model = NumpyMaSIF.load("nn_models/sc05/all_feat/model_data/model.npz")      # NumPy only
+    desc = model.global_desc(rho_wrt_center, theta_wrt_center, input_feat, mask)
+
+Released under an Apache License 2.0
+"""
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+KINDS = {"MaSIF_site": "site", "MaSIF_ppi_search": "ppi_search", "MaSIF_ligand": "ligand"}
+KERNEL_NAMES = ["mu_rho", "sigma_rho", "mu_theta", "sigma_theta"]
+EPS = 1e-5
+
+
+def fc_layer_number(name):
+    # Creation order of the layers of tf.contrib.layers.fully_connected: fully_connected, fully_connected_1, ...
+    match = re.match(r"^fully_connected(?:_(\d+))?/weights$", name)
+    if match is None:
+        return None
+    return int(match.group(1) or 0)
+
+
+def export_model(learning_obj, path):
+    """
+    Write the variables of a MaSIF_site, MaSIF_ppi_search or MaSIF_ligand model (e.g. after
+    learning_obj.saver.restore) to the .npz file path, for NumpyMaSIF.
+    The kernels of the second to fourth layers of MaSIF_site are read from the attributes of the model
+    (mu_rho_l2, sigma_rho_l2, ...), which are the arguments of inference: the TF variables of
+    sigma_rho_l2 and mu_theta_l2 are named mu_theta_l2 and sigma_rho_l2 (and the same for l3 and l4),
+    so they cannot be matched by name in a checkpoint.
+    """
+    import tensorflow as tf
+
+    kind = KINDS[type(learning_obj).__name__]
+    with learning_obj.graph.as_default():
+        variables = {v.op.name: v for v in tf.global_variables()}
+    n_feat = learning_obj.n_feat
+
+    fetches = {name: getattr(learning_obj, name) for name in KERNEL_NAMES}
+    fetches["W_conv"] = [variables["W_conv_{}".format(i)] for i in range(n_feat)]
+    fetches["b_conv"] = [variables["b_conv_{}".format(i)] for i in range(n_feat)]
+    n_conv_layers = 1
+    for layer in ["l2", "l3", "l4"]:
+        if not hasattr(learning_obj, "mu_rho_" + layer):
+            break
+        for name in KERNEL_NAMES:
+            fetches["{}_{}".format(name, layer)] = getattr(learning_obj, "{}_{}".format(name, layer))
+        fetches["W_conv_" + layer] = variables["W_conv_" + layer]
+        fetches["b_conv_" + layer] = variables["b_conv_" + layer]
+        n_conv_layers += 1
+    fc_layers = sorted((fc_layer_number(name), name) for name in variables if fc_layer_number(name) is not None)
+    for j, (_, name) in enumerate(fc_layers):
+        fetches["fc_weights_{}".format(j)] = variables[name]
+        fetches["fc_biases_{}".format(j)] = variables[name.replace("/weights", "/biases")]
+
+    values = learning_obj.session.run(fetches)
+    arrays = {name: np.asarray(value, dtype=np.float32) for name, value in values.items()}
+    arrays.update(
+        kind=np.array(kind),
+        n_rotations=np.array(learning_obj.n_rotations),
+        n_conv_layers=np.array(n_conv_layers),
+        n_fc_layers=np.array(len(fc_layers)),
+    )
+    with open(path, "wb") as f:
+        np.savez_compressed(f, **arrays)
+
+
+def rotation_offsets(n_rotations):
+    # Rotation angle of each rotation, as in rotation_conv.py
+    return (np.arange(n_rotations) * 2 * np.pi / n_rotations).astype(np.float32)
+
+
+def relu(x):
+    return np.maximum(x, 0)
+
+
+def rotation_conv(input_feat, rho_coords, theta_coords, mask, W_conv, b_conv, mu_rho, sigma_rho, mu_theta,
+                  sigma_theta, n_rotations, eps=EPS, mean_gauss_activation=True):
+    """
+    Output of a convolution layer, as fused_rotation_conv in rotation_conv.py.
+        input_feat: batch_size, n_vertices, n_feat
+        rho_coords, theta_coords, mask: batch_size, n_vertices, 1
+        W_conv, b_conv: weights (n_feat*n_gauss, n_out) and bias (n_out) of the linear layer
+        mu_rho, sigma_rho, mu_theta, sigma_theta: 1, n_gauss
+    Returns: batch_size, n_out
+    """
+    n_samples, n_vertices, n_feat = input_feat.shape
+    rho_coords_ = np.exp(-np.square(rho_coords - mu_rho) / (np.square(sigma_rho) + eps))  # batch_size, n_vertices, n_gauss
+
+    thetas_coords_ = np.mod(theta_coords[None] + rotation_offsets(n_rotations)[:,None,None,None], np.float32(2 * np.pi))
+    thetas_coords_ = np.exp(
+        -np.square(thetas_coords_ - mu_theta) / (np.square(sigma_theta) + eps)
+    )  # n_rotations, batch_size, n_vertices, n_gauss
+
+    gauss_activations = thetas_coords_
+    gauss_activations *= rho_coords_ * mask
+    if mean_gauss_activation:  # computes mean weights for the different gaussians
+        gauss_activations /= np.sum(gauss_activations, axis=2, keepdims=True) + eps
+
+    gauss_desc = np.matmul(
+        np.swapaxes(input_feat, 1, 2)[None], gauss_activations
+    )  # n_rotations, batch_size, n_feat, n_gauss
+    gauss_desc = gauss_desc.reshape(n_rotations * n_samples, -1)  # n_rotations*batch_size, n_feat*n_gauss
+
+    conv_feat = gauss_desc @ W_conv + b_conv
+    conv_feat = conv_feat.reshape(n_rotations, n_samples, -1).max(axis=0)
+    return relu(conv_feat)
+
+
+def patch_array(x):
+    # batch_size, n_vertices, 1 float32 array of rho, theta or mask (also given as batch_size, n_vertices)
+    x = np.asarray(x, dtype=np.float32)
+    return x[:,:,None] if x.ndim == 2 else x
+
+
+class NumpyMaSIF:
+    """
+    A model exported by export_model. The patches are given as in the feed_dict of the TF models:
+    rho_wrt_center, theta_wrt_center and mask (n_patches, n_vertices) or (n_patches, n_vertices, 1), and
+    input_feat (n_patches, n_vertices, n_feat) with the features of feat_mask only. The patches are
+    processed batch_size at a time, in n_threads threads.
+    """
+    def __init__(self, arrays, batch_size=256, n_threads=1):
+        self.kind = str(arrays["kind"])
+        self.n_rotations = int(arrays["n_rotations"])
+        self.n_conv_layers = int(arrays["n_conv_layers"])
+        self.arrays = {name: np.asarray(arrays[name]) for name in arrays}
+        self.n_feat = len(self.arrays["W_conv"])
+        self.fc = [(self.arrays["fc_weights_{}".format(j)], self.arrays["fc_biases_{}".format(j)])
+                   for j in range(int(arrays["n_fc_layers"]))]
+        self.batch_size = batch_size
+        self.n_threads = n_threads
+
+    @classmethod
+    def load(cls, path, batch_size=256, n_threads=1):
+        with np.load(path) as f:
+            return cls({name: f[name] for name in f.files}, batch_size=batch_size, n_threads=n_threads)
+
+    def map_batches(self, func, n):
+        # Concatenated func(batch) over the batches of range(n)
+        batches = [slice(start, min(start + self.batch_size, n)) for start in range(0, n, self.batch_size)]
+        if not batches:
+            return func(slice(0, 0))
+        if self.n_threads > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(self.n_threads) as pool:
+                out = list(pool.map(func, batches))
+        else:
+            out = [func(batch) for batch in batches]
+        return np.concatenate(out, axis=0)
+
+    def kernels(self, layer=None, i=None):
+        # mu_rho, sigma_rho, mu_theta, sigma_theta of feature i of the first layer, or of layer 'l2', ...
+        if layer is None:
+            return [self.arrays[name][i] for name in KERNEL_NAMES]
+        return [self.arrays["{}_{}".format(name, layer)] for name in KERNEL_NAMES]
+
+    def first_layer(self, rho_wrt_center, theta_wrt_center, input_feat, mask):
+        """
+        Output of the convolution layer of each input feature: n_patches, n_feat*n_gauss.
+        """
+        rho_wrt_center, theta_wrt_center, mask = [patch_array(x) for x in [rho_wrt_center, theta_wrt_center, mask]]
+
+        def run(batch):
+            feat = np.asarray(input_feat[batch], dtype=np.float32)
+            return np.concatenate([
+                rotation_conv(feat[:,:,i:i+1], rho_wrt_center[batch], theta_wrt_center[batch], mask[batch],
+                              self.arrays["W_conv"][i], self.arrays["b_conv"][i], *self.kernels(i=i),
+                              n_rotations=self.n_rotations)
+                for i in range(self.n_feat)
+            ], axis=1)
+
+        return self.map_batches(run, len(mask))
+
+    def dense(self, x, j, activation=relu):
+        W, b = self.fc[j]
+        return activation(x @ W + b)
+
+    def global_desc(self, rho_wrt_center, theta_wrt_center, input_feat, mask):
+        """
+        MaSIF-search descriptors (global_desc of MaSIF_ppi_search): n_patches, n_thetas*n_rhos.
+        Flip the binder patches as in construct_batch_val_test.
+        """
+        assert self.kind == "ppi_search"
+        desc = self.first_layer(rho_wrt_center, theta_wrt_center, input_feat, mask)
+        return self.dense(desc, 0, activation=lambda x: x)
+
+    def site_logits(self, rho_wrt_center, theta_wrt_center, input_feat, mask, indices=None):
+        """
+        logits of MaSIF_site for all the patches of a protein: n_patches, 2. With more than one
+        convolution layer, indices (the padded list_indices, as indices_tensor) gives the members of each patch.
+        """
+        assert self.kind == "site"
+        rho_wrt_center, theta_wrt_center, mask = [patch_array(x) for x in [rho_wrt_center, theta_wrt_center, mask]]
+        desc = self.first_layer(rho_wrt_center, theta_wrt_center, input_feat, mask)
+        desc = self.dense(self.dense(desc, 0), 1)
+        for layer in ["l2", "l3", "l4"][:self.n_conv_layers - 1]:
+            desc = self.site_layer(desc, indices, rho_wrt_center, theta_wrt_center, mask, layer)
+        desc = self.dense(desc, 2)
+        return self.dense(desc, 3, activation=lambda x: x)
+
+    def site_layer(self, desc, indices, rho_wrt_center, theta_wrt_center, mask, layer):
+        n_gauss = self.arrays["W_conv"].shape[1]
+
+        def run(batch):
+            # Rebuild a patch from the output of the previous layer
+            out = rotation_conv(desc[indices[batch]], rho_wrt_center[batch], theta_wrt_center[batch], mask[batch],
+                                self.arrays["W_conv_" + layer], self.arrays["b_conv_" + layer],
+                                *self.kernels(layer=layer), n_rotations=self.n_rotations)
+            if layer == "l4":
+                return out.reshape(len(out), n_gauss, n_gauss).max(axis=2)
+            # Reduce the dimensionality by averaging over the last dimension
+            return out.reshape(len(out), -1, n_gauss).mean(axis=2)
+
+        return self.map_batches(run, len(mask))
+
+    def site_scores(self, rho_wrt_center, theta_wrt_center, input_feat, mask, indices=None):
+        """
+        Interface score of each patch (full_score of MaSIF_site).
+        """
+        logits = self.site_logits(rho_wrt_center, theta_wrt_center, input_feat, mask, indices)
+        return 1 / (1 + np.exp(-logits[:,0]))
+
+    def ligand_probabilities(self, rho_wrt_center, theta_wrt_center, input_feat, mask):
+        """
+        Probability of each ligand type for a pocket (logits_softmax of MaSIF_ligand), from its patches.
+        """
+        assert self.kind == "ligand"
+        desc = self.dense(self.first_layer(rho_wrt_center, theta_wrt_center, input_feat, mask), 0)
+        desc = (desc.T @ desc / np.float32(len(desc))).reshape(1, -1)
+        logits = self.dense(self.dense(desc, 1), 2, activation=lambda x: x)[0]
+        logits = np.exp(logits - logits.max())
+        return logits / logits.sum()
@@ -1,17 +1,20 @@
 # coding: utf-8
 # ## Imports and helper functions
 from IPython.core.debugger import set_trace
-import pymesh
 import time
 import numpy as np
 
-from geometry.compute_polar_coordinates import compute_polar_coordinates
-from input_output.save_ply import save_ply
+from geometry.compute_polar_coordinates import compute_polar_coordinates, update_polar_coordinates
+from masif_modules.surface import Surface
+from profiling import stage
 
 from sklearn import metrics
 
-def get_patches_from_surface(mesh, normals, features, params):
+def get_patches_from_surface(mesh, normals, features, params, centers=None, cache=None):
     """
+    # centers: vertex indices of the patch centers (see geometry.patch_centers.resolve_centers);
+    #          all vertices if None. Outputs have one row per center.
+    # cache: kept between calls on the same mesh (see compute_patch_coordinates).
     # Returns: 
     # list_desc: List of features per patch
     # list_coords: list of angular and polar coordinates.
@@ -20,8 +23,53 @@ def get_patches_from_surface(mesh, normals, features, params):
     """
 
     # Compute the angular and radial coordinates. 
-    rho, theta, neigh_indices, mask = compute_polar_coordinates(mesh, radius=params['max_distance'], max_vertices=params['max_shape_size'])
+    with stage('polar_coordinates'):
+        rho, theta, neigh_indices, mask = compute_polar_coordinates(mesh, radius=params['max_distance'], max_vertices=params['max_shape_size'],
+                                                                    centers=centers, geodesic=params.get('geodesic', 'dijkstra'),
+                                                                    cache=cache)
 
+    # Get the principal curvature components for the shape index. 
+    si = compute_shape_index(mesh)
+
+    # Get chemical features
+    FEAT = get_chemical_features(features)
+
+    # Compute the input features for each patch.
+    with stage('input_feat', patches=len(neigh_indices)):
+        input_feat = compute_input_feat(mesh.vertices, normals, si, FEAT, rho, mask, neigh_indices, params['max_shape_size'],
+                                        centers=centers)
+        
+    return input_feat, rho, theta, mask, neigh_indices 
+
+
+def update_patches_from_surface(mesh, normals, features, params, old_mesh, old_input_feat, old_rho, old_theta, old_mask, old_neigh_indices):
+    """
+    Update the patches of old_mesh for a new mesh where only part of the surface moved
+    (see update_polar_coordinates). The coordinates and the distance-dependent curvature are
+    only recomputed for the patches that changed; the shape index and chemical features
+    are gathered from the new surface for all patches.
+    # Returns: input_feat, rho, theta, mask, neigh_indices, as get_patches_from_surface
+    """
+    rho, theta, neigh_indices, mask, recomputed, old_of_new = update_polar_coordinates(
+        mesh, old_mesh, old_rho, old_theta, old_neigh_indices, old_mask,
+        radius=params['max_distance'], max_vertices=params['max_shape_size'],
+        geodesic=params.get('geodesic', 'dijkstra'))
+
+    # Reuse the distance-dependent curvature of unchanged patches.
+    recompute = np.zeros(len(mesh.vertices), dtype=bool)
+    recompute[recomputed] = True
+    prev_ddc = np.zeros((len(mesh.vertices), params['max_shape_size']))
+    prev_ddc[~recompute] = old_input_feat[old_of_new[~recompute], :, 1]
+
+    si = compute_shape_index(mesh)
+    FEAT = get_chemical_features(features)
+    input_feat = compute_input_feat(mesh.vertices, normals, si, FEAT, rho, mask, neigh_indices, params['max_shape_size'],
+                                    prev_ddc=prev_ddc, recompute=recompute)
+
+    return input_feat, rho, theta, mask, neigh_indices
+
+
+def compute_shape_index(mesh):
     # Get the principal curvature components for the shape index. 
     H = mesh.get_attribute("vertex_mean_curvature")
     K = mesh.get_attribute("vertex_gaussian_curvature")
@@ -34,7 +82,10 @@ def get_patches_from_surface(mesh, normals, features, params):
     # Compute the shape index 
     si = (k1+k2)/(k1-k2)
     si = np.arctan(si)*(2/np.pi)
+    return si
+
 
+def get_chemical_features(features):
     # Get chemical features
     FEAT = []
     for name in ['charge', 'hphob', 'hbond']:
@@ -45,255 +96,63 @@ def get_patches_from_surface(mesh, normals, features, params):
                 FEAT.append(normalize_electrostatics(features[name]))
             else:
                 FEAT.append(features[name])
+    return FEAT
 
-    # n: number of patches, equal to the number of vertices.
-    n = len(mesh.vertices)
+
+def compute_input_feat(vertices, normals, si, FEAT, rho, mask, neigh_indices, max_shape_size, prev_ddc=None, recompute=None,
+                       centers=None):
+    """
+    Compute the input features (shape index, ddc and chemical features) of each patch.
+        prev_ddc, recompute: if given, the ddc is only computed for patches where recompute is True,
+            and taken from prev_ddc for the rest.
+        centers: the center vertex of each patch, if patches are not centered on every vertex.
+    """
+    # n: number of patches
+    n = len(neigh_indices)
+    if centers is None:
+        centers = np.arange(n)
     
-    input_feat = np.zeros((n, params['max_shape_size'], 2 + len(FEAT)))
+    input_feat = np.zeros((n, max_shape_size, 2 + len(FEAT)))
 
     # Compute the input features for each patch.
-    for vix in range(n):
+    for k, vix in enumerate(centers):
         # Patch members.
-        neigh_vix = np.array(neigh_indices[vix])
-
-        # Compute the distance-dependent curvature for all neighbors of the patch. 
-        patch_v = mesh.vertices[neigh_vix]
-        patch_n = normals[neigh_vix]
-        patch_cp = np.where(neigh_vix == vix)[0][0] # central point
-        mask_pos = np.where(mask[vix] == 1.0)[0] # nonzero elements
-        patch_rho = rho[vix][mask_pos] # nonzero elements of rho
-        ddc = compute_ddc(patch_v, patch_n, patch_cp, patch_rho)        
+        neigh_vix = np.array(neigh_indices[k])
+
+        if prev_ddc is None or recompute[k]:
+            # Compute the distance-dependent curvature for all neighbors of the patch. 
+            patch_v = vertices[neigh_vix]
+            patch_n = normals[neigh_vix]
+            patch_cp = np.where(neigh_vix == vix)[0][0] # central point
+            mask_pos = np.where(mask[k] == 1.0)[0] # nonzero elements
+            patch_rho = rho[k][mask_pos] # nonzero elements of rho
+            ddc = compute_ddc(patch_v, patch_n, patch_cp, patch_rho)        
+        else:
+            ddc = prev_ddc[k, :len(neigh_vix)]
         
-        input_feat[vix, :len(neigh_vix), 0] = si[neigh_vix]
-        input_feat[vix, :len(neigh_vix), 1] = ddc
+        input_feat[k, :len(neigh_vix), 0] = si[neigh_vix]
+        input_feat[k, :len(neigh_vix), 1] = ddc
         for i, f in enumerate(FEAT):
-            input_feat[vix, :len(neigh_vix), i+2] = f[neigh_vix]
-        
-    return input_feat, rho, theta, mask, neigh_indices 
-
-
-# From a full shape in a full protein, extract a patch around a vertex.
-# If patch_indices = True, then store the indices of all neighbors.
-def extract_patch_and_coord(
-    vix, shape, coord, max_distance, max_vertices, patch_indices=False
-):
-    # Member vertices are nonzero elements
-    i, j = coord[np.int(vix), : coord.shape[1] // 2].nonzero()
-
-
-    # D = np.squeeze(np.asarray(coord[np.int(vix),j].todense()))
-    D = np.squeeze(np.asarray(coord[np.int(vix), : coord.shape[1] // 2].todense()))
-    j = np.where((D < max_distance) & (D > 0))[0]
-    max_dist_tmp = max_distance
-    old_j = len(j)
-    while len(j) > max_vertices:
-        max_dist_tmp = max_dist_tmp * 0.95
-        j = np.where((D < max_dist_tmp) & (D > 0))[0]
-    #    print('j = {} {}'.format(len(j), old_j))
-    D = D[j]
-    patch = {}
-    patch["X"] = shape["X"][0][j]
-    patch["Y"] = shape["Y"][0][j]
-    patch["Z"] = shape["Z"][0][j]
-    patch["charge"] = shape["charge"][0][j]
-    patch["hbond"] = shape["hbond"][0][j]
-    patch["normal"] = shape["normal"][:, j]
-    patch["shape_index"] = shape["shape_index"][0][j]
-    if "hphob" in shape:
-        patch["hphob"] = shape["hphob"][0][j]
-
-    patch["center"] = np.argmin(D)
-
-    j_theta = j + coord.shape[1] // 2
-    theta = np.squeeze(np.asarray(coord[np.int(vix), j_theta].todense()))
-    coord = np.concatenate([D, theta], axis=0)
-
-    if patch_indices:
-        return patch, coord, j
-    else:
-        return patch, coord
-
-
-from scipy.spatial import cKDTree
-# neigh1 and neigh2 are the precomputed indices; rho1 and rho2 their distances.
-def compute_shape_complementarity(ply_fn1, ply_fn2, neigh1, neigh2, rho1, rho2, mask1, mask2, params):
-    """
-        compute_shape_complementarity: compute the shape complementarity between all pairs of patches. 
-        ply_fnX: path to the ply file of the surface of protein X=1 and X=2
-        neighX, rhoX, maskX: (N,max_vertices_per_patch) matrices with the indices of the neighbors, the distances to the center 
-                and the mask
-
-        Returns: vX_sc (2,N,10) matrix with the shape complementarity (shape complementarity 25 and 50) 
-        of each vertex to its nearest neighbor in the other protein, in 10 rings.
-    """
-    # Mesh 1
-    mesh1 = pymesh.load_mesh(ply_fn1)
-    # Normals: 
-    nx = mesh1.get_attribute("vertex_nx")
-    ny = mesh1.get_attribute("vertex_ny")
-    nz = mesh1.get_attribute("vertex_nz")
-    n1 = np.stack([nx,ny,nz], axis=1)
-
-    # Mesh 2
-    mesh2 = pymesh.load_mesh(ply_fn2)
-    # Normals: 
-    nx = mesh2.get_attribute("vertex_nx")
-    ny = mesh2.get_attribute("vertex_ny")
-    nz = mesh2.get_attribute("vertex_nz")
-    n2 = np.stack([nx,ny,nz], axis=1)
-
-    w = params['sc_w']
-    int_cutoff = params['sc_interaction_cutoff']
-    radius = params['sc_radius']
-    num_rings = 10
-    scales = np.arange(0, radius, radius/10)
-    scales = np.append(scales, radius)
-
-    v1 = mesh1.vertices
-    v2 = mesh2.vertices
-
-    v1_sc = np.zeros((2,len(v1), 10))
-    v2_sc = np.zeros((2,len(v2), 10))
-
-    # Find all interface vertices
-    kdt = cKDTree(v2)
-    d, nearest_neighbors_v1_to_v2 = kdt.query(v1)
-    # Interface vertices in v1
-    interface_vertices_v1 = np.where(d < int_cutoff)[0]
-
-    # Go through every interface vertex. 
-    for cv1_iiix in range(len(interface_vertices_v1)):
-        cv1_ix = interface_vertices_v1[cv1_iiix]
-        assert (d[cv1_ix] < int_cutoff)
-        # First shape complementarity s1->s2 for the entire patch
-        patch_idxs1 = np.where(mask1[cv1_ix]==1)[0]
-        neigh_cv1 = np.array(neigh1[cv1_ix])[patch_idxs1]
-        # Find the point cv2_ix in s2 that is closest to cv1_ix
-        cv2_ix = nearest_neighbors_v1_to_v2[cv1_ix]
-        patch_idxs2 = np.where(mask2[cv2_ix]==1)[0]
-        neigh_cv2 = np.array(neigh2[cv2_ix])[patch_idxs2]
-
-        patch_v1 = v1[neigh_cv1]
-        patch_v2 = v2[neigh_cv2]
-        patch_n1 = n1[neigh_cv1]
-        patch_n2 = n2[neigh_cv2]
-
-        patch_kdt = cKDTree(patch_v1)
-        p_dists_v2_to_v1, p_nearest_neighbor_v2_to_v1 = patch_kdt.query(patch_v2)
-        patch_kdt = cKDTree(patch_v2)
-        p_dists_v1_to_v2, p_nearest_neighbor_v1_to_v2 = patch_kdt.query(patch_v1)
-        
-        # First v1->v2
-        neigh_cv1_p = p_nearest_neighbor_v1_to_v2
-        comp1 = [np.dot(patch_n1[x], -patch_n2[neigh_cv1_p][x]) for x in range(len(patch_n1))]
-        comp1 = np.multiply(comp1, np.exp(-w * np.square(p_dists_v1_to_v2)))
-        # Use 10 rings such that each ring has equal weight in shape complementarity
-        comp_rings1_25 = np.zeros(num_rings)
-        comp_rings1_50 = np.zeros(num_rings)
-
-        patch_rho1 = np.array(rho1[cv1_ix])[patch_idxs1]
-        for ring in range(num_rings):
-            scale = scales[ring]
-            members = np.where((patch_rho1 >= scales[ring]) & (patch_rho1 < scales[ring + 1]))
-            if len(members[0]) == 0:
-                comp_rings1_25[ring] = 0.0
-                comp_rings1_50[ring] = 0.0
-            else:
-                comp_rings1_25[ring] = np.percentile(comp1[members], 25)
-                comp_rings1_50[ring] = np.percentile(comp1[members], 50)
-        
-        # Now v2->v1
-        neigh_cv2_p = p_nearest_neighbor_v2_to_v1
-        comp2 = [np.dot(patch_n2[x], -patch_n1[neigh_cv2_p][x]) for x in range(len(patch_n2))]
-        comp2 = np.multiply(comp2, np.exp(-w * np.square(p_dists_v2_to_v1)))
-        # Use 10 rings such that each ring has equal weight in shape complementarity
-        comp_rings2_25 = np.zeros(num_rings)
-        comp_rings2_50 = np.zeros(num_rings)
-
-        # Apply mask to patch rho coordinates. 
-        patch_rho2 = np.array(rho2[cv2_ix])[patch_idxs2]
-        for ring in range(num_rings):
-            scale = scales[ring]
-            members = np.where((patch_rho2 >= scales[ring]) & (patch_rho2 < scales[ring + 1]))
-            if len(members[0]) == 0:
-                comp_rings2_25[ring] = 0.0
-                comp_rings2_50[ring] = 0.0
-            else:
-                comp_rings2_25[ring] = np.percentile(comp2[members], 25)
-                comp_rings2_50[ring] = np.percentile(comp2[members], 50)
-
-        v1_sc[0,cv1_ix,:] = comp_rings1_25
-        v2_sc[0,cv2_ix,:] = comp_rings2_25
-        v1_sc[1,cv1_ix,:] = comp_rings1_50
-        v2_sc[1,cv2_ix,:] = comp_rings2_50
+            input_feat[k, :len(neigh_vix), i+2] = f[neigh_vix]
 
-
-    return v1_sc, v2_sc
+    return input_feat
 
 
-def normalize_electrostatics(in_elec):
-    """
-        Normalize electrostatics to a value between -1 and 1
-    """
-    upper_threshold = 3
-    lower_threshold = -3
-    elec = np.clip(in_elec, lower_threshold, upper_threshold)
-    elec = elec - lower_threshold
-    elec = elec / (upper_threshold - lower_threshold)
-    elec = 2 * elec - 1
-    return elec
-
-def mean_normal_center_patch(D, n, r):
-    """
-        Function to compute the mean normal of vertices within r radius of the center of the patch.
-    """
-    c_normal = [n[i] for i in range(len(D)) if D[i] <= r]
-    mean_normal = np.mean(c_normal, axis=0, keepdims=True).T
-    mean_normal = mean_normal / np.linalg.norm(mean_normal)
-    return np.squeeze(mean_normal)
-
-def compute_ddc(patch_v, patch_n, patch_cp, patch_rho):
-    """
-        Compute the distance dependent curvature, Yin et al PNAS 2009
-            patch_v: the patch vertices
-            patch_n: the patch normals
-            patch_cp: the index of the central point of the patch 
-            patch_rho: the geodesic distance to all members.
-        Returns a vector with the ddc for each point in the patch.
-    """
-    n = patch_n
-    r = patch_v
-    i = patch_cp
-    # Compute the mean normal 2.5A around the center point
-    ni = mean_normal_center_patch(patch_rho, n, 2.5)
-    dij = np.linalg.norm(r - r[i], axis=1)
-    # Compute the step function sf:
-    sf = r + n
-    sf = sf - (ni + r[i])
-    sf = np.linalg.norm(sf, axis=1)
-    sf = sf - dij
-    sf[sf > 0] = 1
-    sf[sf < 0] = -1
-    sf[sf == 0] = 0
-    # Compute the curvature between i and j
-    dij[dij == 0] = 1e-8
-    kij = np.divide(np.linalg.norm(n - ni, axis=1), dij)
-    kij = np.multiply(sf, kij)
-    # Ignore any values greater than 0.7 and any values smaller than 0.7
-    kij[kij > 0.7] = 0
-    kij[kij < -0.7] = 0
-
-    return kij
-
-def read_data_from_surface(ply_fn, params):
+def read_data_from_surface(ply_fn, params, geodesics_path=None):
     """
     # Read data from a ply file -- decompose into patches. 
-    # Returns: 
-    # list_desc: List of features per patch
-    # list_coords: list of angular and polar coordinates.
-    # list_indices: list of indices of neighbors in the patch.
-    # list_sc_labels: list of shape complementarity labels (computed here).
+    # geodesics_path: if given, the geodesic distances stored in this file for the same mesh are reused
+    #                 (see geodesic_matrix.py), or saved there once computed.
+    # Returns: a Surface with
+    # vertices, normals: of the mesh
+    # input_feat: features per patch
+    # rho, theta, mask: angular and polar coordinates.
+    # neigh_indices: list of indices of neighbors in the patch.
+    # iface_labels: interface labels (ground truth only).
     """
+    import pymesh
+    from geometry.geodesic_matrix import geodesic_cache, save_geodesic_cache
+
     mesh = pymesh.load_mesh(ply_fn)
 
     # Normals: 
@@ -303,7 +162,11 @@ def read_data_from_surface(ply_fn, params):
     normals = np.stack([n1,n2,n3], axis=1)
 
     # Compute the angular and radial coordinates. 
-    rho, theta, neigh_indices, mask = compute_polar_coordinates(mesh, radius=params['max_distance'], max_vertices=params['max_shape_size'])
+    cache = geodesic_cache(geodesics_path) if geodesics_path is not None else None
+    rho, theta, neigh_indices, mask = compute_polar_coordinates(mesh, radius=params['max_distance'], max_vertices=params['max_shape_size'],
+                                                                geodesic=params.get('geodesic', 'dijkstra'), cache=cache)
+    if cache is not None:
+        save_geodesic_cache(geodesics_path, cache)
 
     # Compute the principal curvature components for the shape index. 
     mesh.add_attribute("vertex_mean_curvature")
@@ -361,27 +224,36 @@ def read_data_from_surface(ply_fn, params):
         input_feat[vix, :len(neigh_vix), 3] = charge[neigh_vix]
         input_feat[vix, :len(neigh_vix), 4] = hphob[neigh_vix]
         
-    return input_feat, rho, theta, mask, neigh_indices, iface_labels, np.copy(mesh.vertices)
+    return Surface(np.copy(mesh.vertices), normals, input_feat, rho, theta, mask, neigh_indices, iface_labels)
 
 # From a full shape in a full protein, extract a patch around a vertex.
 # If patch_indices = True, then store the indices of all neighbors.
 def extract_patch_and_coord(
     vix, shape, coord, max_distance, max_vertices, patch_indices=False
 ):
+    """
+        coord: sparse (N, 2N) CSR matrix with the rho and theta of every patch, as [rho | theta].
+        The patch keeps the (at most) max_vertices members nearest to the center within
+        max_distance, selected directly from the stored entries of row vix.
+    """
+    n = coord.shape[1] // 2
+    if not coord.has_sorted_indices:
+        coord.sort_indices()
+    start, end = coord.indptr[int(vix)], coord.indptr[int(vix) + 1]
+    cols = coord.indices[start:end]
+    vals = coord.data[start:end]
+    is_rho = cols < n
+
     # Member vertices are nonzero elements
-    i, j = coord[np.int(vix), : coord.shape[1] // 2].nonzero()
-
-
-    # D = np.squeeze(np.asarray(coord[np.int(vix),j].todense()))
-    D = np.squeeze(np.asarray(coord[np.int(vix), : coord.shape[1] // 2].todense()))
-    j = np.where((D < max_distance) & (D > 0))[0]
-    max_dist_tmp = max_distance
-    old_j = len(j)
-    while len(j) > max_vertices:
-        max_dist_tmp = max_dist_tmp * 0.95
-        j = np.where((D < max_dist_tmp) & (D > 0))[0]
-    #    print('j = {} {}'.format(len(j), old_j))
-    D = D[j]
+    j = cols[is_rho]
+    D = vals[is_rho]
+    members = (D < max_distance) & (D > 0)
+    j, D = j[members], D[members]
+    if len(j) > max_vertices:
+        nearest = np.argpartition(D, max_vertices - 1)[:max_vertices]
+        nearest.sort()
+        j, D = j[nearest], D[nearest]
+
     patch = {}
     patch["X"] = shape["X"][0][j]
     patch["Y"] = shape["Y"][0][j]
@@ -395,8 +267,14 @@ def extract_patch_and_coord(
 
     patch["center"] = np.argmin(D)
 
-    j_theta = j + coord.shape[1] // 2
-    theta = np.squeeze(np.asarray(coord[np.int(vix), j_theta].todense()))
+    # Theta of the members (zero if not stored).
+    theta_cols = cols[~is_rho] - n
+    theta_vals = vals[~is_rho]
+    pos = np.minimum(np.searchsorted(theta_cols, j), max(len(theta_cols) - 1, 0))
+    theta = np.zeros(len(j))
+    if len(theta_cols) > 0:
+        found = theta_cols[pos] == j
+        theta[found] = theta_vals[pos[found]]
     coord = np.concatenate([D, theta], axis=0)
 
     if patch_indices:
@@ -407,32 +285,17 @@ def extract_patch_and_coord(
 
 from scipy.spatial import cKDTree
 # neigh1 and neigh2 are the precomputed indices; rho1 and rho2 their distances.
-def compute_shape_complementarity(ply_fn1, ply_fn2, neigh1, neigh2, rho1, rho2, mask1, mask2, params):
+def compute_shape_complementarity(surf1, surf2, params, chunk_size=64):
     """
         compute_shape_complementarity: compute the shape complementarity between all pairs of patches. 
-        ply_fnX: path to the ply file of the surface of protein X=1 and X=2
-        neighX, rhoX, maskX: (N,max_vertices_per_patch) matrices with the indices of the neighbors, the distances to the center 
-                and the mask
+        surfX: Surface of protein X=1 and X=2 (see read_data_from_surface), with the vertices, normals,
+                and the (N,max_vertices_per_patch) matrices with the indices of the neighbors, the distances to the center 
+                and the mask of each patch
+        chunk_size: number of interface patches processed at once.
 
         Returns: vX_sc (2,N,10) matrix with the shape complementarity (shape complementarity 25 and 50) 
         of each vertex to its nearest neighbor in the other protein, in 10 rings.
     """
-    # Mesh 1
-    mesh1 = pymesh.load_mesh(ply_fn1)
-    # Normals: 
-    nx = mesh1.get_attribute("vertex_nx")
-    ny = mesh1.get_attribute("vertex_ny")
-    nz = mesh1.get_attribute("vertex_nz")
-    n1 = np.stack([nx,ny,nz], axis=1)
-
-    # Mesh 2
-    mesh2 = pymesh.load_mesh(ply_fn2)
-    # Normals: 
-    nx = mesh2.get_attribute("vertex_nx")
-    ny = mesh2.get_attribute("vertex_ny")
-    nz = mesh2.get_attribute("vertex_nz")
-    n2 = np.stack([nx,ny,nz], axis=1)
-
     w = params['sc_w']
     int_cutoff = params['sc_interaction_cutoff']
     radius = params['sc_radius']
@@ -440,86 +303,107 @@ def compute_shape_complementarity(ply_fn1, ply_fn2, neigh1, neigh2, rho1, rho2,
     scales = np.arange(0, radius, radius/10)
     scales = np.append(scales, radius)
 
-    v1 = mesh1.vertices
-    v2 = mesh2.vertices
+    v1 = surf1.vertices
+    v2 = surf2.vertices
 
     v1_sc = np.zeros((2,len(v1), 10))
     v2_sc = np.zeros((2,len(v2), 10))
 
-    # Find all interface vertices
+    # Find all interface vertices in v1, and the point in v2 that is closest to each of them.
     kdt = cKDTree(v2)
     d, nearest_neighbors_v1_to_v2 = kdt.query(v1)
-    # Interface vertices in v1
-    interface_vertices_v1 = np.where(d < int_cutoff)[0]
-
-    # Go through every interface vertex. 
-    for cv1_iiix in range(len(interface_vertices_v1)):
-        cv1_ix = interface_vertices_v1[cv1_iiix]
-        assert (d[cv1_ix] < int_cutoff)
-        # First shape complementarity s1->s2 for the entire patch
-        patch_idxs1 = np.where(mask1[cv1_ix]==1)[0]
-        neigh_cv1 = np.array(neigh1[cv1_ix])[patch_idxs1]
-        # Find the point cv2_ix in s2 that is closest to cv1_ix
-        cv2_ix = nearest_neighbors_v1_to_v2[cv1_ix]
-        patch_idxs2 = np.where(mask2[cv2_ix]==1)[0]
-        neigh_cv2 = np.array(neigh2[cv2_ix])[patch_idxs2]
-
-        patch_v1 = v1[neigh_cv1]
-        patch_v2 = v2[neigh_cv2]
-        patch_n1 = n1[neigh_cv1]
-        patch_n2 = n2[neigh_cv2]
-
-        patch_kdt = cKDTree(patch_v1)
-        p_dists_v2_to_v1, p_nearest_neighbor_v2_to_v1 = patch_kdt.query(patch_v2)
-        patch_kdt = cKDTree(patch_v2)
-        p_dists_v1_to_v2, p_nearest_neighbor_v1_to_v2 = patch_kdt.query(patch_v1)
-        
-        # First v1->v2
-        neigh_cv1_p = p_nearest_neighbor_v1_to_v2
-        comp1 = [np.dot(patch_n1[x], -patch_n2[neigh_cv1_p][x]) for x in range(len(patch_n1))]
-        comp1 = np.multiply(comp1, np.exp(-w * np.square(p_dists_v1_to_v2)))
-        # Use 10 rings such that each ring has equal weight in shape complementarity
-        comp_rings1_25 = np.zeros(num_rings)
-        comp_rings1_50 = np.zeros(num_rings)
-
-        patch_rho1 = np.array(rho1[cv1_ix])[patch_idxs1]
-        for ring in range(num_rings):
-            scale = scales[ring]
-            members = np.where((patch_rho1 >= scales[ring]) & (patch_rho1 < scales[ring + 1]))
-            if len(members[0]) == 0:
-                comp_rings1_25[ring] = 0.0
-                comp_rings1_50[ring] = 0.0
-            else:
-                comp_rings1_25[ring] = np.percentile(comp1[members], 25)
-                comp_rings1_50[ring] = np.percentile(comp1[members], 50)
-        
-        # Now v2->v1
-        neigh_cv2_p = p_nearest_neighbor_v2_to_v1
-        comp2 = [np.dot(patch_n2[x], -patch_n1[neigh_cv2_p][x]) for x in range(len(patch_n2))]
-        comp2 = np.multiply(comp2, np.exp(-w * np.square(p_dists_v2_to_v1)))
-        # Use 10 rings such that each ring has equal weight in shape complementarity
-        comp_rings2_25 = np.zeros(num_rings)
-        comp_rings2_50 = np.zeros(num_rings)
-
-        # Apply mask to patch rho coordinates. 
-        patch_rho2 = np.array(rho2[cv2_ix])[patch_idxs2]
-        for ring in range(num_rings):
-            scale = scales[ring]
-            members = np.where((patch_rho2 >= scales[ring]) & (patch_rho2 < scales[ring + 1]))
-            if len(members[0]) == 0:
-                comp_rings2_25[ring] = 0.0
-                comp_rings2_50[ring] = 0.0
-            else:
-                comp_rings2_25[ring] = np.percentile(comp2[members], 25)
-                comp_rings2_50[ring] = np.percentile(comp2[members], 50)
+    cv1 = np.where(d < int_cutoff)[0]
+    cv2 = nearest_neighbors_v1_to_v2[cv1]
+
+    # Several interface vertices of v1 can share the same nearest vertex in v2: 
+    # keep the last one, as the labels of v2 were overwritten in order.
+    _, last = np.unique(cv2[::-1], return_index=True)
+    last = len(cv2) - 1 - last
+
+    patch1 = (v1, surf1.normals, surf1.neigh_indices, surf1.rho, surf1.mask)
+    patch2 = (v2, surf2.normals, surf2.neigh_indices, surf2.rho, surf2.mask)
+    for start in range(0, len(cv1), chunk_size):
+        # First s1->s2 for the entire patch
+        c1 = cv1[start:start+chunk_size]
+        c2 = cv2[start:start+chunk_size]
+        v1_sc[:,c1,:] = patch_complementarity(patch1, c1, patch2, c2, w, scales, num_rings)
+    for start in range(0, len(last), chunk_size):
+        # Now s2->s1
+        c1 = cv1[last[start:start+chunk_size]]
+        c2 = cv2[last[start:start+chunk_size]]
+        v2_sc[:,c2,:] = patch_complementarity(patch2, c2, patch1, c1, w, scales, num_rings)
 
-        v1_sc[0,cv1_ix,:] = comp_rings1_25
-        v2_sc[0,cv2_ix,:] = comp_rings2_25
-        v1_sc[1,cv1_ix,:] = comp_rings1_50
-        v2_sc[1,cv2_ix,:] = comp_rings2_50
+    return v1_sc, v2_sc
 
 
-    return v1_sc, v2_sc
+def padded_patches(neigh, mask, centers):
+    """
+        Padded (len(centers), max_vertices) array with the indices of the members of each patch,
+        and a boolean mask of the valid entries.
+    """
+    max_vertices = mask.shape[1]
+    idx = np.zeros((len(centers), max_vertices), dtype=int)
+    for k, c in enumerate(centers):
+        members = np.asarray(neigh[c], dtype=int)[:max_vertices]
+        idx[k,:len(members)] = members
+    valid = np.asarray(mask)[centers] == 1
+    return idx, valid
+
+
+def patch_complementarity(patch_a, centers_a, patch_b, centers_b, w, scales, num_rings):
+    """
+        Shape complementarity of each patch of protein a (centered at centers_a) to the
+        patch of protein b centered at the matching vertex in centers_b.
+        patch_X: (vertices, normals, neigh, rho, mask) of protein X.
+        Returns a (2, len(centers_a), num_rings) array with the 25th and 50th percentile in each ring.
+    """
+    va, na, neigh_a, rho_a, mask_a = patch_a
+    vb, nb, neigh_b, _, mask_b = patch_b
+    idx_a, valid_a = padded_patches(neigh_a, mask_a, centers_a)
+    idx_b, valid_b = padded_patches(neigh_b, mask_b, centers_b)
+
+    # Nearest neighbor of every vertex in patch a among the vertices of patch b.
+    # Coordinates are centered on each patch to keep the expanded squared distances accurate.
+    pa = va[idx_a] - va[centers_a][:,None,:]
+    pb = vb[idx_b] - va[centers_a][:,None,:]
+    dists = np.sum(pa**2, axis=2)[:,:,None] + np.sum(pb**2, axis=2)[:,None,:] - 2 * np.matmul(pa, pb.transpose(0,2,1))
+    dists[~np.broadcast_to(valid_b[:,None,:], dists.shape)] = np.inf
+    nearest = np.argmin(dists, axis=2)
+    nearest = np.take_along_axis(idx_b, nearest, axis=1)
+    dists = np.linalg.norm(va[idx_a] - vb[nearest], axis=2)
+
+    comp = np.sum(na[idx_a] * -nb[nearest], axis=2)
+    comp = comp * np.exp(-w * np.square(dists))
+
+    # Use 10 rings such that each ring has equal weight in shape complementarity
+    ring = np.digitize(np.asarray(rho_a)[centers_a], scales) - 1
+    valid = valid_a & (ring >= 0) & (ring < num_rings)
+    groups = np.arange(len(centers_a))[:,None] * num_rings + ring
+    sc = segmented_percentiles(comp[valid], groups[valid], len(centers_a) * num_rings, [25, 50])
+    return sc.reshape(2, len(centers_a), num_rings)
+
+
+def segmented_percentiles(values, groups, n_groups, q):
+    """
+        Percentiles q of values within each group (as np.percentile with linear interpolation),
+        for all groups at once. Empty groups are set to zero.
+        Returns a (len(q), n_groups) array.
+    """
+    order = np.lexsort((values, groups))
+    values = values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    first = np.cumsum(counts) - counts
+    out = np.zeros((len(q), n_groups))
+    nonempty = counts > 0
+    for i, qi in enumerate(q):
+        pos = (counts[nonempty] - 1) * qi / 100.0
+        lo = np.floor(pos).astype(int)
+        hi = np.minimum(lo + 1, counts[nonempty] - 1)
+        frac = pos - lo
+        v_lo = values[first[nonempty] + lo]
+        v_hi = values[first[nonempty] + hi]
+        out[i, nonempty] = v_lo + frac * (v_hi - v_lo)
+    return out
 
 
 def normalize_electrostatics(in_elec):
@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 
 
@@ -42,3 +43,141 @@ def _parse_function(example_proto):
         labels,
         parsed_features["pdb"],
     )
+
+
+def features_example(pdb, input_feat, rho_wrt_center, theta_wrt_center, mask, pocket_labels):
+    """
+    Serialized tf.train.Example of a protein with the arrays as FloatList / Int64List features (see _parse_function).
+    """
+    input_feat_shape = tf.train.Int64List(value=input_feat.shape)
+    input_feat_list = tf.train.FloatList(value=input_feat.reshape(-1))
+    rho_wrt_center_shape = tf.train.Int64List(value=rho_wrt_center.shape)
+    rho_wrt_center_list = tf.train.FloatList(value=rho_wrt_center.reshape(-1))
+    theta_wrt_center_shape = tf.train.Int64List(value=theta_wrt_center.shape)
+    theta_wrt_center_list = tf.train.FloatList(value=theta_wrt_center.reshape(-1))
+    mask_shape = tf.train.Int64List(value=mask.shape)
+    mask_list = tf.train.FloatList(value=mask.reshape(-1))
+    pdb_list = tf.train.BytesList(value=[pdb.encode()])
+    pocket_labels_shape = tf.train.Int64List(value=pocket_labels.shape)
+    pocket_labels = tf.train.Int64List(value=pocket_labels.reshape(-1))
+
+    features_dict = {
+        "input_feat_shape": tf.train.Feature(int64_list=input_feat_shape),
+        "input_feat": tf.train.Feature(float_list=input_feat_list),
+        "rho_wrt_center_shape": tf.train.Feature(int64_list=rho_wrt_center_shape),
+        "rho_wrt_center": tf.train.Feature(float_list=rho_wrt_center_list),
+        "theta_wrt_center_shape": tf.train.Feature(
+            int64_list=theta_wrt_center_shape
+        ),
+        "theta_wrt_center": tf.train.Feature(float_list=theta_wrt_center_list),
+        "mask_shape": tf.train.Feature(int64_list=mask_shape),
+        "mask": tf.train.Feature(float_list=mask_list),
+        "pdb": tf.train.Feature(bytes_list=pdb_list),
+        "pocket_labels_shape": tf.train.Feature(int64_list=pocket_labels_shape),
+        "pocket_labels": tf.train.Feature(int64_list=pocket_labels),
+    }
+
+    features = tf.train.Features(feature=features_dict)
+    example = tf.train.Example(features=features)
+    return example.SerializeToString()
+
+
+# Raw byte records: every array is stored as its little-endian bytes, with its dtype and shape,
+# and decoded with decode_raw. The patch arrays are stored as float32 or float16 (float_dtype),
+# the pocket labels (ligand types 0-7) as int8.
+RAW_ARRAYS = ["input_feat", "rho_wrt_center", "theta_wrt_center", "mask", "pocket_labels"]
+RAW_SHAPE_RANKS = {"input_feat": 3, "rho_wrt_center": 2, "theta_wrt_center": 2, "mask": 3, "pocket_labels": 2}
+LABELS_DTYPE = "int8"
+
+
+def record_dtype(name, float_dtype="float32"):
+    return LABELS_DTYPE if name == "pocket_labels" else float_dtype
+
+
+def raw_example(pdb, arrays, float_dtype="float32"):
+    """
+    Serialized tf.train.Example of a protein in the raw byte format.
+        arrays: input_feat, rho_wrt_center, theta_wrt_center, mask and pocket_labels
+        float_dtype: 'float32' or 'float16', dtype of the stored patch arrays
+    """
+    feature = {"pdb": tf.train.Feature(bytes_list=tf.train.BytesList(value=[pdb.encode()]))}
+    for name in RAW_ARRAYS:
+        dtype = np.dtype(record_dtype(name, float_dtype)).newbyteorder("<")
+        values = np.ascontiguousarray(arrays[name], dtype=dtype)
+        feature[name] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[values.tobytes()]))
+        feature[name + "_shape"] = tf.train.Feature(int64_list=tf.train.Int64List(value=values.shape))
+        feature[name + "_dtype"] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[dtype.name.encode()]))
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+def _parse_raw_function(example_proto, float_dtype="float32"):
+    """
+    Parse a record in the raw byte format. Returns the same tensors as _parse_function
+    (float32 arrays, int64 labels). float_dtype is the dtype the patch arrays were stored with; the
+    dtype header of each array is checked against it.
+    """
+    keys_to_features = {"pdb": tf.FixedLenFeature([], dtype=tf.string)}
+    for name in RAW_ARRAYS:
+        keys_to_features[name] = tf.FixedLenFeature([], dtype=tf.string)
+        keys_to_features[name + "_shape"] = tf.FixedLenFeature([RAW_SHAPE_RANKS[name]], dtype=tf.int64)
+        keys_to_features[name + "_dtype"] = tf.FixedLenFeature([], dtype=tf.string)
+    parsed_features = tf.parse_single_example(example_proto, keys_to_features)
+
+    out = []
+    for name in RAW_ARRAYS:
+        dtype = record_dtype(name, float_dtype)
+        check = tf.Assert(
+            tf.equal(parsed_features[name + "_dtype"], dtype), [parsed_features[name + "_dtype"]]
+        )
+        with tf.control_dependencies([check]):
+            values = tf.decode_raw(parsed_features[name], tf.as_dtype(dtype), little_endian=True)
+        values = tf.reshape(values, tf.cast(parsed_features[name + "_shape"], tf.int32))
+        out.append(tf.cast(values, tf.int64 if name == "pocket_labels" else tf.float32))
+    input_feat, rho_wrt_center, theta_wrt_center, mask, labels = out
+    return (
+        input_feat,
+        rho_wrt_center,
+        theta_wrt_center,
+        mask,
+        labels,
+        parsed_features["pdb"],
+    )
+
+
+def ligand_dataset(
+    filenames,
+    record_format="raw",
+    float_dtype="float32",
+    cycle_length=4,
+    num_parallel_calls=4,
+    cache=None,
+    shuffle_buffer=None,
+    prefetch=2,
+    compression_type="",
+):
+    """
+    tf.data pipeline over the ligand records: the shards (a list of files, or a glob pattern) are read
+    interleaved in parallel, the records parsed in parallel, optionally cached (in memory if cache is '',
+    or in files with this prefix) and shuffled, and prefetch records are prepared ahead of the consumer.
+        record_format: 'raw' (see raw_example) or 'features' (the FloatList / Int64List records parsed by
+            _parse_function)
+        compression_type: '', 'GZIP' or 'ZLIB', the compression of the shards (see build_ligand_tfrecords)
+    Yields the tensors of _parse_function for each protein.
+    """
+    if isinstance(filenames, str):
+        files = tf.data.Dataset.list_files(filenames, shuffle=False)
+    else:
+        files = tf.data.Dataset.from_tensor_slices(list(filenames))
+    dataset = files.interleave(
+        lambda f: tf.data.TFRecordDataset(f, compression_type=compression_type), cycle_length=cycle_length, block_length=1, num_parallel_calls=cycle_length
+    )
+    if record_format == "raw":
+        parse = lambda example_proto: _parse_raw_function(example_proto, float_dtype)
+    else:
+        parse = _parse_function
+    dataset = dataset.map(parse, num_parallel_calls=num_parallel_calls)
+    if cache is not None:
+        dataset = dataset.cache(cache)
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer)
+    return dataset.prefetch(prefetch)
@@ -0,0 +1,78 @@
+"""
+rotation_conv.py: Geodesic convolution layer of MaSIF with all rotations evaluated at once.
+The layer is the same as the inference method of MaSIF_site and MaSIF_ppi_search: for every
+rotation of the patch, a Gaussian activation of the polar coordinates of its vertices, a weighted
+sum of the input features, a linear layer, and the maximum over the rotations. Here the rho
+activations (which do not depend on the rotation) are computed once, the theta activations of all
+rotations in one broadcast tensor, and the maximum is taken in one reduction.
+The intermediate tensors are n_rotations times larger than in the loop over rotations.
+Released under an Apache License 2.0
+"""
+import numpy as np
+import tensorflow as tf
+
+
+def rotation_offsets(n_rotations):
+    # Rotation angle of each rotation, in the order of the loop in MaSIF_site.inference
+    return (np.arange(n_rotations) * 2 * np.pi / n_rotations).astype("float32")
+
+
+def fused_rotation_conv(
+    input_feat,
+    rho_coords,
+    theta_coords,
+    mask,
+    W_conv,
+    b_conv,
+    mu_rho,
+    sigma_rho,
+    mu_theta,
+    sigma_theta,
+    n_rotations,
+    eps=1e-5,
+    mean_gauss_activation=True,
+):
+    """
+    Output of the convolution layer, as MaSIF_site.inference.
+        input_feat: batch_size, n_vertices, n_feat
+        rho_coords, theta_coords, mask: batch_size, n_vertices, 1
+        W_conv, b_conv: weights (n_feat*n_gauss, n_out) and bias (n_out) of the linear layer
+        mu_rho, sigma_rho, mu_theta, sigma_theta: 1, n_gauss
+    Returns: batch_size, n_out
+    """
+    n_samples = tf.shape(rho_coords)[0]
+    n_vertices = tf.shape(rho_coords)[1]
+
+    rho_coords_ = tf.reshape(rho_coords, [-1, 1])  # batch_size*n_vertices, 1
+    rho_coords_ = tf.exp(
+        -tf.square(rho_coords_ - mu_rho) / (tf.square(sigma_rho) + eps)
+    )  # batch_size*n_vertices, n_gauss
+
+    thetas_coords_ = tf.reshape(theta_coords, [1, -1, 1])  # 1, batch_size*n_vertices, 1
+    thetas_coords_ += tf.reshape(rotation_offsets(n_rotations), [-1, 1, 1])
+    thetas_coords_ = tf.mod(thetas_coords_, 2 * np.pi)  # n_rotations, batch_size*n_vertices, 1
+    thetas_coords_ = tf.exp(
+        -tf.square(thetas_coords_ - mu_theta) / (tf.square(sigma_theta) + eps)
+    )  # n_rotations, batch_size*n_vertices, n_gauss
+
+    gauss_activations = tf.multiply(rho_coords_, thetas_coords_)
+    gauss_activations = tf.reshape(
+        gauss_activations, [n_rotations, n_samples, n_vertices, -1]
+    )  # n_rotations, batch_size, n_vertices, n_gauss
+    gauss_activations = tf.multiply(gauss_activations, mask)
+    if mean_gauss_activation:  # computes mean weights for the different gaussians
+        gauss_activations /= tf.reduce_sum(gauss_activations, 2, keep_dims=True) + eps
+
+    gauss_desc = tf.multiply(
+        tf.expand_dims(gauss_activations, 3), tf.expand_dims(input_feat, 3)
+    )  # n_rotations, batch_size, n_vertices, n_feat, n_gauss
+    gauss_desc = tf.reduce_sum(gauss_desc, 2)  # n_rotations, batch_size, n_feat, n_gauss
+    gauss_desc = tf.reshape(
+        gauss_desc, [n_rotations * n_samples, tf.shape(W_conv)[0]]
+    )  # n_rotations*batch_size, n_feat*n_gauss
+
+    conv_feat = tf.matmul(gauss_desc, W_conv) + b_conv
+    conv_feat = tf.reshape(conv_feat, [n_rotations, n_samples, -1])
+    conv_feat = tf.reduce_max(conv_feat, 0)
+    conv_feat = tf.nn.relu(conv_feat)
+    return conv_feat
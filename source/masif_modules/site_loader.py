@@ -0,0 +1,292 @@
+"""
+site_loader.py: Load the precomputed patches of the proteins for train_masif_site in background
+worker processes, so that the arrays of the next proteins are ready when the network finishes a step.
+The arrays are memory mapped, the labels encoded and the indices padded in the workers, and at most
+prefetch proteins are prepared ahead of the training loop. The time the training loop waits for data
+is kept in stall_time. The loaded proteins can be kept across epochs in a SiteCache, in memory up to
+a size limit and on a local disk beyond it.
+Released under an Apache License 2.0
+"""
+import os
+import time
+from collections import OrderedDict, deque
+from multiprocessing import Pool
+
+import numpy as np
+
+
+def pad_indices_array(indices, max_verts):
+    """
+    Pad the member indices of each patch to max_verts with the index of the patch, as pad_indices in
+    train_masif_site.py. indices is a list (or object array) of index lists, or an already padded
+    (n_patches, max_verts) array.
+    """
+    if isinstance(indices, np.ndarray) and indices.dtype != object and indices.ndim == 2:
+        return indices.astype(int)
+    lengths = np.fromiter((len(ix) for ix in indices), dtype=int, count=len(indices))
+    padded = np.repeat(np.arange(len(indices))[:,None], max_verts, axis=1)
+    valid = np.arange(max_verts)[None,:] < lengths[:,None]
+    padded[valid] = np.concatenate([np.asarray(ix, dtype=int) for ix in indices] + [np.zeros(0, dtype=int)])
+    return padded
+
+
+def encode_labels(iface_labels):
+    # Column 0 is 1 for interface vertices, column 1 for the rest
+    iface = np.asarray(iface_labels) == 1
+    return np.stack([iface, ~iface], axis=1).astype(float)
+
+
+def load_site_arrays(mydir, pid, feat_mask):
+    """
+    The patches of protein pid in mydir: rho, theta, input features and mask (memory mapped), and the
+    padded indices.
+    """
+    from masif_modules.train_masif_site import mask_input_feat
+
+    rho_wrt_center = np.load(mydir + pid + "_rho_wrt_center.npy", mmap_mode="r")
+    theta_wrt_center = np.load(mydir + pid + "_theta_wrt_center.npy", mmap_mode="r")
+    input_feat = np.load(mydir + pid + "_input_feat.npy", mmap_mode="r")
+    if np.sum(feat_mask) < 5:
+        input_feat = mask_input_feat(input_feat, feat_mask)
+    mask = np.load(mydir + pid + "_mask.npy", mmap_mode="r")
+    mask = np.expand_dims(mask, 2)
+    indices = np.load(mydir + pid + "_list_indices.npy", encoding="latin1", allow_pickle=True)
+    # indices is (n_verts x <30), it should be
+    indices = pad_indices_array(indices, mask.shape[1])
+    return rho_wrt_center, theta_wrt_center, input_feat, mask, indices
+
+
+def site_protein_selected(iface_labels, settings):
+    # Proteins that are too large, or with too few or too many interface vertices, are skipped
+    if len(iface_labels) > settings["max_vertices"]:
+        return False
+    return not (np.sum(iface_labels) > 0.75 * len(iface_labels) or np.sum(iface_labels) < 30)
+
+
+def load_site_protein(mydir, pid, settings):
+    """
+    The interface labels and patches of one protein, as in-memory arrays, or None if the protein is skipped.
+    """
+    try:
+        iface_labels = np.load(mydir + pid + "_iface_labels.npy")
+    except Exception:
+        return None
+    if not site_protein_selected(iface_labels, settings):
+        return None
+
+    arrays = load_site_arrays(mydir, pid, settings["feat_mask"])
+    protein = {"iface_labels": iface_labels}
+    for name, values in zip(["rho_wrt_center", "theta_wrt_center", "input_feat", "mask", "indices"], arrays):
+        protein[name] = np.ascontiguousarray(values)
+    return protein
+
+
+def select_site_data(protein, pid, mode, settings, seed):
+    """
+    Prepare the data of one protein (as returned by load_site_protein), as the training (mode 'train')
+    or testing ('test') loop of train_masif_site. Returns None if the protein is skipped.
+    """
+    if protein is None or not site_protein_selected(protein["iface_labels"], settings):
+        return None
+    iface_labels = protein["iface_labels"]
+    rho_wrt_center = protein["rho_wrt_center"]
+    theta_wrt_center = protein["theta_wrt_center"]
+    input_feat = protein["input_feat"]
+    mask = protein["mask"]
+    indices = protein["indices"]
+    iface_labels_dc = encode_labels(iface_labels)
+    pos_labels = np.where(iface_labels == 1)[0]
+    neg_labels = np.where(iface_labels == 0)[0]
+
+    if mode == "train":
+        rng = np.random.RandomState(seed)
+        rng.shuffle(neg_labels)
+        rng.shuffle(pos_labels)
+        # Scramble neg idx, and only get as many as pos_labels to balance the training.
+        n = min(len(pos_labels), len(neg_labels))
+        if settings["n_conv_layers"] == 1:
+            n = min(n, settings["batch_size"] // 2)
+            subset = np.concatenate([neg_labels[:n], pos_labels[:n]])
+
+            rho_wrt_center = rho_wrt_center[subset]
+            theta_wrt_center = theta_wrt_center[subset]
+            input_feat = input_feat[subset]
+            mask = mask[subset]
+            iface_labels_dc = iface_labels_dc[subset]
+            indices = indices[subset]
+            pos_labels = np.arange(0, n)
+            neg_labels = np.arange(n, n * 2)
+        else:
+            neg_labels = neg_labels[:n]
+            pos_labels = pos_labels[:n]
+
+    return {
+        "pid": pid,
+        "iface_labels": iface_labels,
+        "rho_wrt_center": rho_wrt_center,
+        "theta_wrt_center": theta_wrt_center,
+        "input_feat": input_feat,
+        "mask": mask,
+        "indices": indices,
+        "labels": iface_labels_dc,
+        "pos_labels": pos_labels,
+        "neg_labels": neg_labels,
+    }
+
+
+def prepare_site_data(job):
+    """
+    Load and prepare the data of one protein (see select_site_data). Returns None if the protein is skipped.
+        job: (mydir, pid, mode, settings, seed), with the settings feat_mask, n_conv_layers, batch_size
+            and max_vertices (proteins with more vertices are skipped)
+    """
+    mydir, pid, mode, settings, seed = job
+    return select_site_data(load_site_protein(mydir, pid, settings), pid, mode, settings, seed)
+
+
+def load_site_job(job):
+    mydir, pid, mode, settings, seed = job
+    return load_site_protein(mydir, pid, settings)
+
+
+def site_key(job):
+    # ppi_pair_id and pid of a job
+    mydir, pid = job[0], job[1]
+    return "{}_{}".format(os.path.basename(mydir.rstrip("/")), pid)
+
+
+class SiteCache:
+    """
+    Cache of the proteins loaded by load_site_protein, shared across epochs. The most recently used
+    proteins are kept in memory up to max_mb; the least recently used ones are moved to .npy files in
+    spill_dir (e.g. on a local SSD), from which they are read memory mapped. Without spill_dir they are
+    dropped. hits, disk_hits and misses count the lookups.
+    """
+    def __init__(self, max_mb, spill_dir=None):
+        self.max_bytes = max_mb * 2**20
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.ram = OrderedDict()
+        self.ram_bytes = 0
+        self.spilled = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.ram or key in self.spilled
+
+    def get(self, key):
+        if key in self.ram:
+            self.hits += 1
+            self.ram.move_to_end(key)
+            return self.ram[key]
+        if key in self.spilled:
+            self.disk_hits += 1
+            return {name: np.load(path, mmap_mode="r") for name, path in self.spilled[key].items()}
+        self.misses += 1
+        return None
+
+    def put(self, key, protein):
+        if protein is None or key in self:
+            return
+        self.ram[key] = protein
+        self.ram_bytes += protein_bytes(protein)
+        while self.ram_bytes > self.max_bytes and self.ram:
+            old_key, old = self.ram.popitem(last=False)
+            self.ram_bytes -= protein_bytes(old)
+            self.spill(old_key, old)
+
+    def spill(self, key, protein):
+        if self.spill_dir is None:
+            return
+        paths = {}
+        for name, values in protein.items():
+            paths[name] = os.path.join(self.spill_dir, "{}_{}.npy".format(key, name))
+            np.save(paths[name], values)
+        self.spilled[key] = paths
+
+    def stats(self):
+        lookups = max(self.hits + self.disk_hits + self.misses, 1)
+        return "Cache: {:.1%} hits in memory, {:.1%} on disk, {} misses; {:.0f} MB in memory, {} proteins on disk".format(
+            self.hits / lookups, self.disk_hits / lookups, self.misses, self.ram_bytes / 2**20, len(self.spilled)
+        )
+
+    def reset_stats(self):
+        self.hits = self.disk_hits = self.misses = 0
+
+
+def protein_bytes(protein):
+    return sum(values.nbytes for values in protein.values())
+
+
+class Deferred:
+    # Result computed in the calling process when it is needed
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def get(self):
+        return self.func(*self.args)
+
+
+class SiteLoader:
+    """
+    Prepare the data of the proteins (see prepare_site_data) in n_workers processes, at most prefetch
+    proteins ahead of the consumer. With n_workers=0 the data is prepared in the calling process.
+    With a SiteCache, the proteins are loaded from the cache when they are in it, and added to it otherwise.
+    stall_time is the time the consumer waited for data since the last reset_stall_time.
+    """
+    def __init__(self, n_workers=2, prefetch=4, cache=None):
+        self.pool = Pool(n_workers) if n_workers > 0 else None
+        self.prefetch = max(prefetch, 1)
+        self.cache = cache
+        self.stall_time = 0.0
+
+    def reset_stall_time(self):
+        stall_time = self.stall_time
+        self.stall_time = 0.0
+        return stall_time
+
+    def submit(self, job):
+        # Returns the job, whether it is read from the cache, and its pending result
+        if self.cache is not None:
+            protein = self.cache.get(site_key(job))
+            if protein is not None:
+                return job, True, Deferred(lambda: protein)
+        func = prepare_site_data if self.cache is None else load_site_job
+        if self.pool is None:
+            return job, False, Deferred(func, job)
+        return job, False, self.pool.apply_async(func, (job,))
+
+    def iterate(self, jobs):
+        """
+        Yield (job, data) for each job whose protein is not skipped, in the order of jobs.
+        """
+        jobs = iter(jobs)
+        pending = deque()
+        for job in jobs:
+            pending.append(self.submit(job))
+            if len(pending) >= self.prefetch:
+                break
+        while pending:
+            job, cached, result = pending.popleft()
+            tic = time.time()
+            data = result.get()
+            self.stall_time += time.time() - tic
+            for next_job in jobs:
+                pending.append(self.submit(next_job))
+                break
+            if self.cache is not None:
+                if not cached:
+                    self.cache.put(site_key(job), data)
+                mydir, pid, mode, settings, seed = job
+                data = select_site_data(data, pid, mode, settings, seed)
+            if data is not None:
+                yield job, data
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
@@ -0,0 +1,38 @@
+import numpy as np
+
+
+class Surface:
+    """
+    In-memory surface of one protein and its decomposition into patches, as read by
+    read_data_from_surface. It is passed directly to compute_shape_complementarity and
+    saved to the precomputation directory, so the ply file is only parsed once.
+        vertices, normals: (N,3) arrays
+        input_feat: (N,max_vertices,n_feat) input features of each patch
+        rho, theta, mask: (N,max_vertices) polar coordinates and mask of each patch
+        neigh_indices: indices of the members of each patch
+        iface_labels: (N,) interface labels (ground truth only)
+    """
+    def __init__(self, vertices, normals, input_feat, rho, theta, mask, neigh_indices, iface_labels):
+        self.vertices = vertices
+        self.normals = normals
+        self.input_feat = input_feat
+        self.rho = rho
+        self.theta = theta
+        self.mask = mask
+        self.neigh_indices = neigh_indices
+        self.iface_labels = iface_labels
+
+    def save(self, prefix):
+        """
+        Save the patches as {prefix}_rho_wrt_center.npy, {prefix}_input_feat.npy, ...
+        """
+        np.save(prefix+'_rho_wrt_center', self.rho)
+        np.save(prefix+'_theta_wrt_center', self.theta)
+        np.save(prefix+'_input_feat', self.input_feat)
+        np.save(prefix+'_mask', self.mask)
+        np.save(prefix+'_list_indices', self.neigh_indices)
+        np.save(prefix+'_iface_labels', self.iface_labels)
+        # Save x, y, z
+        np.save(prefix+'_X.npy', self.vertices[:,0])
+        np.save(prefix+'_Y.npy', self.vertices[:,1])
+        np.save(prefix+'_Z.npy', self.vertices[:,2])
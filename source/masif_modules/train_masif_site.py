@@ -22,20 +22,107 @@ def pad_indices(indices, max_verts):
 
 # Run masif site on a protein, on a previously trained network.
 def run_masif_site(
-    params, learning_obj, rho_wrt_center, theta_wrt_center, input_feat, mask, indices
+    params, learning_obj, rho_wrt_center, theta_wrt_center, input_feat, mask, indices, max_memory_mb=None
 ):
+    """
+    Score every vertex of a protein. With max_memory_mb, the vertices are scored in blocks
+    (see site_blocks) sized so that the intermediate tensors of the network stay under this budget,
+    and the scores are the same as when the whole protein is fed at once.
+    Returns [score], as session.run.
+    """
     indices = pad_indices(indices, mask.shape[1])
     mask = np.expand_dims(mask, 2)
-    feed_dict = {
-        learning_obj.rho_coords: rho_wrt_center,
-        learning_obj.theta_coords: theta_wrt_center,
-        learning_obj.input_feat: input_feat,
-        learning_obj.mask: mask,
-        learning_obj.indices_tensor: indices,
-    }
+    if max_memory_mb is None:
+        feed_dict = {
+            learning_obj.rho_coords: rho_wrt_center,
+            learning_obj.theta_coords: theta_wrt_center,
+            learning_obj.input_feat: input_feat,
+            learning_obj.mask: mask,
+            learning_obj.indices_tensor: indices,
+        }
+
+        score = learning_obj.session.run([learning_obj.full_score], feed_dict=feed_dict)
+        return score
+
+    max_rows = max(int(max_memory_mb * 2**20 / site_bytes_per_patch(learning_obj, mask.shape[1])), 1)
+    score = np.zeros(len(indices))
+    for centers, rows, local_indices in site_blocks(indices, params["n_conv_layers"], max_rows):
+        feed_dict = {
+            learning_obj.rho_coords: rho_wrt_center[rows],
+            learning_obj.theta_coords: theta_wrt_center[rows],
+            learning_obj.input_feat: input_feat[rows],
+            learning_obj.mask: mask[rows],
+            learning_obj.indices_tensor: local_indices,
+        }
+        logits = learning_obj.session.run(learning_obj.full_logits, feed_dict=feed_dict)
+        score[centers] = logits[np.searchsorted(rows, centers), 0]
+    return [score]
+
+
+def site_bytes_per_patch(learning_obj, max_verts):
+    # Largest intermediate of a convolution layer per patch: (max_verts, n_feat, n_gauss) float32
+    # activations, with about two temporaries of the same size, for each rotation if they are fused.
+    n_gauss = learning_obj.n_thetas * learning_obj.n_rhos
+    rotations = learning_obj.n_rotations if getattr(learning_obj, "fused_rotations", False) else 1
+    return 3 * 4 * max_verts * learning_obj.n_feat * n_gauss * rotations
+
+
+def site_halo(indices, centers, n_conv_layers):
+    """
+    Patches needed to score centers: each convolution layer after the first gathers the output of
+    the previous layer at the members of the patch (indices_tensor), so the scores of centers depend
+    on the patches up to n_conv_layers-1 membership hops away.
+    """
+    rows = np.unique(centers)
+    for _ in range(n_conv_layers - 1):
+        rows = np.union1d(rows, indices[rows].ravel())
+    return rows
 
-    score = learning_obj.session.run([learning_obj.full_score], feed_dict=feed_dict)
-    return score
+
+def site_blocks(indices, n_conv_layers, max_rows):
+    """
+    Split the patches of a protein into blocks of centers whose halo (see site_halo) has at most max_rows
+    patches, where possible. The centers are ordered by reverse Cuthill-McKee on the membership graph, so
+    that each block is a compact region of the surface with a small halo.
+    Yields the centers of each block, the rows of the patches to feed (sorted) and indices_tensor in
+    terms of these rows. Members outside the rows (only in the outer halo, whose outputs are not used)
+    point to the patch itself.
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+    n = len(indices)
+    rows_ix = np.repeat(np.arange(n), indices.shape[1])
+    graph = csr_matrix((np.ones(indices.size), (rows_ix, indices.ravel())), shape=(n, n))
+    order = reverse_cuthill_mckee(graph + graph.T, symmetric_mode=True)
+
+    block_size = max_rows
+    start = 0
+    while start < n:
+        centers = np.sort(order[start:start+block_size])
+        rows = site_halo(indices, centers, n_conv_layers)
+        if len(rows) > max_rows and block_size > 1:
+            block_size = max(block_size // 2, 1)
+            continue
+        local = np.searchsorted(rows, indices[rows])
+        outside = rows[np.minimum(local, len(rows) - 1)] != indices[rows]
+        local[outside] = np.repeat(np.arange(len(rows))[:,None], indices.shape[1], axis=1)[outside]
+        yield centers, rows, local
+        start += len(centers)
+
+
+def site_feed_dict(learning_obj, data):
+    # Feed dict of a protein prepared by site_loader.prepare_site_data
+    return {
+        learning_obj.rho_coords: data["rho_wrt_center"],
+        learning_obj.theta_coords: data["theta_wrt_center"],
+        learning_obj.input_feat: data["input_feat"],
+        learning_obj.mask: data["mask"],
+        learning_obj.labels: data["labels"],
+        learning_obj.pos_idx: data["pos_labels"],
+        learning_obj.neg_idx: data["neg_labels"],
+        learning_obj.indices_tensor: data["indices"],
+    }
 
 
 def compute_roc_auc(pos, neg):
@@ -51,7 +138,18 @@ def train_masif_site(
     num_iterations=100,
     num_iter_test=1000,
     batch_size_val_test=50,
+    n_workers=2,
+    prefetch=4,
+    cache_mb=None,
+    cache_dir=None,
 ):
+    """
+    Train MaSIF-site. The data of the proteins is prepared by n_workers background processes,
+    at most prefetch proteins ahead (see site_loader.py).
+        cache_mb: if given, the loaded proteins are kept across epochs, up to cache_mb in memory
+            and in cache_dir (if given) beyond that.
+    """
+    from masif_modules.site_loader import SiteLoader, SiteCache
 
     # Open training list.
 
@@ -78,6 +176,16 @@ def train_masif_site(
     n_val = len(data_dirs) // 10
     val_dirs = set(data_dirs[(len(data_dirs) - n_val) :])
 
+    cache = SiteCache(cache_mb, cache_dir) if cache_mb is not None else None
+    loader = SiteLoader(n_workers=n_workers, prefetch=prefetch, cache=cache)
+    train_settings = {
+        "feat_mask": params["feat_mask"],
+        "n_conv_layers": params["n_conv_layers"],
+        "batch_size": batch_size,
+        "max_vertices": 8000,
+    }
+    test_settings = dict(train_settings, max_vertices=20000)
+
     for num_iter in range(num_iterations):
         # Start training epoch:
         list_training_loss = []
@@ -105,6 +213,7 @@ def train_masif_site(
         all_test_labels = []
         all_test_scores = []
 
+        train_jobs = []
         for ppi_pair_id in data_dirs:
             mydir = params["masif_precomputation_dir"] + ppi_pair_id + "/"
             pdbid = ppi_pair_id.split("_")[0]
@@ -119,112 +228,59 @@ def train_masif_site(
             if pdbid + "_" + chains2 in training_list:
                 pids.append("p2")
             for pid in pids:
-                try:
-                    iface_labels = np.load(mydir + pid + "_iface_labels.npy")
-                except:
-                    continue
-                if len(iface_labels) > 8000:
-                    continue
-                if (
-                    np.sum(iface_labels) > 0.75 * len(iface_labels)
-                    or np.sum(iface_labels) < 30
-                ):
-                    continue
-                count_proteins += 1
-
-                rho_wrt_center = np.load(mydir + pid + "_rho_wrt_center.npy")
-                theta_wrt_center = np.load(mydir + pid + "_theta_wrt_center.npy")
-                input_feat = np.load(mydir + pid + "_input_feat.npy")
-                if np.sum(params["feat_mask"]) < 5:
-                    input_feat = mask_input_feat(input_feat, params["feat_mask"])
-                mask = np.load(mydir + pid + "_mask.npy")
-                mask = np.expand_dims(mask, 2)
-                indices = np.load(mydir + pid + "_list_indices.npy", encoding="latin1")
-                # indices is (n_verts x <30), it should be
-                indices = pad_indices(indices, mask.shape[1])
-                tmp = np.zeros((len(iface_labels), 2))
-                for i in range(len(iface_labels)):
-                    if iface_labels[i] == 1:
-                        tmp[i, 0] = 1
-                    else:
-                        tmp[i, 1] = 1
-                iface_labels_dc = tmp
-                logfile.flush()
-                pos_labels = np.where(iface_labels == 1)[0]
-                neg_labels = np.where(iface_labels == 0)[0]
-                np.random.shuffle(neg_labels)
-                np.random.shuffle(pos_labels)
-                # Scramble neg idx, and only get as many as pos_labels to balance the training.
-                if params["n_conv_layers"] == 1:
-                    n = min(len(pos_labels), len(neg_labels))
-                    n = min(n, batch_size // 2)
-                    subset = np.concatenate([neg_labels[:n], pos_labels[:n]])
-
-                    rho_wrt_center = rho_wrt_center[subset]
-                    theta_wrt_center = theta_wrt_center[subset]
-                    input_feat = input_feat[subset]
-                    mask = mask[subset]
-                    iface_labels_dc = iface_labels_dc[subset]
-                    indices = indices[subset]
-                    pos_labels = range(0, n)
-                    neg_labels = range(n, n * 2)
-                else:
-                    n = min(len(pos_labels), len(neg_labels))
-                    neg_labels = neg_labels[:n]
-                    pos_labels = pos_labels[:n]
-
-                feed_dict = {
-                    learning_obj.rho_coords: rho_wrt_center,
-                    learning_obj.theta_coords: theta_wrt_center,
-                    learning_obj.input_feat: input_feat,
-                    learning_obj.mask: mask,
-                    learning_obj.labels: iface_labels_dc,
-                    learning_obj.pos_idx: pos_labels,
-                    learning_obj.neg_idx: neg_labels,
-                    learning_obj.indices_tensor: indices,
-                }
-
-                if ppi_pair_id in val_dirs:
-                    logfile.write("Validating on {} {}\n".format(ppi_pair_id, pid))
-                    feed_dict[learning_obj.keep_prob] = 1.0
-                    training_loss, score, eval_labels = learning_obj.session.run(
-                        [
-                            learning_obj.data_loss,
-                            learning_obj.eval_score,
-                            learning_obj.eval_labels,
-                        ],
-                        feed_dict=feed_dict,
-                    )
-                    auc = metrics.roc_auc_score(eval_labels[:, 0], score)
-                    list_val_pos_labels.append(np.sum(iface_labels))
-                    list_val_neg_labels.append(len(iface_labels) - np.sum(iface_labels))
-                    list_val_auc.append(auc)
-                    list_val_names.append(ppi_pair_id)
-                    all_val_labels = np.concatenate([all_val_labels, eval_labels[:, 0]])
-                    all_val_scores = np.concatenate([all_val_scores, score])
-                else:
-                    logfile.write("Training on {} {}\n".format(ppi_pair_id, pid))
-                    feed_dict[learning_obj.keep_prob] = 1.0
-                    _, training_loss, norm_grad, score, eval_labels = learning_obj.session.run(
-                        [
-                            learning_obj.optimizer,
-                            learning_obj.data_loss,
-                            learning_obj.norm_grad,
-                            learning_obj.eval_score,
-                            learning_obj.eval_labels,
-                        ],
-                        feed_dict=feed_dict,
-                    )
-                    all_training_labels = np.concatenate(
-                        [all_training_labels, eval_labels[:, 0]]
-                    )
-                    all_training_scores = np.concatenate([all_training_scores, score])
-                    auc = metrics.roc_auc_score(eval_labels[:, 0], score)
-                    list_training_auc.append(auc)
-                    list_training_loss.append(np.mean(training_loss))
-                logfile.flush()
+                train_jobs.append((mydir, pid, "train", train_settings, np.random.randint(2**31)))
+
+        for job, data in loader.iterate(train_jobs):
+            mydir, pid = job[0], job[1]
+            ppi_pair_id = os.path.basename(mydir.rstrip("/"))
+            count_proteins += 1
+            iface_labels = data["iface_labels"]
+            logfile.flush()
+
+            feed_dict = site_feed_dict(learning_obj, data)
+
+            if ppi_pair_id in val_dirs:
+                logfile.write("Validating on {} {}\n".format(ppi_pair_id, pid))
+                feed_dict[learning_obj.keep_prob] = 1.0
+                training_loss, score, eval_labels = learning_obj.session.run(
+                    [
+                        learning_obj.data_loss,
+                        learning_obj.eval_score,
+                        learning_obj.eval_labels,
+                    ],
+                    feed_dict=feed_dict,
+                )
+                auc = metrics.roc_auc_score(eval_labels[:, 0], score)
+                list_val_pos_labels.append(np.sum(iface_labels))
+                list_val_neg_labels.append(len(iface_labels) - np.sum(iface_labels))
+                list_val_auc.append(auc)
+                list_val_names.append(ppi_pair_id)
+                all_val_labels = np.concatenate([all_val_labels, eval_labels[:, 0]])
+                all_val_scores = np.concatenate([all_val_scores, score])
+            else:
+                logfile.write("Training on {} {}\n".format(ppi_pair_id, pid))
+                feed_dict[learning_obj.keep_prob] = 1.0
+                _, training_loss, norm_grad, score, eval_labels = learning_obj.session.run(
+                    [
+                        learning_obj.optimizer,
+                        learning_obj.data_loss,
+                        learning_obj.norm_grad,
+                        learning_obj.eval_score,
+                        learning_obj.eval_labels,
+                    ],
+                    feed_dict=feed_dict,
+                )
+                all_training_labels = np.concatenate(
+                    [all_training_labels, eval_labels[:, 0]]
+                )
+                all_training_scores = np.concatenate([all_training_scores, score])
+                auc = metrics.roc_auc_score(eval_labels[:, 0], score)
+                list_training_auc.append(auc)
+                list_training_loss.append(np.mean(training_loss))
+            logfile.flush()
 
         # Run testing cycle.
+        test_jobs = []
         for ppi_pair_id in data_dirs:
             mydir = params["masif_precomputation_dir"] + ppi_pair_id + "/"
             pdbid = ppi_pair_id.split("_")[0]
@@ -240,61 +296,26 @@ def train_masif_site(
                 pids.append("p2")
             for pid in pids:
                 logfile.write("Testing on {} {}\n".format(ppi_pair_id, pid))
-                try:
-                    iface_labels = np.load(mydir + pid + "_iface_labels.npy")
-                except:
-                    continue
-                if len(iface_labels) > 20000:
-                    continue
-                if (
-                    np.sum(iface_labels) > 0.75 * len(iface_labels)
-                    or np.sum(iface_labels) < 30
-                ):
-                    continue
-                count_proteins += 1
-
-                rho_wrt_center = np.load(mydir + pid + "_rho_wrt_center.npy")
-                theta_wrt_center = np.load(mydir + pid + "_theta_wrt_center.npy")
-                input_feat = np.load(mydir + pid + "_input_feat.npy")
-                if np.sum(params["feat_mask"]) < 5:
-                    input_feat = mask_input_feat(input_feat, params["feat_mask"])
-                mask = np.load(mydir + pid + "_mask.npy")
-                mask = np.expand_dims(mask, 2)
-                indices = np.load(mydir + pid + "_list_indices.npy", encoding="latin1")
-                # indices is (n_verts x <30), it should be
-                indices = pad_indices(indices, mask.shape[1])
-                tmp = np.zeros((len(iface_labels), 2))
-                for i in range(len(iface_labels)):
-                    if iface_labels[i] == 1:
-                        tmp[i, 0] = 1
-                    else:
-                        tmp[i, 1] = 1
-                iface_labels_dc = tmp
-                logfile.flush()
-                pos_labels = np.where(iface_labels == 1)[0]
-                neg_labels = np.where(iface_labels == 0)[0]
-
-                feed_dict = {
-                    learning_obj.rho_coords: rho_wrt_center,
-                    learning_obj.theta_coords: theta_wrt_center,
-                    learning_obj.input_feat: input_feat,
-                    learning_obj.mask: mask,
-                    learning_obj.labels: iface_labels_dc,
-                    learning_obj.pos_idx: pos_labels,
-                    learning_obj.neg_idx: neg_labels,
-                    learning_obj.indices_tensor: indices,
-                }
+                test_jobs.append((mydir, pid, "test", test_settings, None))
 
-                feed_dict[learning_obj.keep_prob] = 1.0
-                score = learning_obj.session.run(
-                    [learning_obj.full_score], feed_dict=feed_dict
-                )
-                score = score[0]
-                auc = metrics.roc_auc_score(iface_labels, score)
-                list_test_auc.append(auc)
-                list_test_names.append((ppi_pair_id, pid))
-                all_test_labels.append(iface_labels)
-                all_test_scores.append(score)
+        for job, data in loader.iterate(test_jobs):
+            mydir, pid = job[0], job[1]
+            ppi_pair_id = os.path.basename(mydir.rstrip("/"))
+            count_proteins += 1
+            iface_labels = data["iface_labels"]
+            logfile.flush()
+
+            feed_dict = site_feed_dict(learning_obj, data)
+            feed_dict[learning_obj.keep_prob] = 1.0
+            score = learning_obj.session.run(
+                [learning_obj.full_score], feed_dict=feed_dict
+            )
+            score = score[0]
+            auc = metrics.roc_auc_score(iface_labels, score)
+            list_test_auc.append(auc)
+            list_test_names.append((ppi_pair_id, pid))
+            all_test_labels.append(iface_labels)
+            all_test_scores.append(score)
 
         outstr = "Epoch ran on {} proteins\n".format(count_proteins)
         outstr += "Per protein AUC mean (training): {:.4f}; median: {:.4f} for iter {}\n".format(
@@ -312,6 +333,10 @@ def train_masif_site(
             metrics.roc_auc_score(flat_all_test_labels, flat_all_test_scores)
         )
         outstr += "Epoch took {:2f}s\n".format(time.time() - tic)
+        outstr += "Waiting for input data took {:.2f}s\n".format(loader.reset_stall_time())
+        if cache is not None:
+            outstr += cache.stats() + "\n"
+            cache.reset_stats()
         logfile.write(outstr + "\n")
         print(outstr)
 
@@ -326,4 +351,5 @@ def train_masif_site(
             np.save(out_dir + "test_scores.npy", all_test_scores)
             np.save(out_dir + "test_names.npy", list_test_names)
 
+    loader.close()
     logfile.close()
@@ -1,5 +1,6 @@
 import time
 import math
+import threading
 from sklearn import metrics
 import numpy as np
 import sys
@@ -149,10 +150,7 @@ def compute_val_test_desc(
             learning_obj.keep_prob: 1.0,
         }
 
-        desc = learning_obj.session.run([learning_obj.global_desc], feed_dict=feed_dict)
-        desc = np.squeeze(desc)
-        if len(desc.shape) == 1:
-            desc = np.expand_dims(desc, 0)
+        desc = learning_obj.session.run(learning_obj.global_desc, feed_dict=feed_dict)
         all_descs.append(desc)
 
     if len(all_descs) > 1:
@@ -169,6 +167,88 @@ def compute_roc_auc(pos, neg):
 
 
 # Randomly pick
+class HardNegativeSampler:
+    """
+    Hard negatives for train_ppi_search: the negative patches whose descriptors are closest to the
+    (flipped) descriptor of the binder, instead of random ones.
+    Every refresh_every iterations, the descriptors of n_pos random training binders and n_neg random
+    training negatives are recomputed with the current model in a background thread, which shares the
+    session with the training loop, and the n_candidates nearest negatives of each binder are kept.
+    The binders of a batch are still drawn from all training binders; a fraction hard_fraction of the
+    ones in the last refresh get one of their nearest negatives, the others keep their random negative.
+    """
+    def __init__(
+        self,
+        learning_obj,
+        binder_arrays,
+        pos_training_idx,
+        neg_arrays,
+        neg_training_idx,
+        n_pos=2000,
+        n_neg=20000,
+        n_candidates=10,
+        hard_fraction=0.5,
+        refresh_every=1000,
+        batch_size=1000,
+    ):
+        # binder_arrays and neg_arrays: (rho_wrt_center, theta_wrt_center, input_feat, mask)
+        self.learning_obj = learning_obj
+        self.binder_arrays = binder_arrays
+        self.pos_training_idx = np.asarray(pos_training_idx)
+        self.neg_arrays = neg_arrays
+        self.neg_training_idx = np.asarray(neg_training_idx)
+        self.n_pos = n_pos
+        self.n_neg = n_neg
+        self.n_candidates = n_candidates
+        self.hard_fraction = hard_fraction
+        self.refresh_every = refresh_every
+        self.batch_size = batch_size
+        # (binder idx, nearest negative idx of each binder, mean distance), replaced by each refresh
+        self.table = None
+        self.thread = None
+        self.n_refreshes = 0
+
+    def step(self, num_iter):
+        # Start a refresh every refresh_every iterations, unless the previous one is still running
+        if num_iter % self.refresh_every == 0 and (self.thread is None or not self.thread.is_alive()):
+            self.thread = threading.Thread(target=self.refresh, daemon=True)
+            self.thread.start()
+
+    def refresh(self):
+        from masif_modules.descriptor_index import exact_search
+
+        pos_idx = np.sort(
+            np.random.choice(self.pos_training_idx, min(self.n_pos, len(self.pos_training_idx)), replace=False)
+        )
+        neg_idx = np.random.choice(self.neg_training_idx, min(self.n_neg, len(self.neg_training_idx)), replace=False)
+        binder_desc = compute_val_test_desc(
+            self.learning_obj, pos_idx, *self.binder_arrays, batch_size=self.batch_size, flip=True
+        )
+        neg_desc = compute_val_test_desc(self.learning_obj, neg_idx, *self.neg_arrays, batch_size=self.batch_size)
+        nearest, dists = exact_search(neg_desc, binder_desc, min(self.n_candidates, len(neg_idx)))
+        self.table = (pos_idx, neg_idx[nearest], np.mean(dists))
+        self.n_refreshes += 1
+
+    def negatives(self, pos_idx, neg_idx):
+        """
+        The random negative idx neg_idx of the binders pos_idx, with hard negatives for a fraction
+        hard_fraction of the binders that are in the last refresh.
+        """
+        table = self.table
+        if table is None:
+            return neg_idx
+        table_pos, candidates, _ = table
+        rows = np.minimum(np.searchsorted(table_pos, pos_idx), len(table_pos) - 1)
+        hard = (table_pos[rows] == pos_idx) & (np.random.rand(len(pos_idx)) < self.hard_fraction)
+        neg_idx = np.array(neg_idx)
+        neg_idx[hard] = candidates[rows[hard], np.random.randint(candidates.shape[1], size=hard.sum())]
+        return neg_idx
+
+    def close(self):
+        if self.thread is not None:
+            self.thread.join()
+
+
 def train_ppi_search(
     learning_obj,
     params,
@@ -194,7 +274,14 @@ def train_ppi_search(
     num_iter_test=1000,
     batch_size=32,
     batch_size_val_test=1000,
+    hard_negatives=False,
+    hard_negative_every=1000,
+    hard_negative_fraction=0.5,
 ):
+    """
+    With hard_negatives, a fraction hard_negative_fraction of the negatives are among the closest to the
+    binder, recomputed every hard_negative_every iterations (see HardNegativeSampler).
+    """
 
     out_dir = params["model_dir"]
     logfile = open(out_dir + "log.txt", "w")
@@ -244,6 +331,19 @@ def train_ppi_search(
         32178,
     ]
 
+    sampler = None
+    if hard_negatives:
+        sampler = HardNegativeSampler(
+            learning_obj,
+            (binder_rho_wrt_center, binder_theta_wrt_center, binder_input_feat, binder_mask),
+            pos_training_idx,
+            (neg_rho_wrt_center, neg_theta_wrt_center, neg_input_feat, neg_mask),
+            neg_training_idx,
+            hard_fraction=hard_negative_fraction,
+            refresh_every=hard_negative_every,
+            batch_size=batch_size_val_test,
+        )
+
     tic = time.time()
     for num_iter in range(num_iterations):
         # Read dataset for training.
@@ -254,6 +354,9 @@ def train_ppi_search(
 
         c_pos_training_idx = pos_training_idx_copy[: batch_size // 4]
         c_neg_training_idx = neg_training_idx_copy[: batch_size // 4]
+        if sampler is not None:
+            sampler.step(num_iter)
+            c_neg_training_idx = sampler.negatives(c_pos_training_idx, c_neg_training_idx)
 
         c_neg_training_idx_2 = None
 
@@ -322,6 +425,12 @@ def train_ppi_search(
             roc_auc = 1 - compute_roc_auc(iter_pos_score, iter_neg_score)
             logfile.write("training_loss: {}\n".format(np.mean(list_training_loss)))
             print("Approx Training ROC AUC: {}\n ".format(roc_auc))
+            if sampler is not None and sampler.table is not None:
+                print(
+                    "Hard negatives: {} refreshes, mean distance {:.3f}".format(
+                        sampler.n_refreshes, sampler.table[2]
+                    )
+                )
             print(
                 "Mean training positive score: {} ".format(
                     np.mean(1.0 / iter_pos_score)
@@ -477,3 +586,5 @@ def train_ppi_search(
                 np.save(out_dir + "neg_test_idx.npy", neg_test_idx)
                 np.save(out_dir + "neg_desc_2.npy", neg_desc_2)
 
+    if sampler is not None:
+        sampler.close()
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+"""
+profiling.py: Per-stage timing and resource use of the surface pipeline.
+
+A Profiler collects, for every stage run while it is active, the wall time, the CPU time of the
+process and of the external programs it waited for, the current RSS at the start and end of the
+stage, the peak RSS of the process so far (process_peak_rss_mb, which includes the earlier stages)
+and the input sizes reported by the stage (atoms, MSMS vertices, mesh vertices, patches, ...). Each molecule is written as one JSON
+line; running this file aggregates JSON lines files over a batch:
+
+    python profiling.py profile.jsonl [more.jsonl ...]
+
+Stages are marked in the code with the stage context manager or the profiled decorator, which do
+nothing when no Profiler is active.
+Released under an Apache License 2.0
+"""
+import argparse
+import json
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+
+
+# Stack of the active profilers in this process
+ACTIVE = []
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def rss_mb():
+    """
+    Current resident set size (Linux), or the peak RSS where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+
+class RSSSampler:
+    """
+    Current RSS (rss_mb) at the start and end of a block, and its peak within the block, sampled
+    every interval seconds in a background thread. Unlike peak_rss_mb, the peak over the lifetime of
+    the process, this measures the memory used by the block itself; allocations shorter than the
+    interval can be missed.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+
+    def __enter__(self):
+        self.start = rss_mb()
+        self.peak = self.start
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def __exit__(self, exc_type, exc, tb):
+        self.done.set()
+        self.thread.join()
+        self.end = rss_mb()
+        self.peak = max(self.peak, self.end)
+        return False
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Profiler:
+    """
+    Record the stages of the computation of one molecule.
+        name: name of the molecule
+        path: JSON lines file the record is appended to when the profiler exits (optional)
+    """
+    def __init__(self, name, path=None):
+        self.name = name
+        self.path = path
+        self.stages = []
+        self.names = []
+
+    def __enter__(self):
+        ACTIVE.append(self)
+        self.start_time = time.time()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.child_cpu = children_cpu()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        ACTIVE.remove(self)
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+        self.child_cpu = children_cpu() - self.child_cpu
+        self.failed = exc_type is not None
+        if self.path is not None:
+            self.write(self.path)
+        return False
+
+    @contextmanager
+    def stage(self, name, **sizes):
+        """
+        Time a stage. Nested stages are named parent/child. Yields a dictionary where the
+        stage can add its sizes (e.g. info['mesh_vertices'] = n).
+        """
+        self.names.append(name)
+        full_name = '/'.join(self.names)
+        info = dict(sizes)
+        rss_start = rss_mb()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        child_cpu = children_cpu()
+        try:
+            yield info
+        finally:
+            self.names.pop()
+            self.stages.append({'stage':full_name,
+                                'wall':time.perf_counter() - wall,
+                                'cpu':time.process_time() - cpu,
+                                'child_cpu':children_cpu() - child_cpu,
+                                'rss_start_mb':rss_start,
+                                'rss_end_mb':rss_mb(),
+                                'process_peak_rss_mb':peak_rss_mb(),
+                                **info})
+
+    def timings(self):
+        """
+        Wall time of each stage (summed if a stage ran several times).
+        """
+        out = defaultdict(float)
+        for s in self.stages:
+            out[s['stage']] += s['wall']
+        return dict(out)
+
+    def record(self):
+        return {'molecule':self.name, 'start':time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start_time)),
+                'wall':self.wall, 'cpu':self.cpu, 'child_cpu':self.child_cpu,
+                'process_peak_rss_mb':peak_rss_mb(), 'child_peak_rss_mb':peak_rss_mb(resource.RUSAGE_CHILDREN),
+                'failed':self.failed, 'stages':self.stages}
+
+    def write(self, path):
+        with open(path, 'a') as o:
+            o.write(json.dumps(self.record(), default=float) + '\n')
+
+
+@contextmanager
+def stage(name, **sizes):
+    """
+    Time a stage with the active profiler, if any.
+    """
+    if len(ACTIVE) == 0:
+        yield dict(sizes)
+        return
+    with ACTIVE[-1].stage(name, **sizes) as info:
+        yield info
+
+
+def profiled(name=None):
+    """
+    Decorator timing every call of a function as a stage (named after the function by default).
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def read_records(paths):
+    records = []
+    for path in paths:
+        with open(path, 'r') as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return records
+
+
+def aggregate(records):
+    """
+    Aggregate the stages over a batch of molecules. Returns {stage: statistics}, where the
+    statistics are the number of calls, the total / mean / median / 95th percentile of the
+    wall time, the total CPU time, the fraction of the total wall time of all molecules and the
+    largest increase of the RSS over one call.
+    """
+    wall = defaultdict(list)
+    cpu = defaultdict(float)
+    rss = defaultdict(float)
+    for r in records:
+        for s in r['stages']:
+            wall[s['stage']].append(s['wall'])
+            cpu[s['stage']] += s['cpu'] + s['child_cpu']
+            if 'rss_end_mb' in s:
+                rss[s['stage']] = max(rss[s['stage']], s['rss_end_mb'] - s['rss_start_mb'])
+    total = sum(r['wall'] for r in records)
+    summary = {}
+    for k, v in wall.items():
+        v = np.array(v)
+        summary[k] = {'calls':len(v), 'total':v.sum(), 'mean':v.mean(), 'p50':np.percentile(v, 50),
+                      'p95':np.percentile(v, 95), 'cpu':cpu[k], 'fraction':v.sum() / total if total > 0 else 0,
+                      'rss_growth_mb':rss[k]}
+    return summary
+
+
+def print_summary(records):
+    summary = aggregate(records)
+    print(f"{len(records)} molecules, {sum(r['wall'] for r in records):.1f} s wall, "
+          f"max peak RSS {max([process_peak(r) for r in records], default=0):.0f} MB")
+    print(f"{'stage':<40s} {'calls':>6s} {'total [s]':>10s} {'mean [s]':>9s} {'p50 [s]':>8s} {'p95 [s]':>8s} {'cpu [s]':>8s} {'%':>6s} "
+          f"{'+RSS [MB]':>10s}")
+    for k, s in sorted(summary.items(), key=lambda kv: -kv[1]['total']):
+        print(f"{k:<40s} {s['calls']:6d} {s['total']:10.2f} {s['mean']:9.3f} {s['p50']:8.3f} {s['p95']:8.3f} "
+              f"{s['cpu']:8.2f} {100*s['fraction']:6.1f} {s['rss_growth_mb']:10.1f}")
+
+
+def process_peak(record):
+    # Peak RSS of a record, also from the files written before it was named process_peak_rss_mb
+    return record.get('process_peak_rss_mb', record.get('peak_rss_mb', 0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Aggregate the per-stage profiles of a batch of molecules')
+    parser.add_argument('paths', nargs='+', help='JSON lines files written with --profile')
+    print_summary(read_records(parser.parse_args().paths))
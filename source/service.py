@@ -0,0 +1,292 @@
+#!/usr/bin/python
+"""
+service.py: Long-lived surface computation service. A pool of worker processes is started once, with the
+imports loaded, the APBS template read and a scratch directory ready, and computes the surfaces sent to
+it over HTTP, so that many small molecules do not each pay the startup of main.py.
+
+    POST /surface?name=1abc.pdb&chain=A&hphob=1   body: the PDB / PQR file
+        Options are the ones of main.py (flags as name=1, lists as comma separated values).
+        Returns an .npz file with the vertices, faces, vertex_normals, the features (feature_<name>)
+        and, with patches=1, the patches (centers, input_feat, rho, theta, mask, neigh_indices).
+    GET /metrics
+        Queue depth, running and completed requests and the latency of each stage, as JSON.
+
+Example: curl --data-binary @1abc.pdb 'http://localhost:8250/surface?name=1abc.pdb&hphob=1' -o 1abc.npz
+Released under an Apache License 2.0
+"""
+import argparse
+import importlib
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import BoundedSemaphore, Pool
+from pathlib import Path
+from urllib.parse import urlparse, parse_qsl
+
+import numpy as np
+
+from default_config.masif_opts import masif_opts
+from main import build_parser, compute_surface_data, compute_patches, feature_arrays
+from profiling import Profiler, stage
+
+
+# Modules loaded by each worker when it starts.
+WARM_MODULES = ['pymesh', 'sklearn.neighbors', 'input_output.extractPDB', 'input_output.protonate',
+                'triangulation.computeMSMS', 'triangulation.computeCharges', 'triangulation.computeHydrophobicity',
+                'triangulation.computeAPBS', 'triangulation.fixmesh', 'triangulation.compute_normal',
+                'masif_modules.read_data_from_surface', 'geometry.patch_centers']
+
+# Options of main.py that refer to files of the server, or to the output, and are not accepted. The
+# patches of a request are returned in one .npz, so the options that stream them to disk do not apply.
+REJECTED_OPTIONS = ['output_dir', 'centers_file', 'redo', 'profile', 'geodesics', 'chunk_size', 'max_memory_mb']
+
+# Per-worker state, set once by init_worker
+WORKER = {}
+
+
+class OptionError(Exception):
+    pass
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Serve molecular surface computations over HTTP with warm workers')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8250, help='Port to listen on')
+    parser.add_argument('-n', '--workers', type=int, default=4, help='Number of worker processes (Python CPU work)')
+    parser.add_argument('--msms_slots', type=int, default=4, help='Maximum number of MSMS processes running at once')
+    parser.add_argument('--apbs_slots', type=int, default=2, help='Maximum number of APBS processes running at once')
+    parser.add_argument('--scratch_dir', default=masif_opts['tmp_dir'], help='Directory for the scratch directories of the workers')
+    return parser.parse_args()
+
+
+def init_worker(msms_sem, apbs_sem, scratch_root):
+    from triangulation.computeAPBS import read_apbs_template
+
+    for m in WARM_MODULES:
+        importlib.import_module(m)
+    scratch = Path(tempfile.mkdtemp(prefix='masif_worker_', dir=scratch_root))
+    masif_opts['tmp_dir'] = str(scratch)
+
+    WORKER['scratch'] = scratch
+    WORKER['msms_sem'] = msms_sem
+    WORKER['apbs_sem'] = apbs_sem
+    WORKER['apbs_template'] = read_apbs_template(Path(__file__).resolve().parent.joinpath('apbs_input.in'))
+
+
+class Slot:
+    """
+    Hold a semaphore while an external program runs, recording the time spent waiting for it as the stage {name}_wait.
+    """
+    def __init__(self, sem, name):
+        self.sem = sem
+        self.name = name
+
+    def __enter__(self):
+        with stage(f"{self.name}_wait"):
+            self.sem.acquire()
+
+    def __exit__(self, *exc):
+        self.sem.release()
+
+
+def pad_indices(neigh_idx, max_size):
+    out = -np.ones((len(neigh_idx), max_size), dtype=np.int32)
+    for i, neigh in enumerate(neigh_idx):
+        out[i,:len(neigh)] = neigh[:max_size]
+    return out
+
+
+def compute_request(job):
+    """
+    Compute the surface of one request in a worker. Returns the .npz file as bytes, and the
+    profile of the request (see profiling.Profiler).
+    """
+    name, data, args = job
+    scratch = WORKER['scratch']
+    try:
+        with Profiler(Path(name).stem) as prof:
+            path = scratch.joinpath(name)
+            path.write_bytes(data)
+            mesh, vertex_normals, features = compute_surface_data(path, args, scratch, WORKER['apbs_template'],
+                                                                  msms_slot=Slot(WORKER['msms_sem'], 'msms'),
+                                                                  apbs_slot=Slot(WORKER['apbs_sem'], 'apbs'))
+            arrays = {'vertices':mesh.vertices, 'faces':mesh.faces, 'vertex_normals':vertex_normals}
+            for k, v in feature_arrays(features).items():
+                arrays[f"feature_{k}"] = v
+
+            if args.patches:
+                centers, (input_feat, rho, theta, mask, neigh_idx) = compute_patches(mesh, vertex_normals, features, args)
+                arrays.update({'centers':np.arange(len(mesh.vertices)) if centers is None else centers,
+                               'input_feat':input_feat, 'rho':rho, 'theta':theta, 'mask':mask,
+                               'neigh_indices':pad_indices(neigh_idx, args.patch_max_size)})
+
+            with stage('serialize'):
+                buf = io.BytesIO()
+                np.savez(buf, **arrays)
+    finally:
+        # Clear the scratch directory for the next request
+        for f in scratch.iterdir():
+            if f.is_dir():
+                shutil.rmtree(f, ignore_errors=True)
+            else:
+                f.unlink()
+    return buf.getvalue(), prof.record()
+
+
+def parse_options(query):
+    """
+    Convert the query parameters into the arguments of main.py. Returns the file name and the arguments.
+    """
+    parser = build_parser()
+    def error(message):
+        raise OptionError(message)
+    parser.error = error
+
+    options = dict(query)
+    name = Path(options.pop('name', 'input.pdb')).name
+    if Path(name).suffix not in ['.pdb', '.pqr'] or Path(name).stem == '':
+        raise OptionError(f"name should be a .pdb or .pqr file name, got '{name}'")
+
+    argv = [name]
+    for key, value in options.items():
+        action = parser._option_string_actions.get(f"--{key}")
+        if action is None or key in REJECTED_OPTIONS:
+            raise OptionError(f"unknown option '{key}'")
+        if action.nargs == 0:
+            if value.lower() in ['', '1', 'true', 'yes']:
+                argv.append(f"--{key}")
+        elif action.nargs is None:
+            argv += [f"--{key}", value]
+        else:
+            argv += [f"--{key}"] + value.split(',')
+    return name, parser.parse_args(argv)
+
+
+class SurfaceService:
+    """
+    Pool of warm workers. Python CPU work is bounded by the number of workers, and each
+    external program by its own semaphore, shared by all workers.
+    """
+    def __init__(self, n_workers, msms_slots, apbs_slots, scratch_root):
+        self.n_workers = n_workers
+        self.slots = {'msms':msms_slots, 'apbs':apbs_slots}
+        self.workers = threading.BoundedSemaphore(n_workers)
+        self.pool = Pool(n_workers, initializer=init_worker,
+                         initargs=(BoundedSemaphore(msms_slots), BoundedSemaphore(apbs_slots), scratch_root))
+        self.lock = threading.Lock()
+        self.counts = {'waiting':0, 'running':0, 'completed':0, 'failed':0}
+        self.latency = defaultdict(lambda: deque(maxlen=1000))
+        self.peak_rss_mb = 0
+
+    def count(self, key, inc):
+        with self.lock:
+            self.counts[key] += inc
+
+    def compute(self, name, data, args):
+        start = time.perf_counter()
+        self.count('waiting', 1)
+        with self.workers:
+            self.count('waiting', -1)
+            self.count('running', 1)
+            queued = time.perf_counter() - start
+            try:
+                result, record = self.pool.apply(compute_request, ((name, data, args),))
+            except Exception:
+                self.count('failed', 1)
+                raise
+            finally:
+                self.count('running', -1)
+        self.count('completed', 1)
+
+        # Wall time of each stage, and of the whole request
+        timings = defaultdict(float)
+        for s in record['stages']:
+            timings[s['stage']] += s['wall']
+        timings['queue'] = queued
+        timings['total'] = time.perf_counter() - start
+        with self.lock:
+            for k, v in timings.items():
+                self.latency[k].append(v)
+            self.peak_rss_mb = max(self.peak_rss_mb, record['process_peak_rss_mb'])
+        return result, timings
+
+    def metrics(self):
+        with self.lock:
+            stages = {}
+            for k, v in self.latency.items():
+                v = np.array(v)
+                stages[k] = {'count':len(v), 'mean':float(v.mean()), 'p50':float(np.percentile(v, 50)),
+                             'p95':float(np.percentile(v, 95)), 'max':float(v.max())}
+            return {'queue_depth':self.counts['waiting'], 'running':self.counts['running'],
+                    'completed':self.counts['completed'], 'failed':self.counts['failed'],
+                    'workers':self.n_workers, 'slots':self.slots, 'worker_peak_rss_mb':self.peak_rss_mb,
+                    'latency_s':stages}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def send_bytes(self, code, body, content_type, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        # Stream the response in chunks
+        view = memoryview(body)
+        for i in range(0, len(body), 1 << 20):
+            self.wfile.write(view[i:i + (1 << 20)])
+
+    def send_text(self, code, text):
+        self.send_bytes(code, (text + '\n').encode(), 'text/plain')
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self.send_bytes(200, json.dumps(self.server.service.metrics(), indent=1).encode(), 'application/json')
+        elif path == '/health':
+            self.send_text(200, 'ok')
+        else:
+            self.send_text(404, f"unknown path {path}")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/surface':
+            self.send_text(404, f"unknown path {url.path}")
+            return
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            name, args = parse_options(parse_qsl(url.query, keep_blank_values=True))
+        except OptionError as e:
+            self.send_text(400, str(e))
+            return
+        try:
+            result, timings = self.server.service.compute(name, data, args)
+        except Exception as e:
+            self.send_text(500, f"{type(e).__name__}: {e}")
+            return
+        self.send_bytes(200, result, 'application/octet-stream',
+                        {'X-Masif-Timings':json.dumps({k:round(v, 4) for k, v in timings.items()})})
+
+
+def serve(args):
+    service = SurfaceService(args.workers, args.msms_slots, args.apbs_slots, args.scratch_dir)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.service = service
+    print(f"Serving surfaces on http://{args.host}:{args.port} with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.pool.terminate()
+
+
+if __name__ == "__main__":
+    serve(parse_arguments())
@@ -0,0 +1,337 @@
+#!/usr/bin/python
+"""
+tiling.py: Compute the surface, features and patches of a very large assembly (e.g. a viral capsid)
+in spatial tiles, so that MSMS and the geodesic distances only ever see one tile at a time.
+
+The atoms are divided into cubic tiles of --tile_size A. Each tile is computed (in parallel) from the
+atoms of its core box plus a halo around it, which is wide enough for the surface and the patches of
+the vertices in the core to be the same as in the whole assembly. Only the vertices inside the core
+box are kept, and the tiles are stitched into one surface, saved as main.py does. The peak memory of
+a worker depends on the size of a tile, not of the assembly. The patches of each tile are written to
+temporary files by its worker, and copied a chunk at a time to the patch files of the assembly (see
+input_output.patch_writer), so the parent only holds the surface.
+
+A face that crosses the boundary between two tiles is kept once, by the tile whose core box holds its
+centroid, and its vertices in the halo of that tile are matched to the vertices owned by the
+neighbouring tiles (see match_halo), so the stitched mesh has no seams. In the same way, the patch
+members of a vertex near the boundary that are in the halo of its tile keep the coordinates and
+features computed in the tile, and their indices are those of the matching vertices owned by the
+neighbouring tiles. The electrostatics of each tile are computed from the atoms of the tile and its
+halo only.
+Released under an Apache License 2.0
+"""
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+# Local includes
+from default_config.masif_opts import masif_opts
+from main import (build_parser, prepare_input, msms_arguments, regularize_surface, add_curvature, compute_patches,
+                  get_center_selection, save_features, save_centers)
+from profiling import Profiler, stage
+
+
+# Per-worker state, set once by init_worker
+WORKER = {}
+
+PATCH_FILES = ['input_feat', 'rho_wrt_center', 'theta_wrt_center', 'mask', 'list_indices']
+
+
+def parse_arguments():
+    parser = build_parser()
+    parser.description = ('Compute the molecular surface of a large assembly in spatial tiles. Faces that cross the '
+                          'boundary between two tiles are kept by the tile that holds their centroid.')
+    parser.add_argument('--tile_size', type=float, default=80.0, help='Edge of the core box of each tile, in A')
+    parser.add_argument('--halo', type=float, default=None, help='Width of the halo of atoms around each tile, in A '
+                        '(default: patch radius + twice the probe radius + largest atom radius)')
+    parser.add_argument('-n', '--n_jobs', type=int, default=1, help='Number of tiles processed in parallel')
+    args = parser.parse_args()
+    if args.tile_size <= 0:
+        parser.error('--tile_size must be positive')
+    return args
+
+
+def tile_box(ijk, origin, tile_size, shape):
+    """
+    Core box of a tile. The box of a tile at the border of the grid extends to infinity.
+    """
+    ijk = np.asarray(ijk)
+    lo = origin + ijk * tile_size
+    hi = lo + tile_size
+    lo = np.where(ijk == 0, -np.inf, lo)
+    hi = np.where(ijk == np.array(shape) - 1, np.inf, hi)
+    return lo, hi
+
+
+def in_box(points, lo, hi, margin=0.0):
+    return np.all((points >= lo - margin) & (points < hi + margin), axis=1)
+
+
+def residue_keys(atom_lines):
+    # Chain, residue number and insertion code of each atom
+    return np.array([line[21:27] for line in atom_lines])
+
+
+def make_tiles(topology, tile_size, halo, reach):
+    """
+    Divide the atoms into tiles. Returns a list of (grid index, core box, atoms), where atoms are the
+    indices of the atoms within halo of the core box, extended to complete residues. Only the tiles
+    with surface atoms within reach of the core box (i.e. that can own surface vertices) are returned.
+    """
+    coords = topology['coords']
+    surface_atoms = coords[topology['atom_idx']]
+    origin = surface_atoms.min(axis=0)
+    shape = np.maximum(np.ceil((surface_atoms.max(axis=0) - origin) / tile_size).astype(int), 1)
+    residues, residue_of_atom = np.unique(residue_keys(topology['atom_lines']), return_inverse=True)
+
+    tiles = []
+    for ijk in np.ndindex(*shape):
+        lo, hi = tile_box(ijk, origin, tile_size, shape)
+        if not in_box(surface_atoms, lo, hi, reach).any():
+            continue
+        selected = np.zeros(len(residues), dtype=bool)
+        selected[residue_of_atom[in_box(coords, lo, hi, halo)]] = True
+        atoms = np.where(selected[residue_of_atom])[0]
+        tiles.append((ijk, (lo, hi), atoms))
+    return tiles, origin, shape
+
+
+def init_worker(topology, args, apbs_template, tmp_dir):
+    WORKER['topology'] = topology
+    WORKER['args'] = args
+    WORKER['apbs_template'] = apbs_template
+    WORKER['tmp_dir'] = tmp_dir
+
+
+def compute_tile(job):
+    """
+    Compute the surface, features and patches of one tile, from the atoms of its core box and halo.
+    Returns the part of the tile mesh in the core box (the vertices owned by the tile and the faces
+    whose centroid is in the box), the features of the owned vertices, and the positions of the halo
+    vertices that are patch members or vertices of these faces.
+    The patches centered on the owned vertices are written to temporary files with a PatchWriter,
+    with the owned vertices numbered first and the halo vertices after them; the result has their
+    centers and path.
+    """
+    from input_output.patch_writer import PatchWriter
+    from input_output.read_trajectory import write_frame
+    from triangulation.computeMSMS import computeMSMS_atoms
+    from triangulation.computeCharges import computeCharges
+    from triangulation.computeHydrophobicity import computeHydrophobicity
+    from triangulation.computeAPBS import computeAPBS
+
+    n, (lo, hi), atoms = job
+    topology, args, tmp_dir = WORKER['topology'], WORKER['args'], WORKER['tmp_dir']
+    stem = f"{topology['path'].stem}_tile{n:04d}"
+    features = {}
+
+    with Profiler(stem, args.profile):
+        # Atoms of the tile, as a PDB / PQR file for the hydrogen bonds and electrostatics
+        path_tile = tmp_dir.joinpath(f"{stem}{topology['path'].suffix}")
+        write_frame(path_tile, {'atom_lines':[topology['atom_lines'][i] for i in atoms]}, topology['coords'][atoms])
+
+        # Surface atoms of the tile
+        surface_atoms = np.intersect1d(topology['atom_idx'], atoms)
+        position = np.searchsorted(topology['atom_idx'], surface_atoms)
+        R = [topology['R'][i] for i in position]
+        full_ids = [topology['full_ids'][i] for i in position]
+
+        with stage('msms', atoms=len(surface_atoms)) as info:
+            vertices, faces, normals, names, areas = computeMSMS_atoms(topology['coords'][surface_atoms], R, full_ids,
+                                                                       msms_arguments(args))
+            info['msms_vertices'] = len(vertices)
+
+        vertex_hbond = None
+        if args.hbond:
+            with stage('hbond'):
+                vertex_hbond = computeCharges(path_tile, vertices, names)
+
+        vertex_hphob = None
+        if args.hphob:
+            vertex_hphob = computeHydrophobicity(names)
+
+        with stage('regularize') as info:
+            mesh, vertex_normals, features = regularize_surface(vertices, faces, names, features, args,
+                                                                vertex_hbond=vertex_hbond, vertex_hphob=vertex_hphob)
+            info['mesh_vertices'] = len(mesh.vertices)
+
+        if not args.no_apbs:
+            with stage('apbs', mesh_vertices=len(mesh.vertices)):
+                vertex_charges = computeAPBS(mesh.vertices, path_tile, tmp_dir, WORKER['apbs_template'])
+            features['charge'] = vertex_charges / 10
+
+        with stage('curvature'):
+            features = add_curvature(mesh, features)
+
+        # Vertices owned by this tile, then the halo vertices of its faces and patches
+        owned = in_box(mesh.vertices, lo, hi)
+        faces = np.asarray(mesh.faces)
+        faces = faces[in_box(np.asarray(mesh.vertices)[faces].mean(axis=1), lo, hi)]
+        used = owned.copy()
+        used[faces] = True
+        centers, patches, path_patches = None, None, None
+        if args.patches:
+            centers, patches = compute_patches(mesh, vertex_normals, features, args, within=np.where(owned)[0])
+            for neigh in patches[4]:
+                used[np.asarray(neigh, dtype=int)] = True
+        halo = used & ~owned
+        index = -np.ones(len(mesh.vertices), dtype=int)
+        index[owned] = np.arange(owned.sum())
+        index[halo] = owned.sum() + np.arange(halo.sum())
+
+        if args.patches:
+            input_feat, rho, theta, mask, neigh_idx = patches
+            centers = index[centers]
+            patches = (input_feat, rho, theta, mask, [index[np.asarray(neigh, dtype=int)] for neigh in neigh_idx])
+            path_patches = tmp_dir.joinpath(f"{stem}_patches.npy")
+            writer = PatchWriter(path_patches, len(centers), args.patch_max_size, input_feat.shape[2])
+            writer.write(0, centers, patches)
+            del patches
+
+    vertices = np.array(mesh.vertices)
+    return {'vertices':vertices[owned], 'halo':vertices[halo], 'faces':index[faces],
+            'features':{k: np.asarray(v)[owned] for k, v in features.items()},
+            'centers':centers, 'patches':path_patches}
+
+
+def match_halo(tree, tile_of, halo, tile, k=8):
+    """
+    Index in the stitched surface of the vertex matching each halo vertex of a tile: the nearest of the
+    vertices owned by another tile (the halo vertices are outside the core box of their own tile).
+        tree: cKDTree of the stitched vertices, tile_of: tile of each stitched vertex
+    """
+    if len(halo) == 0:
+        return np.zeros(0, dtype=int)
+    k = min(k, len(tile_of))
+    idx = tree.query(halo, k=k)[1].reshape(len(halo), k)
+    other = tile_of[idx] != tile
+    # The nearest vertex of any tile if none of the k nearest is owned by another tile
+    first = np.where(other.any(axis=1), np.argmax(other, axis=1), 0)
+    return idx[np.arange(len(halo)), first]
+
+
+def stitch(tiles):
+    """
+    Stitch the surfaces of the tiles, each restricted to the vertices it owns, into one surface. The
+    halo vertices of the faces of each tile are replaced by the matching vertices of the neighbouring
+    tiles (see match_halo); the faces that become degenerate or repeated are removed.
+    Returns the vertices, faces, features, and for each tile the index in the stitched surface of
+    its owned vertices followed by its halo vertices.
+    """
+    from scipy.spatial import cKDTree
+
+    offsets = np.cumsum([0] + [len(t['vertices']) for t in tiles])
+    vertices = np.concatenate([t['vertices'] for t in tiles])
+    features = {k: np.concatenate([t['features'][k] for t in tiles]) for k in tiles[0]['features']}
+
+    tree = cKDTree(vertices)
+    tile_of = np.repeat(np.arange(len(tiles)), np.diff(offsets))
+    stitched_index = [np.concatenate([offset + np.arange(len(t['vertices'])), match_halo(tree, tile_of, t['halo'], n)])
+                      for n, (t, offset) in enumerate(zip(tiles, offsets))]
+
+    faces = np.concatenate([index[t['faces']].reshape(-1, 3) for t, index in zip(tiles, stitched_index)])
+    faces = faces[(faces[:,0] != faces[:,1]) & (faces[:,1] != faces[:,2]) & (faces[:,0] != faces[:,2])]
+    # Faces with the same vertices, e.g. matched by two tiles from both sides of the boundary
+    faces = faces[np.sort(np.unique(np.sort(faces, axis=1), axis=0, return_index=True)[1])]
+    return vertices, faces, features, stitched_index
+
+
+def write_patches(path, tiles, stitched_index, max_vertices, chunk_size=4096):
+    """
+    Copy the patches of the tiles, written by compute_tile, to the patch files of path (as main.py
+    does), a chunk at a time, with the vertex indices of each tile mapped to the stitched surface
+    (see stitch). The files of the tiles are removed. Returns the centers of the patches in the
+    stitched surface.
+    """
+    from input_output.patch_writer import PatchWriter
+
+    tiles = [(t, index) for t, index in zip(tiles, stitched_index) if t['patches'] is not None]
+    n_feat = np.load(patch_file(tiles[0][0]['patches'], 'input_feat'), mmap_mode='r').shape[2]
+    writer = PatchWriter(path, sum(len(t['centers']) for t, _ in tiles), max_vertices, n_feat)
+    centers = []
+    for t, index in tiles:
+        n = len(t['centers'])
+        if n > 0:
+            arrays = [np.load(patch_file(t['patches'], name), mmap_mode='r') for name in PATCH_FILES]
+            for start in range(0, n, chunk_size):
+                input_feat, rho, theta, mask, indices = [a[start:start+chunk_size] for a in arrays]
+                writer.write(writer.written, index[t['centers'][start:start+chunk_size]],
+                             (input_feat, rho, theta, mask, index[indices]))
+            del arrays
+        for name in PATCH_FILES:
+            patch_file(t['patches'], name).unlink()
+        centers.append(index[t['centers']])
+    return np.concatenate(centers)
+
+
+def patch_file(path, name):
+    # File of a PatchWriter with path template path
+    return path.with_name(f"{path.stem}_{name}.npy")
+
+
+def compute_tiled_surface(args):
+    import pymesh
+    from input_output.read_trajectory import read_topology
+    from input_output.save_ply import save_ply
+    from triangulation.computeAPBS import read_apbs_template
+
+    tmp_dir = Path(masif_opts['tmp_dir'])
+    path_out = Path(args.output_dir).joinpath(f"{args.path.stem}")
+    path_out.mkdir(parents=True, exist_ok=True)
+
+    with Profiler(args.path.stem, args.profile):
+        main_path = prepare_input(args.path, args, tmp_dir)
+        topology = read_topology(main_path)
+        apbs_template = None if args.no_apbs else read_apbs_template()
+
+        # The surface within the core box depends on the atoms within two probe radii and an atom radius,
+        # and the patches of its vertices on the surface within the patch radius.
+        max_radius = max(float(r) for r in topology['R'])
+        reach = max_radius + 2 * args.msms_probe
+        halo = args.patch_max_dist + reach if args.halo is None else args.halo
+        with stage('tiles') as info:
+            tiles, origin, shape = make_tiles(topology, args.tile_size, halo, reach)
+            info['tiles'] = len(tiles)
+        print(f"{len(tiles)} tiles of {args.tile_size:.0f} A (grid {'x'.join(map(str, shape))}), halo {halo:.1f} A")
+
+        jobs = [(n, box, atoms) for n, (ijk, box, atoms) in enumerate(tiles)]
+        initargs = (topology, args, apbs_template, tmp_dir)
+        if args.n_jobs > 1:
+            pool = Pool(args.n_jobs, initializer=init_worker, initargs=initargs)
+            results = pool.imap(compute_tile, jobs)
+        else:
+            pool = None
+            init_worker(*initargs)
+            results = map(compute_tile, jobs)
+        # The tiles are collected as they complete; their patches stay on disk
+        computed = []
+        try:
+            for result in results:
+                computed.append(result)
+                print(f"Tile {len(computed)}/{len(jobs)}: {len(result['vertices'])} vertices")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        with stage('stitch'):
+            vertices, faces, features, stitched_index = stitch(computed)
+        print(f"Stitched surface: {len(vertices)} vertices, {len(faces)} faces")
+
+        # Save mesh, features and patches as main.py
+        with stage('save'):
+            mesh = pymesh.form_mesh(vertices, faces)
+            save_ply(str(path_out.joinpath(f"{args.path.stem}.ply")), mesh)
+            path_feat = path_out.joinpath(f"{args.path.stem}.npy")
+            save_features(path_feat, features)
+            if args.patches:
+                centers = write_patches(path_feat, computed, stitched_index, args.patch_max_size)
+                if get_center_selection(args) is None:
+                    # Every vertex is the center of a patch, in order
+                    centers = None
+                save_centers(path_feat, mesh, centers)
+
+
+if __name__ == "__main__":
+    compute_tiled_surface(parse_arguments())
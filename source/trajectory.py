@@ -0,0 +1,116 @@
+#!/usr/bin/python
+import argparse
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+# Local includes
+from default_config.masif_opts import masif_opts
+from main import add_surface_arguments, msms_arguments, regularize_surface, add_curvature, save_surface
+from profiling import Profiler, stage
+
+
+# Per-worker state, set once by init_worker
+WORKER = {}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Compute molecular surfaces for every frame of a trajectory')
+    parser.add_argument('topology', type=Path, help='Path to topology PDB / PQR file')
+    parser.add_argument('trajectory', type=Path, help='Path to frames: (n_frames, n_atoms, 3) .npy array, or any MDAnalysis trajectory')
+    parser.add_argument('--start', type=int, default=0, help='First frame')
+    parser.add_argument('--stop', type=int, default=None, help='Last frame (exclusive)')
+    parser.add_argument('--stride', type=int, default=1, help='Step between frames')
+    parser.add_argument('-n', '--n_jobs', type=int, default=1, help='Number of frames processed in parallel')
+    add_surface_arguments(parser)
+
+    return parser.parse_args()
+
+
+def init_worker(topology, args, apbs_template, path_out):
+    WORKER['topology'] = topology
+    WORKER['args'] = args
+    WORKER['apbs_template'] = apbs_template
+    WORKER['path_out'] = path_out
+
+
+def compute_frame_surface(frame):
+    """
+    Compute the surface and features of a single frame, using the
+    per-atom data that was parsed once in read_topology.
+    """
+    from input_output.read_trajectory import write_frame
+    from triangulation.computeMSMS import computeMSMS_atoms
+    from triangulation.computeHydrophobicity import computeHydrophobicity
+    from triangulation.computeAPBS import computeAPBS
+
+    i, coords = frame
+    topology, args = WORKER['topology'], WORKER['args']
+    tmp_dir = Path(masif_opts['tmp_dir'])
+    stem = f"{topology['path'].stem}_{i:05d}"
+    features = {}
+
+    with Profiler(stem, args.profile):
+        # Compute MSMS of surface
+        atom_idx = topology['atom_idx']
+        with stage('msms', atoms=len(atom_idx)) as info:
+            vertices, faces, normals, names, areas = computeMSMS_atoms(coords[atom_idx], topology['R'],
+                                                                       topology['full_ids'], msms_arguments(args))
+            info['msms_vertices'] = len(vertices)
+
+        # For each surface residue, assign the hydrophobicity of its amino acid.
+        vertex_hphob = None
+        if args.hphob:
+            vertex_hphob = computeHydrophobicity(names)
+
+        with stage('regularize') as info:
+            mesh, vertex_normals, features = regularize_surface(vertices, faces, names, features, args,
+                                                                vertex_hphob=vertex_hphob)
+            info['mesh_vertices'] = len(mesh.vertices)
+
+        # Compute the surface charge from the frame written as a PQR file
+        if not args.no_apbs:
+            with stage('apbs', mesh_vertices=len(mesh.vertices)):
+                path_frame = tmp_dir.joinpath(f"{stem}{topology['path'].suffix}")
+                write_frame(path_frame, topology, coords)
+                vertex_charges = computeAPBS(mesh.vertices, path_frame, tmp_dir, WORKER['apbs_template'])
+            features['charge'] = vertex_charges / 10
+
+        with stage('curvature'):
+            features = add_curvature(mesh, features)
+
+        # Save mesh, features and patches
+        path_out = WORKER['path_out']
+        save_surface(path_out.joinpath(f"{stem}.ply"), path_out.joinpath(f"{stem}.npy"),
+                     mesh, vertex_normals, features, args)
+    return i
+
+
+def compute_trajectory_surfaces(args):
+    from input_output.read_trajectory import read_topology, iter_frames
+    from triangulation.computeAPBS import read_apbs_template
+
+    # Parse topology, radii and charges only once
+    topology = read_topology(args.topology)
+    apbs_template = None if args.no_apbs else read_apbs_template()
+
+    # Frames are stored as {output_dir}/{topology}/{topology}_{frame:05d}_*
+    path_out = Path(args.output_dir).joinpath(f"{args.topology.stem}")
+    path_out.mkdir(parents=True, exist_ok=True)
+
+    frames = iter_frames(args.trajectory, topology, args.start, args.stop, args.stride)
+    initargs = (topology, args, apbs_template, path_out)
+    if args.n_jobs > 1:
+        with Pool(args.n_jobs, initializer=init_worker, initargs=initargs) as pool:
+            done = list(pool.imap(compute_frame_surface, frames))
+    else:
+        init_worker(*initargs)
+        done = [compute_frame_surface(f) for f in frames]
+
+    # Index of the frames in the output store
+    np.save(path_out.joinpath(f"{args.topology.stem}_frames.npy"), np.array(done, dtype=int))
+
+
+if __name__ == "__main__":
+    compute_trajectory_surfaces(parse_arguments())
@@ -1,7 +1,7 @@
 import numpy as np
 from subprocess import Popen, PIPE
 
-from default_config.global_vars import apbs_bin, pdb2pqr_bin, multivalue_bin
+from default_config import global_vars
 
 """
 computeAPBS.py: Wrapper function to compute the Poisson Boltzmann electrostatics for a surface using APBS.
@@ -11,11 +11,15 @@ Released under an Apache License 2.0
 """
 
 
-def convert_apbs_input(path_input, tmp_dir):
-    path_template = 'apbs_input.in'
+def read_apbs_template(path_template='apbs_input.in'):
+    return open(path_template, 'r').readlines()
+
+
+def convert_apbs_input(path_input, tmp_dir, template=None):
     path_apbs_input = tmp_dir.joinpath(f"{path_input.stem}.in")
     path_dx = tmp_dir.joinpath(f"{path_input.stem}")
-    lines = open(path_template, 'r').readlines()
+    # Copy the template, so that a template read once can be reused
+    lines = list(read_apbs_template() if template is None else template)
     lines[1] = f"    mol pqr {str(path_input)}\n"
     lines[23] = f"    write pot dx {str(path_dx)}\n"
     with open(path_apbs_input, 'w') as o:
@@ -23,9 +27,11 @@ def convert_apbs_input(path_input, tmp_dir):
             o.write(l)
         
 
-def computeAPBS(vertices, path_input, tmp_dir):
+def computeAPBS(vertices, path_input, tmp_dir, apbs_template=None):
     """
         Calls APBS, pdb2pqr, and multivalue and returns the charges per vertex
+        apbs_template: lines of the APBS input template (PQR input only);
+            read from apbs_input.in if not given.
     """
 
     filename_base = path_input.stem
@@ -34,7 +40,7 @@ def computeAPBS(vertices, path_input, tmp_dir):
     if path_input.suffix == '.pdb':
         # Convert to PQR
         args = [
-            pdb2pqr_bin,
+            global_vars.pdb2pqr_bin,
             "--ff=parse",
             "--whitespace",
             "--noopt",
@@ -47,9 +53,9 @@ def computeAPBS(vertices, path_input, tmp_dir):
 
     elif path_input.suffix == '.pqr':
         # Create APBS input
-        convert_apbs_input(path_input, tmp_dir)
+        convert_apbs_input(path_input, tmp_dir, apbs_template)
 
-    args = [apbs_bin, filename_base + ".in"]
+    args = [global_vars.apbs_bin, filename_base + ".in"]
     p2 = Popen(args, stdout=PIPE, stderr=PIPE, cwd=str(tmp_dir))
     stdout, stderr = p2.communicate()
 
@@ -58,7 +64,7 @@ def computeAPBS(vertices, path_input, tmp_dir):
             vertfile.write("{},{},{}\n".format(vert[0], vert[1], vert[2]))
 
     args = [
-        multivalue_bin,
+        global_vars.multivalue_bin,
         filename_base + ".csv",
         filename_base + ".dx",
         filename_base + "_out.csv",
@@ -2,8 +2,8 @@ import os
 from subprocess import Popen, PIPE
 
 from input_output.read_msms import read_msms
-from triangulation.xyzrn import output_pdb_as_xyzrn
-from default_config.global_vars import msms_bin 
+from triangulation.xyzrn import output_pdb_as_xyzrn, write_xyzrn
+from default_config import global_vars
 from default_config.masif_opts import masif_opts
 import random
 
@@ -11,15 +11,30 @@ import random
 # Calls MSMS and returns the vertices.
 # Special atoms are atoms with a reduced radius.
 def computeMSMS(path_input,  msms_args):
-    # Convert 
+    # Convert
     randnum = random.randint(1,10000000)
     file_base = masif_opts['tmp_dir']+"/msms_"+str(randnum)
     path_xyzrn = file_base+".xyzrn"
     output_pdb_as_xyzrn(path_input, path_xyzrn)
+    return run_msms(file_base, msms_args)
+
+
+# Calls MSMS on atoms that are already in memory (e.g. one frame of a trajectory),
+# skipping the parsing of the pdb / pqr file.
+def computeMSMS_atoms(coords, R, full_ids, msms_args):
+    randnum = random.randint(1,10000000)
+    file_base = masif_opts['tmp_dir']+"/msms_"+str(randnum)
+    write_xyzrn(file_base+".xyzrn", coords, R, full_ids)
+    return run_msms(file_base, msms_args)
+
+
+# Run MSMS on {file_base}.xyzrn, read the output and remove the temporary files.
+def run_msms(file_base, msms_args):
+    path_xyzrn = file_base+".xyzrn"
 
     # Now run MSMS on xyzrn file
     FNULL = open(os.devnull, 'w')
-    args = [msms_bin] + msms_args + ["-if",path_xyzrn,"-of",file_base, "-af", file_base]
+    args = [global_vars.msms_bin] + msms_args + ["-if",path_xyzrn,"-of",file_base, "-af", file_base]
 
     p2 = Popen(args, stdout=PIPE, stderr=PIPE)
     stdout, stderr = p2.communicate()
@@ -33,11 +48,10 @@ def computeMSMS(path_input,  msms_args):
         areas[fields[3]] = fields[1]
 
 
-    # Remove temporary files. 
+    # Remove temporary files.
     os.remove(file_base+'.area')
     os.remove(file_base+'.xyzrn')
     os.remove(file_base+'.vert')
     os.remove(file_base+'.face')
     return vertices, faces, normals, names, areas
 
-
@@ -8,15 +8,20 @@ This file is part of MaSIF.
 Released under an Apache License 2.0
 """
 
-def output_pdb_as_xyzrn(path_input, path_xyzrn):
+def read_xyzrn_atoms(path_input):
     """
-        pdbfilename: input pdb / pqr filename
-        xyzrnfilename: output in xyzrn format.
+        Read the atoms of a pdb / pqr file that go into the xyzrn file.
+        path_input: input pdb / pqr filename
+        Returns:
+            atom_idx: index of each selected atom in struct.get_atoms()
+            coords: (n,3) coordinates of each selected atom
+            R: radius of each selected atom (as a string)
+            full_ids: MSMS name of each selected atom
     """
     parser = PDBParser()
     struct = parser.get_structure('', path_input)
-    outfile = open(path_xyzrn, "w")
-    for atom in struct.get_atoms():
+    atom_idx, coords, R, full_ids = [], [], [], []
+    for ix, atom in enumerate(struct.get_atoms()):
         name = atom.get_name()
         residue = atom.get_parent()
         # Ignore hetatms.
@@ -28,15 +33,35 @@ def output_pdb_as_xyzrn(path_input, path_xyzrn):
         atomtype = name[0]
 
         if path_input.suffix == '.pqr':
-            R = str(atom.get_bfactor())
+            r = str(atom.get_bfactor())
         elif path_input.suffix == '.pdb':
             if atomtype not in radii:
                 continue
-            R = radii[atomtype]
+            r = radii[atomtype]
 
-        coords = "{:.06f} {:.06f} {:.06f}".format(*atom.get_coord())
-        full_id = f"{chain}_{residx:d}_{resname}_{atomtype}_{name}"
+        atom_idx.append(ix)
+        coords.append(atom.get_coord())
+        R.append(r)
+        full_ids.append(f"{chain}_{residx:d}_{resname}_{atomtype}_{name}")
+    return atom_idx, coords, R, full_ids
+
+
+def write_xyzrn(path_xyzrn, coords, R, full_ids):
+    """
+        coords: (n,3) atom coordinates
+        R, full_ids: radii and names of each atom, as returned by read_xyzrn_atoms
+    """
+    with open(path_xyzrn, "w") as outfile:
+        for xyz, r, full_id in zip(coords, R, full_ids):
+            coords_str = "{:.06f} {:.06f} {:.06f}".format(*xyz)
+            outfile.write(coords_str + " " + r + " 1 " + full_id + "\n")
 
-        outfile.write(coords + " " + R + " 1 " + full_id + "\n")
 
+def output_pdb_as_xyzrn(path_input, path_xyzrn):
+    """
+        pdbfilename: input pdb / pqr filename
+        xyzrnfilename: output in xyzrn format.
+    """
+    atom_idx, coords, R, full_ids = read_xyzrn_atoms(path_input)
+    write_xyzrn(path_xyzrn, coords, R, full_ids)
 